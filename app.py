@@ -3,24 +3,65 @@
 Flask application with webhook endpoint for IntaSend events
 """
 import os
-from flask import Flask, request, jsonify
+import threading
+from flask import Flask, request, jsonify, Response, stream_with_context, make_response
 from flask_cors import CORS
 from dotenv import load_dotenv
 from datetime import datetime
 import json
-from wallet_manager import UniversityWalletManager
-import database as db
+import hashlib
+from functools import wraps
 
+# Before the local modules, which read their settings when imported
 load_dotenv()
 
+from circuit_breaker import CircuitOpen, get_breaker
+import database as db
+import ledger
+from balance_cache import BalanceCache
+import webhook_inbox
+import jobs
+import provisioning
+import disbursements
+import export
+import events
+import serializers
+import metrics
+import logs
+from idempotency import idempotent
+
+log = logs.get_logger('app')
+
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.getenv('FLASK_SECRET_KEY', 'dev-secret-key-change-in-production')
 
 # Enable CORS for frontend communication
 CORS(app)
+serializers.init_app(app)
+metrics.init_app(app)
+
+# IntaSend wallet manager, created on first use so that importing the app
+# (tests, CLI tools, new workers) does not load the SDK or need credentials
+wallet_manager = None
+_wallet_manager_lock = threading.Lock()
+
+def get_wallet_manager():
+    global wallet_manager
+    if wallet_manager is None:
+        with _wallet_manager_lock:
+            if wallet_manager is None:
+                from wallet_manager import UniversityWalletManager
+                wallet_manager = UniversityWalletManager()
+    return wallet_manager
 
-# Initialize wallet manager
-wallet_manager = UniversityWalletManager()
+# Shared with every wallet manager in the process
+intasend_breaker = get_breaker('IntaSend')
+
+# Recently fetched IntaSend balances, keyed by wallet_id
+balance_cache = BalanceCache()
+
+metrics.Gauge('intasend_circuit_open', 'Whether the IntaSend circuit breaker is refusing calls',
+              lambda: intasend_breaker.status()['state'] != 'closed')
 
 
 @app.route('/')
@@ -39,11 +80,20 @@ def api_info():
             'webhook': '/webhook/intasend',
             'health': '/health',
             'create_wallet': '/create-wallet',
+            'bulk_create_wallets': '/wallets/bulk',
             'deposit': '/deposit',
             'balance': '/balance/<student_id>',
             'transfer': '/transfer',
+            'disbursements': '/disbursements',
             'wallets': '/wallets',
-            'transactions': '/transactions'
+            'transactions': '/transactions',
+            'stats': '/stats',
+            'student_transactions': '/transactions/<student_id>',
+            'transaction_metadata': '/transactions/<id>/metadata',
+            'export': '/export/<transactions|wallets>',
+            'events': '/events',
+            'events_poll': '/events/poll',
+            'metrics': '/metrics'
         },
         'timestamp': datetime.now().isoformat()
     })
@@ -52,12 +102,27 @@ def api_info():
 @app.route('/health')
 def health():
     """Health check endpoint"""
+    intasend = intasend_breaker.status()
     return jsonify({
-        'status': 'healthy',
+        'status': 'healthy' if intasend['state'] == 'closed' else 'degraded',
+        'intasend': intasend,
         'timestamp': datetime.now().isoformat()
     })
 
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus metrics for this process"""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+
+def provider_unavailable(error):
+    """503 response for a request refused by the IntaSend circuit breaker"""
+    response = jsonify({'error': str(error), 'retry_after': round(error.retry_after)})
+    response.headers['Retry-After'] = str(max(1, round(error.retry_after)))
+    return response, 503
+
+
 
 @app.route('/create-wallet', methods=['POST'])
 def create_wallet():
@@ -76,7 +141,7 @@ def create_wallet():
             return jsonify({'error': f'Wallet already exists for student {student_id}'}), 400
 
         # Create wallet via IntaSend
-        wallet = wallet_manager.create_wallet(
+        wallet = get_wallet_manager().create_wallet(
             label=student_id,
             currency="KES",
             can_disburse=True
@@ -111,12 +176,79 @@ def create_wallet():
         else:
             return jsonify({'error': 'Failed to create wallet with IntaSend'}), 500
 
+    except CircuitOpen as e:
+        return provider_unavailable(e)
+    except Exception as e:
+        log.exception('Error creating wallet')
+        return jsonify({'error': str(e)}), 500
+
+
+def read_job_upload(list_key):
+    """
+    Rows, options and source name of a bulk job request: an uploaded CSV or
+    JSON file (options in the form), a JSON body (rows under list_key) or a
+    raw CSV body (options in the query string).
+    """
+    if 'file' in request.files:
+        upload = request.files['file']
+        rows = jobs.parse_rows(upload.read(), jobs.file_format(upload.filename), list_key)
+        return rows, request.form, upload.filename
+    if request.is_json:
+        data = request.get_json() or {}
+        options = data if isinstance(data, dict) else {}
+        return jobs.parse_rows(data, 'json', list_key), options, 'api'
+    return jobs.parse_rows(request.get_data(), 'csv'), request.args, 'api'
+
+
+@app.route('/wallets/bulk', methods=['POST'])
+def bulk_create_wallets():
+    """Start a provisioning job from a JSON list or CSV of students"""
+    try:
+        students, _, source = read_job_upload('students')
+        if not students:
+            return jsonify({'error': 'No students provided'}), 400
+
+        job_id = provisioning.create_job(students, source=source)
+        provisioning.start_job(job_id, get_wallet_manager())
+
+        return jsonify({
+            'success': True,
+            'job_id': job_id,
+            'total': len(students),
+            'status_url': f'/wallets/bulk/{job_id}'
+        }), 202
+
     except Exception as e:
-        print(f"Error creating wallet: {str(e)}")
+        log.exception('Error starting bulk provisioning')
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/wallets/bulk/<int:job_id>')
+def bulk_create_wallets_status(job_id):
+    """Progress and per-row results of a provisioning job"""
+    status = provisioning.job_status(
+        job_id,
+        row_status=request.args.get('status'),
+        after=request.args.get('after', 0, type=int),
+        limit=min(request.args.get('limit', 100, type=int), 1000)
+    )
+    if not status:
+        return jsonify({'error': f'No provisioning job {job_id}'}), 404
+    return jsonify({'success': True, 'job': status}), 200
+
+
+@app.route('/wallets/bulk/<int:job_id>/resume', methods=['POST'])
+def bulk_create_wallets_resume(job_id):
+    """Resume an interrupted provisioning job"""
+    if not provisioning.job_status(job_id, limit=0):
+        return jsonify({'error': f'No provisioning job {job_id}'}), 404
+    retry_failed = request.args.get('retry_failed', 'false').lower() == 'true'
+    provisioning.start_job(job_id, get_wallet_manager(), retry_failed=retry_failed)
+    return jsonify({'success': True, 'job_id': job_id, 'status_url': f'/wallets/bulk/{job_id}'}), 202
+
+
 @app.route('/deposit', methods=['POST'])
+@idempotent
 def deposit():
     
     try:
@@ -134,7 +266,7 @@ def deposit():
             return jsonify({'error': f'No wallet found for student {student_id}'}), 404
 
         # Initiate M-Pesa STK push
-        result = wallet_manager.fund_wallet(
+        result = get_wallet_manager().fund_wallet(
             wallet_id=wallet['wallet_id'],
             amount=float(amount),
             phone_number=phone
@@ -150,17 +282,22 @@ def deposit():
             metadata={'phone': phone, 'method': 'M-PESA'}
         )
 
-        return jsonify({
+        response = {
             'success': True,
             'message': 'M-Pesa STK push sent. Check your phone to complete payment.',
             'student_id': student_id,
             'amount': amount,
             'phone': phone,
-            'result': result
-        }), 200
-
+            'invoice_id': ((result or {}).get('invoice') or {}).get('invoice_id')
+        }
+        if include_requested('provider'):
+            response['result'] = result
+        return jsonify(response), 200
+
+    except CircuitOpen as e:
+        return provider_unavailable(e)
     except Exception as e:
-        print(f"Error processing deposit: {str(e)}")
+        log.exception('Error processing deposit')
         return jsonify({'error': str(e)}), 500
 
 
@@ -173,33 +310,60 @@ def get_balance(student_id):
         if not wallet:
             return jsonify({'error': f'No wallet found for student {student_id}'}), 404
 
-        # Get live balance from IntaSend
-        balance_info = wallet_manager.get_wallet_balance(wallet['wallet_id'])
+        # Serve a recent balance from the cache when we have one
+        cached = balance_cache.get(wallet['wallet_id'])
+        if cached:
+            balance_info, cache_age = cached
+        else:
+            # Get live balance from IntaSend
+            version = balance_cache.version(wallet['wallet_id'])
+            try:
+                balance_info = get_wallet_manager().get_wallet_balance(wallet['wallet_id'])
+            except CircuitOpen as e:
+                # IntaSend is down: answer with the last balance we recorded
+                return jsonify({
+                    'success': True,
+                    'student_id': student_id,
+                    'student_name': wallet['student_name'],
+                    'balance': wallet['balance'],
+                    'currency': 'KES',
+                    'wallet_id': wallet['wallet_id'],
+                    'cached': False,
+                    'stale': True,
+                    'as_of': wallet['updated_at'],
+                    'retry_after': round(e.retry_after)
+                }), 200
+            cache_age = 0
+            if balance_info:
+                # Reconcile the local ledger with the current balance
+                ledger.reconcile(wallet['wallet_id'], balance_info.get('current_balance', 0))
+                balance_cache.put(wallet['wallet_id'], balance_info, version)
 
         if balance_info:
-            # Update local database with current balance
-            current_balance = balance_info.get('current_balance', 0)
-            db.update_wallet_balance(student_id, current_balance)
-
             return jsonify({
                 'success': True,
                 'student_id': student_id,
                 'student_name': wallet['student_name'],
-                'balance': current_balance,
+                'balance': balance_info.get('current_balance', 0),
                 'currency': balance_info.get('currency', 'KES'),
-                'wallet_id': wallet['wallet_id']
+                'wallet_id': wallet['wallet_id'],
+                'cached': cached is not None,
+                'cache_age': round(cache_age, 3),
+                'stale': False
             }), 200
         else:
             return jsonify({'error': 'Failed to fetch balance from IntaSend'}), 500
 
     except Exception as e:
-        print(f"Error fetching balance: {str(e)}")
+        log.exception('Error fetching balance')
         return jsonify({'error': str(e)}), 500
 
 
 @app.route('/transfer', methods=['POST'])
+@idempotent
 def transfer():
-    
+    from intasend_transport import IntaSendTimeout
+
     try:
         data = request.get_json()
         from_student = data.get('from_student')
@@ -208,6 +372,13 @@ def transfer():
 
         if not from_student or not to_student or not amount:
             return jsonify({'error': 'from_student, to_student, and amount are required'}), 400
+        try:
+            if ledger.to_cents(amount) <= 0:
+                return jsonify({'error': 'amount must be positive'}), 400
+        except ledger.LedgerError as e:
+            return jsonify({'error': str(e)}), 400
+        if from_student == to_student:
+            return jsonify({'error': 'Cannot transfer to the same student'}), 400
 
         # Get wallets from database
         from_wallet = db.get_wallet_by_student_id(from_student)
@@ -218,26 +389,59 @@ def transfer():
         if not to_wallet:
             return jsonify({'error': f'No wallet found for student {to_student}'}), 404
 
-        # Get current balance from IntaSend to verify sufficient funds
-        from_balance_info = wallet_manager.get_wallet_balance(from_wallet['wallet_id'])
-        if not from_balance_info:
-            return jsonify({'error': 'Unable to fetch sender wallet balance from IntaSend'}), 500
-
-        available_balance = from_balance_info.get('available_balance', 0)
-        if float(amount) > available_balance:
+        # Check funds against the local ledger and hold them in one transaction
+        narrative = f"Transfer from {from_wallet['student_name']} to {to_wallet['student_name']}"
+        try:
+            with db.transaction():
+                reference = ledger.post_transfer(
+                    from_account=from_wallet['wallet_id'],
+                    to_account=to_wallet['wallet_id'],
+                    amount=amount,
+                    narrative=narrative
+                )
+                db.add_transaction(
+                    transaction_type='transfer',
+                    amount=float(amount),
+                    status='pending',
+                    from_student=from_student,
+                    to_student=to_student,
+                    description=f'Transfer: {from_wallet["student_name"]} -> {to_wallet["student_name"]}',
+                    transaction_id=reference
+                )
+        except ledger.InsufficientFunds as e:
             return jsonify({
-                'error': f'Insufficient balance. Available: {available_balance} KES, Required: {amount} KES',
-                'available_balance': available_balance,
+                'error': str(e),
+                'available_balance': ledger.from_cents(e.available_cents),
                 'required_amount': float(amount)
             }), 400
-
-        # Perform transfer via IntaSend
-        result = wallet_manager.transfer_between_wallets(
-            origin_wallet_id=from_wallet['wallet_id'],
-            destination_wallet_id=to_wallet['wallet_id'],
-            amount=float(amount),
-            narrative=f"Transfer from {from_wallet['student_name']} to {to_wallet['student_name']}"
-        )
+        except ledger.LedgerError as e:
+            return jsonify({'error': str(e)}), 400
+
+        # Perform transfer via IntaSend; it confirms or reverses the posting
+        try:
+            result = get_wallet_manager().transfer_between_wallets(
+                origin_wallet_id=from_wallet['wallet_id'],
+                destination_wallet_id=to_wallet['wallet_id'],
+                amount=float(amount),
+                narrative=narrative
+            )
+        except IntaSendTimeout:
+            # IntaSend may still carry it out: keep the funds held until its
+            # webhook confirms the transfer
+            return jsonify({
+                'success': True,
+                'pending': True,
+                'message': 'Transfer submitted; waiting for IntaSend to confirm it',
+                'reference': reference,
+                'from_student': from_student,
+                'to_student': to_student,
+                'amount': amount
+            }), 202
+        except Exception:
+            with db.transaction():
+                ledger.reverse_transfer(reference, reason='IntaSend transfer request failed')
+                db.update_transaction_status(reference, 'failed')
+            raise
 
         # Check if transfer was successful
         # First check if there's an explicit error in the response
@@ -250,6 +454,10 @@ def transfer():
                 if float(amount) > origin_balance:
                     error_message = f'Insufficient balance. Available: {origin_balance} KES, Required: {amount} KES'
 
+            with db.transaction():
+                ledger.reverse_transfer(reference, reason=error_message)
+                db.update_transaction_status(reference, 'failed', metadata=result)
+
             return jsonify({
                 'error': error_message,
                 'details': result
@@ -257,102 +465,295 @@ def transfer():
 
         # Then check for success indicators: tracking_id or details with valid balances
         if result and ('tracking_id' in result or ('details' in result and not 'error' in result)):
-            # Add transaction record
-            db.add_transaction(
-                transaction_type='transfer',
-                amount=float(amount),
-                status='completed',
-                from_student=from_student,
-                to_student=to_student,
-                description=f'Transfer: {from_wallet["student_name"]} -> {to_wallet["student_name"]}',
-                transaction_id=result.get('tracking_id', 'N/A'),
-                metadata=result
-            )
-
-            # Update wallet balances from the response
-            if 'details' in result:
-                if 'origin' in result['details']:
-                    db.update_wallet_balance(from_student, result['details']['origin'].get('current_balance', 0))
-                if 'destination' in result['details']:
-                    db.update_wallet_balance(to_student, result['details']['destination'].get('current_balance', 0))
-
-            return jsonify({
+            tracking_id = result.get('tracking_id')
+            with db.transaction():
+                ledger.confirm_transfer(reference, provider_ref=tracking_id)
+                db.update_transaction_status(
+                    reference, 'completed',
+                    new_transaction_id=tracking_id,
+                    metadata=result
+                )
+
+            # The response carries both wallets' new balances
+            details = result.get('details') or {}
+            balance_cache.update_from_wallet(from_wallet['wallet_id'], details.get('origin'))
+            balance_cache.update_from_wallet(to_wallet['wallet_id'], details.get('destination'))
+
+            response = {
                 'success': True,
                 'message': f'Transfer successful: {amount} KES from {from_student} to {to_student}',
                 'from_student': from_student,
                 'to_student': to_student,
                 'amount': amount,
-                'tracking_id': result.get('tracking_id', 'N/A'),
-                'details': result
-            }), 200
+                'tracking_id': result.get('tracking_id', 'N/A')
+            }
+            if include_requested('provider'):
+                response['details'] = result
+            return jsonify(response), 200
         else:
+            with db.transaction():
+                ledger.reverse_transfer(reference, reason='Transfer failed')
+                db.update_transaction_status(reference, 'failed', metadata=result)
             return jsonify({'error': 'Transfer failed', 'details': result}), 500
 
+    except CircuitOpen as e:
+        return provider_unavailable(e)
     except Exception as e:
-        print(f"Error processing transfer: {str(e)}")
+        log.exception('Error processing transfer')
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/disbursements', methods=['POST'])
+def create_disbursement():
+    """Start a batch disbursement from a treasury wallet"""
+    try:
+        recipients, options, source = read_job_upload('items')
+        source_wallet_id = options.get('source_wallet_id') or disbursements.TREASURY_WALLET_ID
+        if not source_wallet_id:
+            return jsonify({'error': 'source_wallet_id is required (or set TREASURY_WALLET_ID)'}), 400
+        if not recipients:
+            return jsonify({'error': 'No recipients provided'}), 400
+
+        job_id = disbursements.create_job(source_wallet_id, recipients,
+                                          narrative=options.get('narrative'), source=source)
+        disbursements.start_job(job_id, get_wallet_manager())
+
+        return jsonify({
+            'success': True,
+            'job_id': job_id,
+            'total': len(recipients),
+            'status_url': f'/disbursements/{job_id}'
+        }), 202
+
+    except Exception as e:
+        log.exception('Error starting disbursement')
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/disbursements/<int:job_id>')
+def disbursement_status(job_id):
+    """Progress, throughput and ETA of a disbursement job"""
+    status = disbursements.job_status(
+        job_id,
+        item_status=request.args.get('status'),
+        after=request.args.get('after', 0, type=int),
+        limit=min(request.args.get('limit', 100, type=int), 1000)
+    )
+    if not status:
+        return jsonify({'error': f'No disbursement job {job_id}'}), 404
+    return jsonify({'success': True, 'job': status}), 200
+
+
+@app.route('/disbursements/<int:job_id>/resume', methods=['POST'])
+def disbursement_resume(job_id):
+    """Resume an interrupted disbursement job"""
+    if not disbursements.job_status(job_id, limit=0):
+        return jsonify({'error': f'No disbursement job {job_id}'}), 404
+    retry_failed = request.args.get('retry_failed', 'false').lower() == 'true'
+    disbursements.start_job(job_id, get_wallet_manager(), retry_failed=retry_failed)
+    return jsonify({'success': True, 'job_id': job_id, 'status_url': f'/disbursements/{job_id}'}), 202
+
+
+def include_requested(name):
+    """Whether ?include= asks for an optional part of the response"""
+    return name in request.args.get('include', '').split(',')
+
+
+def conditional_get(view):
+    """
+    Give a read-only endpoint a strong ETag derived from the database's data
+    version and the request URL, and answer a matching If-None-Match with
+    304 before the view runs.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        version = db.data_version()
+        etag = hashlib.sha1(f'{version}|{request.full_path}'.encode()).hexdigest()[:32]
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+        else:
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    return wrapper
+
+
 @app.route('/wallets')
+@conditional_get
 def get_wallets():
     
     try:
-        wallets = db.get_all_wallets()
-
-        # Format wallets for frontend
-        formatted_wallets = []
-        for wallet in wallets:
-            formatted_wallets.append({
-                'student_id': wallet['student_id'],
-                'student_name': wallet['student_name'],
-                'wallet_id': wallet['wallet_id'],
-                'balance': wallet['balance'],
-                'phone': wallet.get('phone'),
-                'email': wallet.get('email'),
-                'created_at': wallet['created_at']
-            })
+        limit = max(1, min(request.args.get('limit', 100, type=int), 1000))
+        try:
+            fields = db.parse_fields(request.args.get('fields', ''), db.WALLET_FIELDS)
+            wallets, next_cursor = db.get_wallets_page(limit=limit, cursor=request.args.get('cursor'),
+                                                       fields=fields)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
 
         return jsonify({
             'success': True,
-            'count': len(formatted_wallets),
-            'wallets': formatted_wallets
-        }), 200 
+            'count': len(wallets),
+            'wallets': wallets,
+            'next_cursor': next_cursor
+        }), 200
 
     except Exception as e:
-        print(f"Error fetching wallets: {str(e)}")
+        log.exception('Error fetching wallets')
         return jsonify({'error': str(e)}), 500
 
 
 @app.route('/transactions')
+@conditional_get
 def get_transactions():
     
     try:
-        limit = request.args.get('limit', 50, type=int)
-        transactions = db.get_all_transactions(limit=limit)
-
-        # Format transactions for frontend
-        formatted_transactions = []
-        for txn in transactions:
-            formatted_transactions.append({
-                'id': txn['id'],
-                'type': txn['type'],
-                'amount': txn['amount'],
-                'status': txn['status'],
-                'student_id': txn.get('student_id'),
-                'from_student': txn.get('from_student'),
-                'to_student': txn.get('to_student'),
-                'description': txn.get('description'),
-                'timestamp': txn['timestamp']
-            })
+        limit = max(1, min(request.args.get('limit', 50, type=int), 1000))
+        try:
+            fields = db.parse_fields(request.args.get('fields', ''), db.TRANSACTION_FIELDS)
+            transactions, next_cursor = db.get_transactions_page(
+                limit=limit, cursor=request.args.get('cursor'), fields=fields,
+                include_metadata=include_requested('metadata'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
 
         return jsonify({
             'success': True,
-            'count': len(formatted_transactions),
-            'transactions': formatted_transactions
+            'count': len(transactions),
+            'transactions': transactions,
+            'next_cursor': next_cursor
         }), 200
 
     except Exception as e:
-        print(f"Error fetching transactions: {str(e)}")
+        log.exception('Error fetching transactions')
+        return jsonify({'error': str(e)}), 500
+
+
+
+@app.route('/transactions/<student_id>')
+@conditional_get
+def get_student_transactions(student_id):
+    """A student's statement, paginated, with optional type and date filters"""
+    try:
+        wallet = db.get_wallet_by_student_id(student_id)
+        if not wallet:
+            return jsonify({'error': f'No wallet found for student {student_id}'}), 404
+
+        limit = max(1, min(request.args.get('limit', 50, type=int), 1000))
+        types = [t for t in request.args.get('type', '').split(',') if t]
+        try:
+            transactions, next_cursor = db.get_student_transactions(
+                student_id,
+                limit=limit,
+                cursor=request.args.get('cursor'),
+                types=types,
+                since=request.args.get('since'),
+                until=request.args.get('until'),
+                fields=db.parse_fields(request.args.get('fields', ''), db.TRANSACTION_FIELDS),
+                include_metadata=include_requested('metadata')
+            )
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        return jsonify({
+            'success': True,
+            'student_id': student_id,
+            'count': len(transactions),
+            'transactions': transactions,
+            'next_cursor': next_cursor
+        }), 200
+
+    except Exception as e:
+        log.exception('Error fetching student transactions')
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/transactions/<int:transaction_id>/metadata')
+@conditional_get
+def get_transaction_metadata(transaction_id):
+    """The raw provider payload stored for one transaction"""
+    try:
+        result = db.get_transaction_metadata(transaction_id)
+        if result is None:
+            return jsonify({'error': f'No transaction {transaction_id}'}), 404
+        return jsonify({'success': True, **result}), 200
+
+    except Exception as e:
+        log.exception('Error fetching transaction metadata')
+        return jsonify({'error': str(e)}), 500
+
+
+
+@app.route('/stats')
+def get_stats():
+    """Precomputed wallet and transaction statistics for dashboards"""
+    try:
+        days = max(1, min(request.args.get('days', 30, type=int), 366))
+        return jsonify({'success': True, 'stats': db.get_stats(days=days)}), 200
+
+    except Exception as e:
+        log.exception('Error fetching stats')
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/export/<kind>')
+def export_data(kind):
+    """Stream all transactions or wallets as CSV or NDJSON"""
+    fmt = request.args.get('format', 'csv')
+    types = [t for t in request.args.get('type', '').split(',') if t]
+    if kind not in ('transactions', 'wallets'):
+        return jsonify({'error': f'Unknown export: {kind}'}), 404
+    try:
+        chunks = export.export(kind, fmt, since=request.args.get('since'),
+                               until=request.args.get('until'), types=types)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    filename = f"{kind}-{datetime.now().strftime('%Y%m%d-%H%M%S')}.{fmt}"
+    return Response(
+        stream_with_context(chunks),
+        mimetype=export.FORMATS[fmt],
+        headers={'Content-Disposition': f'attachment; filename={filename}'}
+    )
+
+
+@app.route('/events')
+def event_stream():
+    """Server-Sent Events stream of wallet and transaction changes"""
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        last_event_id = None
+
+    # Each stream holds a thread; keep the rest free for other requests
+    if not events.acquire_stream():
+        response = jsonify({'error': 'Too many open event streams; try again later'})
+        response.headers['Retry-After'] = '30'
+        return response, 503
+
+    response = Response(
+        events.sse_stream(last_event_id),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
+    response.call_on_close(events.release_stream)
+    return response
+
+
+@app.route('/events/poll')
+def event_poll():
+    """Long-poll fallback: wait for events after the given id"""
+    after = request.args.get('after', type=int)
+    timeout = max(0, min(request.args.get('timeout', 25, type=int), 60))
+    try:
+        return jsonify({'success': True, **events.poll(after, timeout)}), 200
+
+    except Exception as e:
+        log.exception('Error polling events')
         return jsonify({'error': str(e)}), 500
 
 
@@ -374,54 +775,72 @@ def intasend_webhook():
         }), 200
 
     # Handle POST requests (actual webhook events)
+    # Store the raw event and acknowledge; processing happens in the background
+    raw_payload = request.get_data(as_text=True)
     try:
-        # Get the webhook data
-        data = request.get_json()
+        data = json.loads(raw_payload) if raw_payload else None
+    except ValueError:
+        data = None
 
-        if not data:
-            return jsonify({'status': 'error', 'message': 'No data received'}), 400
-
-        # Log the webhook event
-        print("\n" + "="*60)
-        print(f"[{datetime.now().isoformat()}] IntaSend Webhook Received")
-        print("="*60)
-        print(json.dumps(data, indent=2))
-        print("="*60 + "\n")
-
-        # Process different event types
-        event_type = data.get('event')
-
-        if event_type == 'COMPLETE':
-            handle_payment_complete(data)
-        elif event_type == 'FAILED':
-            handle_payment_failed(data)
-        elif event_type == 'wallet.topup':
-            handle_wallet_topup(data)
-        elif event_type == 'wallet.transfer':
-            handle_wallet_transfer(data)
-        else:
-            print(f"[WARN] Unhandled event type: {event_type}")
+    if not isinstance(data, dict):
+        return jsonify({'status': 'error', 'message': 'No data received'}), 400
 
-        # Always return 200 to acknowledge receipt
-        return jsonify({
-            'status': 'success',
-            'message': 'Webhook received',
-            'event': event_type
-        }), 200
+    try:
+        inbox_id = webhook_inbox.enqueue(raw_payload, data)
+    except Exception:
+        log.exception('Failed to store webhook')
+        # Let IntaSend retry the delivery
+        return jsonify({'status': 'error', 'message': 'Webhook could not be stored'}), 503
 
-    except Exception as e:
-        print(f"[ERROR] Error processing webhook: {str(e)}")
-        # Still return 200 to avoid retries for processing errors
-        return jsonify({
-            'status': 'error',
-            'message': str(e)
-        }), 200
+    metrics.webhooks_received.inc((data.get('event') or 'unknown', str(inbox_id is None).lower()))
+    webhook_processor.ensure_started()
+    webhook_processor.notify()
+
+    return jsonify({
+        'status': 'success',
+        'message': 'Webhook received',
+        'event': data.get('event'),
+        'duplicate': inbox_id is None
+    }), 200
+
+
+def process_webhook_event(data):
+    """Run the handler for one stored webhook event (called by inbox workers)"""
+    event_type = data.get('event')
+    log.info('Processing IntaSend webhook', extra={'event': event_type})
+    log.info('Webhook payload', extra={'event': event_type, 'payload': data, 'sample': True})
+
+    handlers = {
+        'COMPLETE': handle_payment_complete,
+        'FAILED': handle_payment_failed,
+        'wallet.topup': handle_wallet_topup,
+        'wallet.transfer': handle_wallet_transfer
+    }
+    handler = handlers.get(event_type)
+    if handler is None:
+        log.warning('Unhandled event type', extra={'event': event_type})
+        metrics.webhooks_processed.inc((event_type or 'unknown', 'ignored'))
+        return
+
+    try:
+        handler(data)
+    except Exception:
+        metrics.webhooks_processed.inc((event_type, 'failed'))
+        raise
+    metrics.webhooks_processed.inc((event_type, 'processed'))
+
+
+# Background processor for the webhook inbox
+webhook_processor = webhook_inbox.WebhookInbox(process_webhook_event)
+
+
+def init_worker():
+    """Per-process startup, run in each server process (not in a preloading parent)"""
+    webhook_processor.ensure_started()
 
 
 def handle_payment_complete(data):
    
-    print("\n[OK] Payment Completed Event")
-
     # Extract key information
     invoice_id = data.get('invoice_id')
     amount = data.get('value') or data.get('amount')
@@ -429,10 +848,9 @@ def handle_payment_complete(data):
     account = data.get('account')  # Phone number or email
     state = data.get('state')
 
-    print(f"  Invoice ID: {invoice_id}")
-    print(f"  Amount: {currency} {amount}")
-    print(f"  Account: {account}")
-    print(f"  State: {state}")
+    log.info('Payment completed', extra={
+        'invoice_id': invoice_id, 'amount': amount, 'currency': currency, 'state': state
+    })
 
     # Save to database
     try:
@@ -444,22 +862,19 @@ def handle_payment_complete(data):
             transaction_id=invoice_id,
             metadata=data
         )
-        print("  [OK] Transaction saved to database")
-    except Exception as e:
-        print(f"  [ERROR] Failed to save transaction: {str(e)}")
+    except Exception:
+        log.exception('Failed to save transaction', extra={'invoice_id': invoice_id})
+        raise
 
     return True
 
 
 def handle_payment_failed(data):
     """Handle failed payment events"""
-    print("\n[ERROR] Payment Failed Event")
-
     invoice_id = data.get('invoice_id')
     failed_reason = data.get('failed_reason')
 
-    print(f"  Invoice ID: {invoice_id}")
-    print(f"  Reason: {failed_reason}")
+    log.warning('Payment failed', extra={'invoice_id': invoice_id, 'reason': failed_reason})
 
     # Save to database
     try:
@@ -471,60 +886,66 @@ def handle_payment_failed(data):
             transaction_id=invoice_id,
             metadata=data
         )
-        print("  [OK] Failed transaction logged to database")
-    except Exception as e:
-        print(f"  [ERROR] Failed to save transaction: {str(e)}")
+    except Exception:
+        log.exception('Failed to save transaction', extra={'invoice_id': invoice_id})
+        raise
 
     return True
 
 
 def handle_wallet_topup(data):
     """Handle wallet top-up events"""
-    print("\n[OK] Wallet Top-up Event")
-
     wallet_id = data.get('wallet_id')
     amount = data.get('amount')
     currency = data.get('currency', 'KES')
     status = data.get('status')
 
-    print(f"  Wallet ID: {wallet_id}")
-    print(f"  Amount: {currency} {amount}")
-    print(f"  Status: {status}")
+    log.info('Wallet top-up', extra={
+        'wallet_id': wallet_id, 'amount': amount, 'currency': currency, 'status': status
+    })
 
-    # Save to database and update wallet balance
+    # The cached IntaSend balance is now out of date
+    balance_cache.invalidate(wallet_id)
+
+    # Save to database and credit the wallet's ledger account
     try:
         # Find wallet by wallet_id
         wallet = db.get_wallet_by_wallet_id(wallet_id)
         if wallet:
-            # Get updated balance from IntaSend
-            balance_info = wallet_manager.get_wallet_balance(wallet_id)
-            if balance_info:
-                new_balance = balance_info.get('current_balance', 0)
-                db.update_wallet_balance(wallet['student_id'], new_balance)
-                print(f"  [OK] Updated balance for {wallet['student_name']}: {new_balance} KES")
-
-            # Log transaction
-            db.add_transaction(
-                transaction_type='topup',
-                amount=float(amount) if amount else 0,
-                status=status or 'completed',
-                student_id=wallet['student_id'],
-                description=f'Wallet top-up for {wallet["student_name"]}',
-                metadata=data
-            )
-            print("  [OK] Transaction saved to database")
+            provider_ref = data.get('invoice_id') or data.get('tracking_id')
+            if provider_ref and ledger.find_transfer(provider_ref=provider_ref):
+                log.info('Top-up already recorded', extra={'provider_ref': provider_ref})
+                return True
+
+            with db.transaction():
+                if amount and (status or 'completed').lower() not in ('failed', 'pending'):
+                    ledger.record_deposit(
+                        wallet_id, amount,
+                        provider_ref=provider_ref,
+                        narrative=f'Wallet top-up for {wallet["student_name"]}'
+                    )
+
+                # Log transaction
+                db.add_transaction(
+                    transaction_type='topup',
+                    amount=float(amount) if amount else 0,
+                    status=status or 'completed',
+                    student_id=wallet['student_id'],
+                    description=f'Wallet top-up for {wallet["student_name"]}',
+                    metadata=data
+                )
+            log.info('Wallet credited', extra={'student_id': wallet['student_id'], 'amount': amount})
         else:
-            print(f"  [WARN] Wallet not found in local database: {wallet_id}")
-    except Exception as e:
-        print(f"  [ERROR] Failed to process top-up: {str(e)}")
+            log.warning('Wallet not found in local database', extra={'wallet_id': wallet_id})
+    except Exception:
+        log.exception('Failed to process top-up', extra={'wallet_id': wallet_id})
+        raise
 
     return True
 
 
 def handle_wallet_transfer(data):
     
-    print("\n[OK] Wallet Transfer Event")
-
     origin_wallet = data.get('origin_wallet_id')
     destination_wallet = data.get('destination_wallet_id')
     amount = data.get('amount')
@@ -532,55 +953,77 @@ def handle_wallet_transfer(data):
     status = data.get('status')
     tracking_id = data.get('tracking_id')
 
-    print(f"  From: {origin_wallet}")
-    print(f"  To: {destination_wallet}")
-    print(f"  Amount: KES {amount}")
-    print(f"  Narrative: {narrative}")
-    print(f"  Status: {status}")
+    log.info('Wallet transfer', extra={
+        'origin_wallet_id': origin_wallet, 'destination_wallet_id': destination_wallet,
+        'amount': amount, 'status': status, 'tracking_id': tracking_id
+    })
+
+    # The cached IntaSend balances are now out of date
+    balance_cache.invalidate(origin_wallet)
+    balance_cache.invalidate(destination_wallet)
 
-    # Save to database and update wallet balances
+    # Save to database and settle the matching ledger transfer
     try:
         # Find both wallets
         from_wallet = db.get_wallet_by_wallet_id(origin_wallet)
         to_wallet = db.get_wallet_by_wallet_id(destination_wallet)
 
         if from_wallet and to_wallet:
-            # Update balances for both wallets
-            from_balance_info = wallet_manager.get_wallet_balance(origin_wallet)
-            to_balance_info = wallet_manager.get_wallet_balance(destination_wallet)
-
-            if from_balance_info:
-                db.update_wallet_balance(from_wallet['student_id'], from_balance_info.get('current_balance', 0))
-            if to_balance_info:
-                db.update_wallet_balance(to_wallet['student_id'], to_balance_info.get('current_balance', 0))
-
-            print(f"  [OK] Updated balances for both wallets")
-
-            # Log transaction
-            db.add_transaction(
-                transaction_type='transfer',
-                amount=float(amount) if amount else 0,
-                status=status or 'completed',
-                from_student=from_wallet['student_id'],
-                to_student=to_wallet['student_id'],
-                description=narrative or f'Transfer: {from_wallet["student_name"]} -> {to_wallet["student_name"]}',
-                transaction_id=tracking_id,
-                metadata=data
-            )
-            print("  [OK] Transaction saved to database")
+            # A transfer started through /transfer is already in the ledger
+            transfer = None
+            if tracking_id:
+                transfer = ledger.find_transfer(provider_ref=tracking_id)
+            if not transfer and amount:
+                transfer = ledger.find_pending_transfer(origin_wallet, destination_wallet, amount)
+
+            if transfer and transfer['status'] == 'confirmed':
+                log.info('Transfer already recorded', extra={'tracking_id': tracking_id})
+            elif transfer and transfer['status'] == 'pending':
+                with db.transaction():
+                    ledger.confirm_transfer(transfer['reference'], provider_ref=tracking_id)
+                    db.update_transaction_status(
+                        transfer['reference'], status or 'completed',
+                        new_transaction_id=tracking_id
+                    )
+                    disbursements.settle_transfer(transfer['reference'], tracking_id)
+                log.info('Confirmed pending transfer', extra={'reference': transfer['reference']})
+            elif amount:
+                # Transfer made outside this system: IntaSend has settled it
+                with db.transaction():
+                    ledger.post_transfer(
+                        origin_wallet, destination_wallet, amount,
+                        narrative=narrative, status='confirmed',
+                        provider_ref=tracking_id, allow_overdraft=True
+                    )
+
+                    # Log transaction
+                    db.add_transaction(
+                        transaction_type='transfer',
+                        amount=float(amount),
+                        status=status or 'completed',
+                        from_student=from_wallet['student_id'],
+                        to_student=to_wallet['student_id'],
+                        description=narrative or f'Transfer: {from_wallet["student_name"]} -> {to_wallet["student_name"]}',
+                        transaction_id=tracking_id,
+                        metadata=data
+                    )
+                log.info('Recorded external transfer', extra={'tracking_id': tracking_id})
         else:
             if not from_wallet:
-                print(f"  [WARN] Origin wallet not found: {origin_wallet}")
+                log.warning('Origin wallet not found', extra={'wallet_id': origin_wallet})
             if not to_wallet:
-                print(f"  [WARN] Destination wallet not found: {destination_wallet}")
-    except Exception as e:
-        print(f"  [ERROR] Failed to process transfer: {str(e)}")
+                log.warning('Destination wallet not found', extra={'wallet_id': destination_wallet})
+    except Exception:
+        log.exception('Failed to process transfer', extra={'tracking_id': tracking_id})
+        raise
 
     return True
 
 
 if __name__ == '__main__':
-    port = int(os.getenv('FLASK_PORT', 5000)) 
+    # Development server; use gunicorn (see wsgi.py) in production
+    port = int(os.getenv('FLASK_PORT', 5000))
+    debug = os.getenv('FLASK_DEBUG', 'false').lower() == 'true'
 
     print("\n" + "="*60)
     print("University Wallet System - Webhook Server")
@@ -594,8 +1037,12 @@ if __name__ == '__main__':
     print(f"  ngrok http {port}")
     print("="*60 + "\n")
 
+    # With the reloader on, only the serving child process runs workers
+    if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        init_worker()
+
     app.run(
         host='0.0.0.0',
         port=port,
-        debug=True
+        debug=debug
     )
@@ -0,0 +1,200 @@
+"""
+Time-partitioned archival of old transactions
+
+Closed transactions (anything not pending or processing) older than
+ARCHIVE_AFTER_DAYS are moved out of the live transactions table into one
+SQLite file per month, ARCHIVE_DIR/transactions-YYYY-MM.db. The live table
+then holds only recent and open transactions, so its pages and indexes
+stay small enough to remain in cache.
+
+Archives are ATTACHed on demand: history and export queries only open the
+months their date range or cursor reaches, and statistics are unchanged by
+archiving. Rows are moved in batches: each batch is committed to the
+archive first and then deleted from the live table in a second short
+transaction, so the app keeps running while the archiver works and an
+interrupted run can simply be repeated.
+
+Usage: python archive.py [--days N] [--batch-size N] [--dry-run] [--vacuum] [--list]
+
+Meant to run from cron, e.g. nightly.
+"""
+import os
+import sys
+import json
+import argparse
+from datetime import datetime, timedelta, timezone
+import database as db
+import logs
+
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', 180))
+ARCHIVE_BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', 1000))
+
+# Transactions in these states may still change and stay in the live table
+OPEN_STATUSES = ('pending', 'processing')
+
+log = logs.get_logger('archive')
+
+_CLOSED = f"LOWER(COALESCE(status, '')) NOT IN ({', '.join(repr(s) for s in OPEN_STATUSES)})"
+
+
+def archive_cutoff(older_than_days=ARCHIVE_AFTER_DAYS):
+    """Timestamp before which closed transactions are archived"""
+    cutoff = datetime.now(timezone.utc) - timedelta(days=older_than_days)
+    return cutoff.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _create_archive_table(conn, schema):
+    """Create the archive's transactions table with the live table's columns"""
+    columns = conn.execute('PRAGMA main.table_info(transactions)').fetchall()
+    definitions = ', '.join(
+        'id INTEGER PRIMARY KEY' if column['name'] == 'id'
+        else f"{column['name']} {column['type']}".rstrip()
+        for column in columns)
+    conn.execute(f'CREATE TABLE IF NOT EXISTS {schema}.transactions ({definitions})')
+    # Columns added to the live table since this archive was created
+    existing = {row['name'] for row in conn.execute(f'PRAGMA {schema}.table_info(transactions)')}
+    for column in columns:
+        if column['name'] not in existing:
+            conn.execute(f"ALTER TABLE {schema}.transactions ADD COLUMN {column['name']} {column['type']}")
+
+    # Same access paths as the live table: keyset pages and per-student history
+    conn.execute(f'CREATE INDEX IF NOT EXISTS {schema}.idx_transaction_timestamp_id ON transactions(timestamp, id)')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS {schema}.idx_transaction_student ON transactions(student_id, timestamp, id)')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS {schema}.idx_transaction_from ON transactions(from_student, timestamp, id)')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS {schema}.idx_transaction_to ON transactions(to_student, timestamp, id)')
+    conn.execute(f'CREATE INDEX IF NOT EXISTS {schema}.idx_transaction_reference ON transactions(transaction_id)')
+    return [column['name'] for column in columns]
+
+
+def _months_to_archive(conn, cutoff):
+    return [row[0] for row in conn.execute(f'''
+        SELECT DISTINCT substr(timestamp, 1, 7) FROM transactions
+        WHERE timestamp < ? AND {_CLOSED}
+        ORDER BY 1
+    ''', (cutoff,))]
+
+
+def _archive_month(conn, month, cutoff, batch_size):
+    """Move one month's closed transactions older than cutoff; returns rows moved"""
+    start, end = db.month_bounds(month)
+    end = min(end, cutoff)
+    moved = 0
+    with db.attach_archive(conn, month) as schema:
+        columns = _create_archive_table(conn, schema)
+        # Archives keep each transaction's payload inline in its metadata column
+        values = ', '.join(
+            'COALESCE(p.payload, t.metadata)' if column == 'metadata' else f't.{column}'
+            for column in columns)
+        columns = ', '.join(columns)
+        while True:
+            ids = [row[0] for row in conn.execute(f'''
+                SELECT id FROM transactions
+                WHERE timestamp >= ? AND timestamp < ? AND {_CLOSED}
+                LIMIT ?
+            ''', (start, end, batch_size))]
+            if not ids:
+                return moved
+            id_list = json.dumps(ids)
+
+            # Commit the copy before deleting anything: SQLite in WAL mode does
+            # not commit atomically across attached files, so a crash between
+            # the two leaves a duplicate (which readers drop), never a loss.
+            # OR REPLACE: a re-run refreshes copies left by an interrupted one.
+            conn.execute('BEGIN')
+            conn.execute(f'''
+                INSERT OR REPLACE INTO {schema}.transactions ({columns})
+                SELECT {values} FROM main.transactions t
+                LEFT JOIN main.transaction_payloads p ON p.id = t.id
+                WHERE t.id IN (SELECT value FROM json_each(?))
+            ''', (id_list,))
+            conn.commit()
+
+            # Only delete rows whose archived copy is still current
+            conn.execute('BEGIN IMMEDIATE')
+            deleted = conn.execute(f'''
+                DELETE FROM main.transactions
+                WHERE id IN (SELECT value FROM json_each(?)) AND EXISTS (
+                    SELECT 1 FROM {schema}.transactions a
+                    WHERE a.id = main.transactions.id AND a.status IS main.transactions.status
+                )
+            ''', (id_list,)).rowcount
+            conn.execute('''
+                DELETE FROM main.transaction_payloads
+                WHERE id IN (SELECT value FROM json_each(?))
+                  AND NOT EXISTS (SELECT 1 FROM main.transactions t WHERE t.id = transaction_payloads.id)
+            ''', (id_list,))
+            conn.commit()
+            if not deleted:
+                return moved
+            moved += deleted
+
+
+def archive_transactions(older_than_days=ARCHIVE_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE,
+                         dry_run=False):
+    """
+    Move closed transactions older than older_than_days into the monthly
+    archives. Returns {month: rows moved} (rows that would move, with
+    dry_run).
+    """
+    cutoff = archive_cutoff(older_than_days)
+    results = {}
+    with db.get_db_connection() as conn:
+        months = _months_to_archive(conn, cutoff)
+        if dry_run:
+            for month in months:
+                start, end = db.month_bounds(month)
+                results[month] = conn.execute(f'''
+                    SELECT COUNT(*) FROM transactions
+                    WHERE timestamp >= ? AND timestamp < ? AND {_CLOSED}
+                ''', (start, min(end, cutoff))).fetchone()[0]
+            return results
+
+        os.makedirs(db.ARCHIVE_DIR, exist_ok=True)
+        for month in months:
+            results[month] = _archive_month(conn, month, cutoff, batch_size)
+            log.info('Archived transactions', extra={'month': month, 'rows': results[month]})
+    return results
+
+
+def list_archives():
+    """Row count, date range and file size of each archive, newest first"""
+    archives = []
+    with db.get_db_connection() as conn:
+        for month in db.archive_months():
+            with db.attach_archive(conn, month) as schema:
+                row = conn.execute(f'''
+                    SELECT COUNT(*) AS count, MIN(timestamp) AS first, MAX(timestamp) AS last
+                    FROM {schema}.transactions
+                ''').fetchone()
+            archives.append({'month': month, 'rows': row['count'], 'first': row['first'],
+                             'last': row['last'], 'bytes': os.path.getsize(db.archive_path(month))})
+    return archives
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Move old closed transactions into monthly archives')
+    parser.add_argument('--days', type=int, default=ARCHIVE_AFTER_DAYS,
+                        help='Archive closed transactions older than this many days')
+    parser.add_argument('--batch-size', type=int, default=ARCHIVE_BATCH_SIZE,
+                        help='Rows moved per transaction')
+    parser.add_argument('--dry-run', action='store_true', help='Only count what would be archived')
+    parser.add_argument('--vacuum', action='store_true',
+                        help='Reclaim the freed space in the live database afterwards')
+    parser.add_argument('--list', action='store_true', help='List existing archives and exit')
+    args = parser.parse_args()
+
+    if args.list:
+        for archive in list_archives():
+            print(f"{archive['month']}  {archive['rows']:>9} rows  "
+                  f"{archive['first']} .. {archive['last']}  {archive['bytes'] / 1024:,.0f} KiB")
+        sys.exit(0)
+
+    results = archive_transactions(args.days, args.batch_size, dry_run=args.dry_run)
+    verb = 'would be archived' if args.dry_run else 'archived'
+    for month, rows in results.items():
+        print(f"{month}: {rows} transactions {verb}")
+    print(f"Total: {sum(results.values())} transactions {verb}")
+
+    if args.vacuum and not args.dry_run:
+        with db.get_db_connection() as conn:
+            conn.execute('VACUUM')
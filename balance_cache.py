@@ -0,0 +1,100 @@
+"""
+Bounded TTL cache for IntaSend wallet balances
+
+Keeps the last balance IntaSend reported for each wallet_id so repeated
+/balance lookups do not hit the provider. Entries expire after a TTL and the
+least recently used ones are evicted once the cache is full. Webhook
+handlers and /transfer responses refresh or drop entries as balances change.
+
+Every worker process has its own cache, so a change is recorded as a new
+per-wallet version in SQLite (balance_versions). Each entry remembers the
+version it was fetched at and is only served while that is still current,
+so a webhook handled by one worker invalidates the balance in all of them.
+"""
+import os
+import time
+import threading
+from collections import OrderedDict
+import database as db
+
+BALANCE_CACHE_TTL = float(os.getenv('BALANCE_CACHE_TTL', 30))            # seconds
+BALANCE_CACHE_MAX_ENTRIES = int(os.getenv('BALANCE_CACHE_MAX_ENTRIES', 10000))
+
+
+class BalanceCache:
+    """Thread-safe LRU cache of balance responses keyed by wallet_id"""
+
+    def __init__(self, ttl=BALANCE_CACHE_TTL, max_entries=BALANCE_CACHE_MAX_ENTRIES):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, wallet_id):
+        """Return (balance_info, age_in_seconds), or None if missing, expired or outdated"""
+        with self._lock:
+            entry = self._entries.get(wallet_id)
+            if entry is None:
+                return None
+            balance_info, version, stored_at = entry
+            age = time.monotonic() - stored_at
+            if age > self.ttl:
+                del self._entries[wallet_id]
+                return None
+
+        # Another process may have seen the balance change since
+        if db.get_balance_version(wallet_id) != version:
+            with self._lock:
+                if self._entries.get(wallet_id) is entry:
+                    del self._entries[wallet_id]
+            return None
+
+        with self._lock:
+            if wallet_id in self._entries:
+                self._entries.move_to_end(wallet_id)
+        return balance_info, age
+
+    def version(self, wallet_id):
+        """The balance version to pass to put(); read it before asking IntaSend"""
+        return db.get_balance_version(wallet_id)
+
+    def put(self, wallet_id, balance_info, version):
+        """Store a balance response fetched at the given balance version"""
+        if self.ttl <= 0 or not balance_info:
+            return
+        with self._lock:
+            self._entries[wallet_id] = (dict(balance_info), version, time.monotonic())
+            self._entries.move_to_end(wallet_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, wallet_id):
+        """Drop a wallet's cached balance, in every process"""
+        if not wallet_id:
+            return
+        db.bump_balance_version(wallet_id)
+        with self._lock:
+            self._entries.pop(wallet_id, None)
+
+    def update_from_wallet(self, wallet_id, wallet_data):
+        """
+        Refresh an entry from a wallet object embedded in a provider payload
+        (e.g. details.origin of a transfer). Other processes drop their entry;
+        this one keeps the new balance, or drops it too when the payload
+        carries no balance.
+        """
+        if not wallet_id:
+            return
+        version = db.bump_balance_version(wallet_id)
+        if wallet_data and 'current_balance' in wallet_data:
+            self.put(wallet_id, wallet_data, version)
+        else:
+            with self._lock:
+                self._entries.pop(wallet_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
@@ -0,0 +1,375 @@
+"""
+HTTP load benchmark for the API routes
+
+Starts the app in a separate process on a freshly seeded SQLite database,
+with UniversityWalletManager replaced by an in-memory stub so IntaSend is
+never called, then drives each route at increasing concurrency and
+reports throughput and latency percentiles as JSON. The data set is
+generated from a fixed seed, so results from different commits can be
+compared with --baseline.
+
+Usage:
+    python bench_api.py                                   # all routes, default sizes
+    python bench_api.py --routes balance,transfer --concurrency 1,8,32 -o bench.json
+    python bench_api.py --baseline bench.json             # flag regressions vs. an earlier run
+"""
+import os
+import sys
+import json
+import math
+import time
+import uuid
+import random
+import socket
+import argparse
+import platform
+import tempfile
+import threading
+import subprocess
+from datetime import datetime, timedelta
+import requests
+
+DEFAULT_WALLETS = 10000
+DEFAULT_TRANSACTIONS = 100000
+DEFAULT_CONCURRENCY = '1,4,16,64'
+SEED_BALANCE = 1000000.0
+
+
+class StubWalletManager:
+    """Answers like UniversityWalletManager without calling IntaSend"""
+
+    def __init__(self, latency=0.0):
+        from circuit_breaker import get_breaker
+        self.latency = latency
+        self.breaker = get_breaker('IntaSend')
+        self._balances = {}
+        self._lock = threading.Lock()
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _wallet(self, wallet_id):
+        return {'wallet_id': wallet_id, 'currency': 'KES',
+                'current_balance': self._balances.get(wallet_id, SEED_BALANCE),
+                'available_balance': self._balances.get(wallet_id, SEED_BALANCE)}
+
+    def create_wallet(self, label, currency='KES', can_disburse=True):
+        self._wait()
+        return {'wallet_id': uuid.uuid4().hex[:8].upper(), 'label': label,
+                'currency': currency, 'current_balance': 0}
+
+    def get_wallet_balance(self, wallet_id):
+        self._wait()
+        with self._lock:
+            return self._wallet(wallet_id)
+
+    def fund_wallet(self, wallet_id, amount, phone_number, email=None):
+        self._wait()
+        return {'invoice': {'invoice_id': uuid.uuid4().hex[:8].upper(), 'state': 'PENDING',
+                            'value': amount}}
+
+    def transfer_between_wallets(self, origin_wallet_id, destination_wallet_id, amount,
+                                 narrative='Canteen payment'):
+        self._wait()
+        with self._lock:
+            self._balances[origin_wallet_id] = self._balances.get(origin_wallet_id, SEED_BALANCE) - amount
+            self._balances[destination_wallet_id] = (self._balances.get(destination_wallet_id, SEED_BALANCE)
+                                                     + amount)
+            return {'tracking_id': str(uuid.uuid4()), 'status': 'Completed',
+                    'details': {'origin': self._wallet(origin_wallet_id),
+                                'destination': self._wallet(destination_wallet_id)}}
+
+
+def student_id(n):
+    return f'BENCH{n:07d}'
+
+def wallet_id(n):
+    return f'BW{n:07d}'
+
+
+def seed(wallets, transactions, seed_value=42, batch_size=5000):
+    """Fill an empty database with deterministic wallets and transactions"""
+    import database as db
+    import ledger
+
+    rng = random.Random(seed_value)
+    for start in range(0, wallets, batch_size):
+        db.add_wallets([{
+            'student_id': student_id(n),
+            'student_name': f'Bench Student {n}',
+            'wallet_id': wallet_id(n),
+            'phone': f'2547{n:08d}',
+            'email': f'{student_id(n).lower()}@university.ac.ke'
+        } for n in range(start, min(start + batch_size, wallets))])
+    ledger.reconcile_many({wallet_id(n): SEED_BALANCE for n in range(wallets)})
+
+    types = ['deposit', 'transfer', 'topup', 'disbursement', 'payment_complete']
+    statuses = ['completed'] * 8 + ['pending', 'failed']
+    start_time = datetime(2025, 1, 1)
+    for start in range(0, transactions, batch_size):
+        rows = []
+        for _ in range(start, min(start + batch_size, transactions)):
+            kind = rng.choice(types)
+            a, b = rng.randrange(wallets), rng.randrange(wallets)
+            timestamp = start_time + timedelta(seconds=rng.randrange(365 * 24 * 3600))
+            rows.append((kind,
+                         student_id(a) if kind != 'transfer' else None,
+                         student_id(a) if kind == 'transfer' else None,
+                         student_id(b) if kind in ('transfer', 'disbursement') else None,
+                         round(rng.uniform(1, 5000), 2), rng.choice(statuses),
+                         f'Bench {kind}', timestamp.strftime('%Y-%m-%d %H:%M:%S')))
+        with db.get_db_connection() as conn:
+            conn.executemany('''
+                INSERT INTO transactions
+                (type, student_id, from_student, to_student, amount, status, description, timestamp)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+
+
+def serve(args):
+    """Server process: seed the database, swap in the stub manager and serve"""
+    import logging
+    os.environ['DATABASE_FILE'] = args.db
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    fresh = not os.path.exists(args.db)
+    import app as wallet_app
+    if fresh:
+        seed(args.wallets, args.transactions, args.seed)
+    wallet_app.wallet_manager = StubWalletManager(latency=args.stub_latency_ms / 1000)
+
+    # Per-request access lines would dominate the measurements
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    wallet_app.app.run(host='127.0.0.1', port=args.port, threaded=True, debug=False,
+                       use_reloader=False)
+
+
+# Each scenario builds one request: (method, path, json body)
+def scenarios(wallets):
+    def any_student(rng):
+        return student_id(rng.randrange(wallets))
+
+    def transfer(rng):
+        a, b = rng.sample(range(wallets), 2)
+        return 'POST', '/transfer', {'from_student': student_id(a), 'to_student': student_id(b),
+                                     'amount': rng.randint(1, 20)}
+
+    def webhook(rng):
+        n = rng.randrange(wallets)
+        return 'POST', '/webhook/intasend', {'event': 'wallet.topup', 'wallet_id': wallet_id(n),
+                                             'amount': 10, 'status': 'completed',
+                                             'invoice_id': uuid.uuid4().hex}
+
+    return {
+        'health': lambda rng: ('GET', '/health', None),
+        'balance': lambda rng: ('GET', f'/balance/{any_student(rng)}', None),
+        'wallets': lambda rng: ('GET', '/wallets?limit=100', None),
+        'transactions': lambda rng: ('GET', '/transactions?limit=50', None),
+        'student_transactions': lambda rng: ('GET', f'/transactions/{any_student(rng)}', None),
+        'stats': lambda rng: ('GET', '/stats', None),
+        'deposit': lambda rng: ('POST', '/deposit', {'student_id': any_student(rng), 'amount': 10,
+                                                     'phone': '254700000000'}),
+        'transfer': transfer,
+        'webhook': webhook,
+    }
+
+
+def percentile(sorted_values, fraction):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    index = max(0, math.ceil(fraction * len(sorted_values)) - 1)
+    return sorted_values[index]
+
+
+def run_level(base_url, make_request, concurrency, duration, seed_value):
+    """Drive one route with `concurrency` client threads for `duration` seconds"""
+    latencies = [[] for _ in range(concurrency)]
+    errors = [0] * concurrency
+    start_barrier = threading.Barrier(concurrency + 1)
+    deadline = [0.0]
+
+    def client(i):
+        rng = random.Random(seed_value * 1000 + i)
+        session = requests.Session()
+        start_barrier.wait()
+        while time.perf_counter() < deadline[0]:
+            method, path, body = make_request(rng)
+            started = time.perf_counter()
+            try:
+                response = session.request(method, base_url + path, json=body, timeout=30)
+                ok = response.status_code < 400
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - started
+            if ok:
+                latencies[i].append(elapsed)
+            else:
+                errors[i] += 1
+
+    threads = [threading.Thread(target=client, args=(i,), daemon=True) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    started = time.perf_counter()
+    deadline[0] = started + duration
+    start_barrier.wait()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    values = sorted(v for thread_values in latencies for v in thread_values)
+    ms = lambda v: round(v * 1000, 3) if v is not None else None
+    return {
+        'concurrency': concurrency,
+        'requests': len(values) + sum(errors),
+        'errors': sum(errors),
+        'throughput_rps': round(len(values) / elapsed, 1),
+        'p50_ms': ms(percentile(values, 0.50)),
+        'p95_ms': ms(percentile(values, 0.95)),
+        'p99_ms': ms(percentile(values, 0.99)),
+        'max_ms': ms(values[-1] if values else None)
+    }
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def wait_until_ready(base_url, process, timeout=600):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError('Benchmark server exited during startup')
+        try:
+            requests.get(base_url + '/health', timeout=1)
+            return
+        except requests.RequestException:
+            time.sleep(0.25)
+    raise RuntimeError('Benchmark server did not start')
+
+
+def metadata(args):
+    import sqlite3
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'commit': commit or None,
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'wallets': args.wallets,
+        'transactions': args.transactions,
+        'duration_per_level': args.duration,
+        'stub_latency_ms': args.stub_latency_ms,
+        'seed': args.seed
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Print changes against a baseline run; returns the regressions found"""
+    regressions = []
+    for route, levels in results['results'].items():
+        old_levels = {level['concurrency']: level for level in baseline.get('results', {}).get(route, [])}
+        for level in levels:
+            old = old_levels.get(level['concurrency'])
+            if not old or not old.get('p95_ms') or not level.get('p95_ms'):
+                continue
+            p95_change = level['p95_ms'] / old['p95_ms'] - 1
+            rps_change = level['throughput_rps'] / old['throughput_rps'] - 1 if old['throughput_rps'] else 0
+            flag = ''
+            if p95_change > tolerance or rps_change < -tolerance:
+                flag = '  <-- regression'
+                regressions.append((route, level['concurrency']))
+            print(f"{route:22} c={level['concurrency']:<4} p95 {old['p95_ms']:>9.2f} -> "
+                  f"{level['p95_ms']:>9.2f} ms ({p95_change:+.0%})  rps {old['throughput_rps']:>8.1f} -> "
+                  f"{level['throughput_rps']:>8.1f} ({rps_change:+.0%}){flag}", file=sys.stderr)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the API routes under load')
+    parser.add_argument('--wallets', type=int, default=DEFAULT_WALLETS)
+    parser.add_argument('--transactions', type=int, default=DEFAULT_TRANSACTIONS)
+    parser.add_argument('--routes', help='Comma-separated routes (default: all)')
+    parser.add_argument('--concurrency', default=DEFAULT_CONCURRENCY,
+                        help='Comma-separated client counts, run in order')
+    parser.add_argument('--duration', type=float, default=5.0, help='Seconds per concurrency level')
+    parser.add_argument('--stub-latency-ms', type=float, default=0.0,
+                        help='Simulated IntaSend latency of the stub manager')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--db', help='Database file, seeded if it does not exist '
+                                     '(default: a new temporary file)')
+    parser.add_argument('-o', '--output', help='Write results to this file (default: stdout)')
+    parser.add_argument('--baseline', help='Earlier results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed p95/throughput change before flagging a regression')
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        serve(args)
+        return
+
+    all_scenarios = scenarios(args.wallets)
+    routes = args.routes.split(',') if args.routes else list(all_scenarios)
+    unknown = [route for route in routes if route not in all_scenarios]
+    if unknown:
+        parser.error(f"unknown route(s): {', '.join(unknown)}; choose from {', '.join(all_scenarios)}")
+    levels = [int(c) for c in args.concurrency.split(',')]
+
+    tmpdir = None
+    if not args.db:
+        tmpdir = tempfile.TemporaryDirectory(prefix='wallet-bench-')
+        args.db = os.path.join(tmpdir.name, 'bench.db')
+    port = free_port()
+    base_url = f'http://127.0.0.1:{port}'
+
+    env = dict(os.environ, INTASEND_BASE_URL=os.getenv('INTASEND_BASE_URL', 'http://127.0.0.1:9/api/v1'))
+    server = subprocess.Popen([sys.executable, os.path.abspath(__file__), '--serve',
+                               '--port', str(port), '--db', args.db,
+                               '--wallets', str(args.wallets), '--transactions', str(args.transactions),
+                               '--seed', str(args.seed), '--stub-latency-ms', str(args.stub_latency_ms)],
+                              env=env, stdout=subprocess.DEVNULL)
+    try:
+        print(f"Seeding {args.wallets} wallets and {args.transactions} transactions...", file=sys.stderr)
+        wait_until_ready(base_url, server)
+
+        results = {'meta': metadata(args), 'results': {}}
+        for route in routes:
+            results['results'][route] = []
+            for concurrency in levels:
+                level = run_level(base_url, all_scenarios[route], concurrency, args.duration, args.seed)
+                results['results'][route].append(level)
+                print(f"{route:22} c={concurrency:<4} {level['throughput_rps']:>8.1f} req/s  "
+                      f"p50 {level['p50_ms']} ms  p95 {level['p95_ms']} ms  p99 {level['p99_ms']} ms  "
+                      f"errors {level['errors']}", file=sys.stderr)
+    finally:
+        server.terminate()
+        server.wait()
+        if tmpdir:
+            tmpdir.cleanup()
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Startup-time benchmark
+
+Times how long a fresh Python process takes to import each entry point
+(CLI tools, the app, a first request), running every case several times
+in new interpreters. Cases run against a database whose schema is already
+current, except 'database (new file)', which creates one each time.
+
+Usage:
+    python bench_startup.py                       # all cases, table on stderr, JSON on stdout
+    python bench_startup.py --runs 30 -o startup.json
+    python bench_startup.py --baseline startup.json
+
+`python -X importtime -c "import app"` shows which imports a slow case spends
+its time on.
+"""
+import os
+import sys
+import json
+import math
+import time
+import argparse
+import platform
+import tempfile
+import subprocess
+from datetime import datetime
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# name -> code run by the child interpreter
+CASES = {
+    'python': 'pass',
+    'database': 'import database',
+    'database + query': 'import database; database.get_wallets_page(limit=1)',
+    'database (new file)': 'import database; database.get_wallets_page(limit=1)',
+    'view_database': 'import view_database',
+    'export': 'import export',
+    'wallet_manager': 'import wallet_manager; wallet_manager.UniversityWalletManager()',
+    'app': 'import app',
+    'app + first request': "import app; app.app.test_client().get('/health')",
+    'wsgi': 'import wsgi',
+}
+
+
+def run_once(code, env):
+    started = time.perf_counter()
+    subprocess.run([sys.executable, '-c', code], cwd=HERE, env=env, check=True,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return (time.perf_counter() - started) * 1000
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def run_case(name, code, runs, workdir):
+    env = dict(os.environ, DATABASE_FILE=os.path.join(workdir, 'startup.db'),
+               INTASEND_BASE_URL='http://127.0.0.1:9/api/v1')
+    timings = []
+    for i in range(runs):
+        if name == 'database (new file)':
+            env['DATABASE_FILE'] = os.path.join(workdir, f'new-{i}.db')
+        timings.append(run_once(code, env))
+    return {
+        'runs': runs,
+        'min_ms': round(min(timings), 1),
+        'p50_ms': round(percentile(timings, 50), 1),
+        'p90_ms': round(percentile(timings, 90), 1),
+    }
+
+
+def metadata(args):
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                                text=True, cwd=HERE).stdout.strip()
+    except OSError:
+        commit = None
+    return {
+        'commit': commit or None,
+        'started_at': datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'runs': args.runs
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Print changes against a baseline run; returns the regressed cases"""
+    regressions = []
+    for name, result in results['results'].items():
+        old = baseline.get('results', {}).get(name)
+        if not old:
+            continue
+        change = result['p50_ms'] / old['p50_ms'] - 1
+        flag = ''
+        if change > tolerance:
+            flag = '  <-- regression'
+            regressions.append(name)
+        print(f"{name:22} p50 {old['p50_ms']:>8.1f} -> {result['p50_ms']:>8.1f} ms ({change:+.0%}){flag}",
+              file=sys.stderr)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark process startup time')
+    parser.add_argument('--cases', help=f"Comma-separated cases (default: all of {', '.join(CASES)})")
+    parser.add_argument('--runs', type=int, default=15, help='Processes started per case')
+    parser.add_argument('-o', '--output', help='Write results to this file (default: stdout)')
+    parser.add_argument('--baseline', help='Earlier results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Allowed p50 increase before flagging a regression')
+    args = parser.parse_args()
+
+    names = args.cases.split(',') if args.cases else list(CASES)
+    unknown = [name for name in names if name not in CASES]
+    if unknown:
+        parser.error(f"unknown case(s): {', '.join(unknown)}")
+
+    results = {'meta': metadata(args), 'results': {}}
+    with tempfile.TemporaryDirectory(prefix='wallet-startup-') as workdir:
+        # Create the shared database once so the other cases see a current schema
+        run_once(CASES['database + query'], dict(os.environ, DATABASE_FILE=os.path.join(workdir, 'startup.db')))
+        for name in names:
+            result = run_case(name, CASES[name], args.runs, workdir)
+            results['results'][name] = result
+            print(f"{name:22} p50 {result['p50_ms']:>8.1f} ms  p90 {result['p90_ms']:>8.1f} ms  "
+                  f"min {result['min_ms']:>8.1f} ms", file=sys.stderr)
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
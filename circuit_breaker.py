@@ -0,0 +1,154 @@
+"""
+Circuit breaker for calls to IntaSend
+
+Tracks the outcome and duration of recent calls. When too many of them
+fail or are slow, the breaker opens and calls fail immediately with
+CircuitOpen instead of tying up a worker. After a cool-down it lets a few
+probe calls through (half-open): if they succeed it closes again,
+otherwise it re-opens.
+"""
+import os
+import time
+import threading
+from collections import deque
+import logs
+
+BREAKER_WINDOW = int(os.getenv('BREAKER_WINDOW', 20))                       # calls
+BREAKER_MIN_CALLS = int(os.getenv('BREAKER_MIN_CALLS', 10))
+BREAKER_FAILURE_RATE = float(os.getenv('BREAKER_FAILURE_RATE', 0.5))
+BREAKER_SLOW_CALL_SECONDS = float(os.getenv('BREAKER_SLOW_CALL_SECONDS', 5))
+BREAKER_SLOW_CALL_RATE = float(os.getenv('BREAKER_SLOW_CALL_RATE', 0.8))
+BREAKER_OPEN_SECONDS = float(os.getenv('BREAKER_OPEN_SECONDS', 30))
+BREAKER_HALF_OPEN_CALLS = int(os.getenv('BREAKER_HALF_OPEN_CALLS', 3))
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+log = logs.get_logger('circuit_breaker')
+
+
+def not_failures():
+    """IntaSend rejecting a request is an answer, not an outage"""
+    # Imported here so the breaker can be used without loading the SDK
+    from intasend.exceptions import IntaSendBadRequest, IntaSendNotAllowed
+    return (IntaSendBadRequest, IntaSendNotAllowed)
+
+
+class CircuitOpen(Exception):
+    """Raised instead of calling IntaSend while the breaker is open"""
+
+    def __init__(self, name, retry_after):
+        self.retry_after = retry_after
+        super().__init__(f'{name} is unavailable; retry in {retry_after:.0f}s')
+
+
+class CircuitBreaker:
+    """Count-based sliding window breaker with a half-open probe state"""
+
+    def __init__(self, name, window=BREAKER_WINDOW, min_calls=BREAKER_MIN_CALLS,
+                 failure_rate=BREAKER_FAILURE_RATE, slow_call_seconds=BREAKER_SLOW_CALL_SECONDS,
+                 slow_call_rate=BREAKER_SLOW_CALL_RATE, open_seconds=BREAKER_OPEN_SECONDS,
+                 half_open_calls=BREAKER_HALF_OPEN_CALLS):
+        self.name = name
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.half_open_calls = half_open_calls
+
+        self._lock = threading.Lock()
+        self._outcomes = deque(maxlen=window)     # (failed, slow) per call
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probes = 0
+        self._probe_successes = 0
+        self._last_error = None
+
+    def _before_call(self):
+        with self._lock:
+            if self._state == OPEN:
+                remaining = self._opened_at + self.open_seconds - time.monotonic()
+                if remaining > 0:
+                    raise CircuitOpen(self.name, remaining)
+                self._state = HALF_OPEN
+                self._probes = self._probe_successes = 0
+            if self._state == HALF_OPEN:
+                if self._probes >= self.half_open_calls:
+                    raise CircuitOpen(self.name, 1)
+                self._probes += 1
+
+    def _after_call(self, failed, duration):
+        slow = duration >= self.slow_call_seconds
+        with self._lock:
+            if self._state == HALF_OPEN:
+                if failed or slow:
+                    self._open()
+                else:
+                    self._probe_successes += 1
+                    if self._probe_successes >= self.half_open_calls:
+                        self._state = CLOSED
+                        self._outcomes.clear()
+                        log.info('Circuit closed', extra={'circuit': self.name})
+                return
+            if self._state != CLOSED:
+                return
+
+            self._outcomes.append((failed, slow))
+            calls = len(self._outcomes)
+            if calls < self.min_calls:
+                return
+            failures = sum(1 for f, _ in self._outcomes if f)
+            slow_calls = sum(1 for _, s in self._outcomes if s)
+            if failures / calls >= self.failure_rate or slow_calls / calls >= self.slow_call_rate:
+                self._open()
+
+    def _open(self):
+        self._state = OPEN
+        self._opened_at = time.monotonic()
+        self._outcomes.clear()
+        log.error('Circuit opened', extra={'circuit': self.name, 'open_seconds': self.open_seconds,
+                                           'last_error': self._last_error})
+
+    def call(self, func, *args, **kwargs):
+        """Run func through the breaker"""
+        self._before_call()
+        started = time.monotonic()
+        try:
+            result = func(*args, **kwargs)
+        except Exception as e:
+            failed = not isinstance(e, not_failures())
+            if failed:
+                self._last_error = str(e)
+            self._after_call(failed, time.monotonic() - started)
+            raise
+        self._after_call(False, time.monotonic() - started)
+        return result
+
+    def status(self):
+        """Breaker state for health checks"""
+        with self._lock:
+            calls = len(self._outcomes)
+            info = {
+                'state': self._state,
+                'recent_calls': calls,
+                'failure_rate': round(sum(1 for f, _ in self._outcomes if f) / calls, 3) if calls else 0.0,
+                'slow_call_rate': round(sum(1 for _, s in self._outcomes if s) / calls, 3) if calls else 0.0,
+                'last_error': self._last_error
+            }
+            if self._state == OPEN:
+                info['retry_after'] = round(max(0.0, self._opened_at + self.open_seconds
+                                                - time.monotonic()), 1)
+        return info
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+def get_breaker(name):
+    """Process-wide breaker for a named dependency"""
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+        return _breakers[name]
@@ -1,28 +1,260 @@
-
+import os
+import re
+import sys
+import base64
 import sqlite3
+import threading
 from datetime import datetime
-from contextlib import contextmanager
+from contextlib import contextmanager, closing
+from queue import LifoQueue, Empty, Full
 import json
+import metrics
+
+DATABASE_FILE = os.getenv('DATABASE_FILE', 'wallet_system.db')
+
+# Closed transactions moved out of the live table by archive.py, one file per month
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR') or os.path.join(os.path.dirname(DATABASE_FILE), 'archive')
+
+# Bump whenever init_database() changes; stored in PRAGMA user_version
+SCHEMA_VERSION = 5
+
+# SQLite tuning, overridable from the environment
+SQLITE_JOURNAL_MODE = os.getenv('SQLITE_JOURNAL_MODE', 'WAL')
+SQLITE_SYNCHRONOUS = os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL')
+SQLITE_CACHE_SIZE = int(os.getenv('SQLITE_CACHE_SIZE', -16000))        # negative = KiB
+SQLITE_MMAP_SIZE = int(os.getenv('SQLITE_MMAP_SIZE', 64 * 1024 * 1024))
+SQLITE_BUSY_TIMEOUT = int(os.getenv('SQLITE_BUSY_TIMEOUT', 5000))      # milliseconds
+SQLITE_STATEMENT_CACHE = int(os.getenv('SQLITE_STATEMENT_CACHE', 128))
+SQLITE_POOL_SIZE = int(os.getenv('SQLITE_POOL_SIZE', 8))
+
+
+def _connect():
+    """Open a new connection with the configured pragmas applied"""
+    conn = sqlite3.connect(
+        DATABASE_FILE,
+        timeout=SQLITE_BUSY_TIMEOUT / 1000,
+        cached_statements=SQLITE_STATEMENT_CACHE,
+        check_same_thread=False
+    )
+    conn.row_factory = sqlite3.Row  # Enable column access by name
+    conn.execute(f'PRAGMA journal_mode={SQLITE_JOURNAL_MODE}')
+    conn.execute(f'PRAGMA synchronous={SQLITE_SYNCHRONOUS}')
+    conn.execute(f'PRAGMA cache_size={SQLITE_CACHE_SIZE}')
+    conn.execute(f'PRAGMA mmap_size={SQLITE_MMAP_SIZE}')
+    conn.execute(f'PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT}')
+    return conn
+
+
+class ConnectionPool:
+    """
+    Keeps a bounded set of idle connections for reuse.
+
+    A thread checks a connection out for the outermost get_db_connection()
+    block and hands it back afterwards, so nested helpers share one
+    connection and one transaction. The pool is discarded after a fork.
+    """
+
+    def __init__(self, size=SQLITE_POOL_SIZE):
+        self.size = size
+        self._idle = LifoQueue(maxsize=size)
+        self._local = threading.local()
+        self._pid = os.getpid()
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            # Connections must never be shared across processes
+            self._idle = LifoQueue(maxsize=self.size)
+            self._local = threading.local()
+            self._pid = os.getpid()
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except Empty:
+            return _connect()
+
+    def release(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        try:
+            self._idle.put_nowait(conn)
+        except Full:
+            conn.close()
+
+    @contextmanager
+    def connection(self, immediate=False):
+        self._check_pid()
+        local = self._local
+        if getattr(local, 'conn', None) is not None:
+            # Nested use joins the outer block's transaction
+            if immediate and not local.conn.in_transaction:
+                local.conn.execute('BEGIN IMMEDIATE')
+            yield local.conn
+            return
+
+        conn = self.acquire()
+        local.conn = conn
+        try:
+            if immediate:
+                conn.execute('BEGIN IMMEDIATE')
+            yield conn
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            local.conn = None
+            self.release(conn)
+
+    def close_all(self):
+        """Close every idle connection (e.g. on shutdown)"""
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Empty:
+                break
+
+
+_pool = ConnectionPool()
+
+
+_schema_ready = False
+_schema_lock = threading.Lock()
+
+def ensure_schema():
+    """Bring the schema up to date, once per process, before first use"""
+    global _schema_ready
+    if _schema_ready:
+        return
+    with _schema_lock:
+        if not _schema_ready:
+            init_database()
+            _schema_ready = True
 
-DATABASE_FILE = 'wallet_system.db'
 
-@contextmanager
 def get_db_connection():
     """Context manager for database connections"""
-    conn = sqlite3.connect(DATABASE_FILE)
-    conn.row_factory = sqlite3.Row  # Enable column access by name
+    ensure_schema()
+    return _pool.connection()
+
+def close_connections():
+    """Close this process's idle connections, e.g. before forking workers"""
+    _pool.close_all()
+
+def transaction():
+    """
+    Context manager for a write transaction that takes the database write
+    lock up front (BEGIN IMMEDIATE), so read-check-write sequences inside
+    it cannot interleave with other writers.
+    """
+    ensure_schema()
+    return _pool.connection(immediate=True)
+
+def data_version():
+    """
+    Counter bumped by triggers on every change to wallets, transactions and
+    their payloads. It lives in the database, so every worker process sees
+    the same value; reading it is a single-row lookup.
+    """
+    with get_db_connection() as conn:
+        return conn.execute('SELECT version FROM data_changes WHERE id = 1').fetchone()[0]
+
+
+_ARCHIVE_FILE = re.compile(r'^transactions-(\d{4}-\d{2})\.db$')
+_archive_listing = (None, [])
+
+def archive_path(month):
+    """Archive file for a 'YYYY-MM' month"""
+    return os.path.join(ARCHIVE_DIR, f'transactions-{month}.db')
+
+def month_bounds(month):
+    """First timestamp of a 'YYYY-MM' month and of the month after it"""
+    year, number = int(month[:4]), int(month[5:7])
+    following = (year + 1, 1) if number == 12 else (year, number + 1)
+    return f'{year:04d}-{number:02d}-01 00:00:00', f'{following[0]:04d}-{following[1]:02d}-01 00:00:00'
+
+def archive_months(since=None, until=None):
+    """
+    Months that have an archive file, newest first, optionally only those
+    overlapping [since, until) (normalized timestamps).
+    """
+    global _archive_listing
     try:
-        yield conn
-        conn.commit()
-    except Exception as e:
-        conn.rollback()
-        raise e
+        signature = os.stat(ARCHIVE_DIR).st_mtime_ns
+    except OSError:
+        return []
+    if _archive_listing[0] != signature:
+        months = [m.group(1) for m in map(_ARCHIVE_FILE.match, os.listdir(ARCHIVE_DIR)) if m]
+        _archive_listing = (signature, sorted(months, reverse=True))
+
+    months = _archive_listing[1]
+    if since or until:
+        months = [month for month in months
+                  if (not until or month_bounds(month)[0] < until)
+                  and (not since or month_bounds(month)[1] > since)]
+    return months
+
+@contextmanager
+def attach_archive(conn, month):
+    """
+    ATTACH a month's archive to a connection for the duration of the block
+    and yield its schema name. Must not be used inside a transaction.
+    """
+    schema = 'archive_' + month.replace('-', '_')
+    conn.execute(f'ATTACH DATABASE ? AS {schema}', (archive_path(month),))
+    try:
+        yield schema
     finally:
-        conn.close()
+        if conn.in_transaction:
+            # Only after an error; DETACH is not allowed mid-transaction
+            conn.rollback()
+        conn.execute(f'DETACH DATABASE {schema}')
+
+def _with_archives(conn, query, params, limit, since=None, until=None, before=None):
+    """
+    Run a newest-first transactions query, written with {table} in place of
+    the table name and returning up to limit + 1 rows, against the live
+    table and then each archive month that could still contribute to the
+    page. Months are disjoint, so this stops at the first month older than
+    a full page; recent pages never open an archive.
+    """
+    rows = conn.execute(query.format(table='transactions'), params).fetchall()
+    for month in archive_months(since, until):
+        start, end = month_bounds(month)
+        if before and before < start:
+            continue
+        if len(rows) > limit and rows[limit]['timestamp'] >= end:
+            break
+        with attach_archive(conn, month) as schema:
+            rows += conn.execute(query.format(table=f'{schema}.transactions'), params).fetchall()
+        # A row interrupted mid-move can be in both; keep the live copy
+        unique = {}
+        for row in rows:
+            unique.setdefault(row['id'], row)
+        rows = sorted(unique.values(),
+                      key=lambda row: (row['timestamp'], row['id']), reverse=True)[:limit + 1]
+    return rows
+
+
+def schema_version():
+    with _pool.connection() as conn:
+        return conn.execute('PRAGMA user_version').fetchone()[0]
+
 
 def init_database():
-    """Initialize the database with required tables"""
-    with get_db_connection() as conn:
+    """
+    Create or upgrade the tables, triggers and indexes. Does nothing when
+    the database is already at SCHEMA_VERSION, so it costs one PRAGMA read
+    on an existing database. Returns True if the schema was changed.
+    """
+    if schema_version() >= SCHEMA_VERSION:
+        return False
+
+    # One process migrates; any other waits for the write lock, then finds
+    # the schema current
+    with _pool.connection(immediate=True) as conn:
+        if conn.execute('PRAGMA user_version').fetchone()[0] >= SCHEMA_VERSION:
+            return False
         cursor = conn.cursor()
 
         # Table to store student-wallet mappings
@@ -56,16 +288,530 @@ def init_database():
                 metadata TEXT
             )
         ''')
+        # Raw provider payloads for transactions (webhook bodies, transfer
+        # responses), read only when asked for. transactions.metadata is no
+        # longer written for live rows; archive.py uses it in archive files.
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS transaction_payloads (
+                id INTEGER PRIMARY KEY,
+                payload TEXT NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # Double-entry ledger: one row per transfer, two postings per transfer
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS ledger_transfers (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                reference TEXT UNIQUE NOT NULL,
+                kind TEXT NOT NULL,
+                from_account TEXT NOT NULL,
+                to_account TEXT NOT NULL,
+                amount_cents INTEGER NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                provider_ref TEXT,
+                narrative TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS ledger_postings (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                transfer_ref TEXT NOT NULL,
+                account TEXT NOT NULL,
+                amount_cents INTEGER NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # Running balance per account; pending_cents is the part still
+        # waiting for IntaSend to confirm
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS ledger_balances (
+                account TEXT PRIMARY KEY,
+                balance_cents INTEGER NOT NULL DEFAULT 0,
+                pending_cents INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+
+        # Raw webhook events, acknowledged immediately and processed in the background
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS webhook_inbox (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                event_type TEXT,
+                dedup_key TEXT,
+                partition_key TEXT,
+                payload TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL DEFAULT 0,
+                locked_until REAL NOT NULL DEFAULT 0,
+                last_error TEXT,
+                received_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                processed_at TIMESTAMP
+            )
+        ''')
+
+        # Webhook events that kept failing after all retries
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS webhook_dead_letter (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                inbox_id INTEGER,
+                event_type TEXT,
+                dedup_key TEXT,
+                payload TEXT NOT NULL,
+                attempts INTEGER NOT NULL,
+                last_error TEXT,
+                received_at TIMESTAMP,
+                failed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+
+        # Bulk wallet provisioning jobs and their per-student rows
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS provisioning_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                status TEXT NOT NULL DEFAULT 'pending',
+                source TEXT,
+                total INTEGER NOT NULL DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                finished_at TIMESTAMP
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS provisioning_rows (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_id INTEGER NOT NULL,
+                row_no INTEGER NOT NULL,
+                student_id TEXT,
+                student_name TEXT,
+                phone TEXT,
+                email TEXT,
+                status TEXT NOT NULL DEFAULT 'pending',
+                wallet_id TEXT,
+                error TEXT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE (job_id, row_no)
+            )
+        ''')
+
+        # Batch disbursements from a treasury wallet, one item per recipient
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS disbursement_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                source_wallet_id TEXT NOT NULL,
+                narrative TEXT,
+                status TEXT NOT NULL DEFAULT 'pending',
+                source TEXT,
+                total INTEGER NOT NULL DEFAULT 0,
+                total_cents INTEGER NOT NULL DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                started_at TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                finished_at TIMESTAMP
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS disbursement_items (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                job_id INTEGER NOT NULL,
+                line_no INTEGER NOT NULL,
+                student_id TEXT,
+                amount_cents INTEGER,
+                status TEXT NOT NULL DEFAULT 'pending',
+                reference TEXT,
+                tracking_id TEXT,
+                error TEXT,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE (job_id, line_no)
+            )
+        ''')
+
+        # Precomputed statistics, kept current by the triggers below.
+        # Amounts are stored in integer cents so running sums do not drift.
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stats_totals (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stats_transaction_counts (
+                dimension TEXT NOT NULL,
+                key TEXT NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                amount_cents INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (dimension, key)
+            )
+        ''')
+
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS stats_daily (
+                day TEXT NOT NULL,
+                type TEXT NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                volume_cents INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (day, type)
+            )
+        ''')
+
+        stats_is_new = cursor.execute('SELECT COUNT(*) FROM stats_totals').fetchone()[0] == 0
+        _create_stats_triggers(cursor)
+        if stats_is_new:
+            _rebuild_stats(cursor)
+
+        # Stored responses for POSTs retried with the same Idempotency-Key
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS idempotency_keys (
+                endpoint TEXT NOT NULL,
+                idempotency_key TEXT NOT NULL,
+                fingerprint TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'in_progress',
+                response_status INTEGER,
+                response_body BLOB,
+                content_type TEXT,
+                locked_until REAL NOT NULL DEFAULT 0,
+                expires_at REAL NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (endpoint, idempotency_key)
+            )
+        ''')
+
+        # Change feed for the live /events stream, filled by triggers
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS event_log (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                type TEXT NOT NULL,
+                payload TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        _create_event_triggers(cursor)
+
+        # Shared data version for ETags, bumped by triggers
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS data_changes (
+                id INTEGER PRIMARY KEY CHECK (id = 1),
+                version INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        cursor.execute('INSERT OR IGNORE INTO data_changes (id, version) VALUES (1, 0)')
+        _create_change_triggers(cursor)
+
+        # Per-wallet version of the IntaSend balance, bumped whenever a
+        # process learns it changed, so every worker's balance cache sees it
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS balance_versions (
+                wallet_id TEXT PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
 
         # Create indexes for faster queries
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_student_id ON wallets(student_id)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_wallet_id ON wallets(wallet_id)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_transaction_type ON transactions(type)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_transaction_timestamp ON transactions(timestamp)')
+        # Composite indexes back keyset pagination on (timestamp, id) / (created_at, id)
+        cursor.execute('DROP INDEX IF EXISTS idx_transaction_timestamp')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_transaction_timestamp_id ON transactions(timestamp, id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_wallet_created_id ON wallets(created_at, id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_wallet_balance ON wallets(balance)')
+        # One index per participant column so student history is a UNION of index ranges
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_transaction_student ON transactions(student_id, timestamp, id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_transaction_from ON transactions(from_student, timestamp, id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_transaction_to ON transactions(to_student, timestamp, id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_ledger_provider_ref ON ledger_transfers(provider_ref)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_ledger_pending ON ledger_transfers(status, from_account, to_account)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_ledger_postings_account ON ledger_postings(account)')
+        cursor.execute('''
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_webhook_inbox_dedup
+            ON webhook_inbox(event_type, dedup_key) WHERE dedup_key IS NOT NULL
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_webhook_inbox_status ON webhook_inbox(status, id)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_provisioning_rows_status ON provisioning_rows(job_id, status, row_no)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_disbursement_items_status ON disbursement_items(job_id, status, line_no)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_disbursement_items_reference ON disbursement_items(reference)')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_idempotency_expires ON idempotency_keys(expires_at)')
 
+        # Open ledger accounts for wallets that predate the ledger, carrying
+        # over the mirrored balance as a confirmed opening transfer
+        cursor.execute("INSERT OR IGNORE INTO ledger_balances (account) VALUES ('external:intasend')")
+        cursor.execute('''
+            UPDATE ledger_balances
+            SET balance_cents = balance_cents - (
+                SELECT COALESCE(SUM(CAST(ROUND(balance * 100) AS INTEGER)), 0) FROM wallets
+                WHERE wallet_id NOT IN (SELECT account FROM ledger_balances)
+            )
+            WHERE account = 'external:intasend'
+        ''')
+        cursor.execute('''
+            INSERT INTO ledger_transfers
+            (reference, kind, from_account, to_account, amount_cents, status, narrative)
+            SELECT 'opening:' || wallet_id, 'opening', 'external:intasend', wallet_id,
+                   CAST(ROUND(balance * 100) AS INTEGER), 'confirmed', 'Opening balance'
+            FROM wallets
+            WHERE wallet_id NOT IN (SELECT account FROM ledger_balances)
+              AND balance != 0
+        ''')
+        cursor.execute('''
+            INSERT INTO ledger_postings (transfer_ref, account, amount_cents)
+            SELECT reference, from_account, -amount_cents FROM ledger_transfers
+            WHERE kind = 'opening' AND reference NOT IN (SELECT transfer_ref FROM ledger_postings)
+            UNION ALL
+            SELECT reference, to_account, amount_cents FROM ledger_transfers
+            WHERE kind = 'opening' AND reference NOT IN (SELECT transfer_ref FROM ledger_postings)
+        ''')
+        cursor.execute('''
+            INSERT INTO ledger_balances (account, balance_cents)
+            SELECT wallet_id, CAST(ROUND(balance * 100) AS INTEGER) FROM wallets
+            WHERE wallet_id NOT IN (SELECT account FROM ledger_balances)
+        ''')
+
+        # Move payloads stored inline by earlier versions into the side table
+        cursor.execute('''
+            INSERT OR IGNORE INTO transaction_payloads (id, payload)
+            SELECT id, metadata FROM transactions WHERE metadata IS NOT NULL
+        ''')
+        cursor.execute('UPDATE transactions SET metadata = NULL WHERE metadata IS NOT NULL')
+
+        cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
         conn.commit()
-        print("Database initialized successfully")
+        # stderr, so CLI tools that write data to stdout stay clean
+        print("Database initialized successfully", file=sys.stderr)
+        return True
+
+def _create_stats_triggers(cursor):
+    """Keep the stats_* tables current on every write to wallets and transactions"""
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS stats_wallet_insert AFTER INSERT ON wallets
+        BEGIN
+            INSERT INTO stats_totals (name, value) VALUES ('wallet_count', 1)
+                ON CONFLICT(name) DO UPDATE SET value = value + 1;
+            INSERT INTO stats_totals (name, value)
+                VALUES ('total_balance_cents', CAST(ROUND(NEW.balance * 100) AS INTEGER))
+                ON CONFLICT(name) DO UPDATE SET value = value + excluded.value;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS stats_wallet_balance AFTER UPDATE OF balance ON wallets
+        WHEN NEW.balance IS NOT OLD.balance
+        BEGIN
+            UPDATE stats_totals
+            SET value = value + CAST(ROUND(NEW.balance * 100) AS INTEGER)
+                              - CAST(ROUND(OLD.balance * 100) AS INTEGER)
+            WHERE name = 'total_balance_cents';
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS stats_wallet_delete AFTER DELETE ON wallets
+        BEGIN
+            UPDATE stats_totals SET value = value - 1 WHERE name = 'wallet_count';
+            UPDATE stats_totals SET value = value - CAST(ROUND(OLD.balance * 100) AS INTEGER)
+            WHERE name = 'total_balance_cents';
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS stats_transaction_insert AFTER INSERT ON transactions
+        BEGIN
+            INSERT INTO stats_totals (name, value) VALUES ('transaction_count', 1)
+                ON CONFLICT(name) DO UPDATE SET value = value + 1;
+            INSERT INTO stats_transaction_counts (dimension, key, count, amount_cents)
+                VALUES ('type', NEW.type, 1, CAST(ROUND(NEW.amount * 100) AS INTEGER))
+                ON CONFLICT(dimension, key) DO UPDATE SET
+                    count = count + 1, amount_cents = amount_cents + excluded.amount_cents;
+            INSERT INTO stats_transaction_counts (dimension, key, count, amount_cents)
+                VALUES ('status', COALESCE(NEW.status, ''), 1, CAST(ROUND(NEW.amount * 100) AS INTEGER))
+                ON CONFLICT(dimension, key) DO UPDATE SET
+                    count = count + 1, amount_cents = amount_cents + excluded.amount_cents;
+            INSERT INTO stats_daily (day, type, count, volume_cents)
+                VALUES (date(NEW.timestamp), NEW.type, 1, CAST(ROUND(NEW.amount * 100) AS INTEGER))
+                ON CONFLICT(day, type) DO UPDATE SET
+                    count = count + 1, volume_cents = volume_cents + excluded.volume_cents;
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS stats_transaction_status AFTER UPDATE OF status ON transactions
+        WHEN NEW.status IS NOT OLD.status
+        BEGIN
+            UPDATE stats_transaction_counts
+            SET count = count - 1, amount_cents = amount_cents - CAST(ROUND(OLD.amount * 100) AS INTEGER)
+            WHERE dimension = 'status' AND key = COALESCE(OLD.status, '');
+            INSERT INTO stats_transaction_counts (dimension, key, count, amount_cents)
+                VALUES ('status', COALESCE(NEW.status, ''), 1, CAST(ROUND(NEW.amount * 100) AS INTEGER))
+                ON CONFLICT(dimension, key) DO UPDATE SET
+                    count = count + 1, amount_cents = amount_cents + excluded.amount_cents;
+        END
+    ''')
+
+# Number of recent events kept in event_log
+EVENT_LOG_RETENTION = 10000
 
+def _create_event_triggers(cursor):
+    """Append wallet and transaction changes to event_log for live clients"""
+    cursor.execute(f'''
+        CREATE TRIGGER IF NOT EXISTS events_prune AFTER INSERT ON event_log
+        BEGIN
+            DELETE FROM event_log WHERE id <= NEW.id - {EVENT_LOG_RETENTION};
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS events_wallet_insert AFTER INSERT ON wallets
+        BEGIN
+            INSERT INTO event_log (type, payload) VALUES ('wallet.created', json_object(
+                'student_id', NEW.student_id, 'student_name', NEW.student_name,
+                'wallet_id', NEW.wallet_id, 'balance', NEW.balance, 'created_at', NEW.created_at));
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS events_wallet_balance AFTER UPDATE OF balance ON wallets
+        WHEN NEW.balance IS NOT OLD.balance
+        BEGIN
+            INSERT INTO event_log (type, payload) VALUES ('wallet.balance', json_object(
+                'student_id', NEW.student_id, 'wallet_id', NEW.wallet_id,
+                'balance', NEW.balance, 'updated_at', NEW.updated_at));
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS events_transaction_insert AFTER INSERT ON transactions
+        BEGIN
+            INSERT INTO event_log (type, payload) VALUES ('transaction.created', json_object(
+                'id', NEW.id, 'type', NEW.type, 'amount', NEW.amount, 'status', NEW.status,
+                'student_id', NEW.student_id, 'from_student', NEW.from_student,
+                'to_student', NEW.to_student, 'description', NEW.description,
+                'timestamp', NEW.timestamp));
+        END
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER IF NOT EXISTS events_transaction_status AFTER UPDATE OF status ON transactions
+        WHEN NEW.status IS NOT OLD.status
+        BEGIN
+            INSERT INTO event_log (type, payload) VALUES ('transaction.updated', json_object(
+                'id', NEW.id, 'status', NEW.status));
+        END
+    ''')
+
+def _create_change_triggers(cursor):
+    """Bump data_changes.version on every write the read endpoints can see"""
+    for table in ('wallets', 'transactions', 'transaction_payloads'):
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS changes_{table}_{event.lower()} AFTER {event} ON {table}
+                BEGIN
+                    UPDATE data_changes SET version = version + 1 WHERE id = 1;
+                END
+            ''')
+
+_TRANSACTION_AGGREGATES = {
+    'total': 'SELECT COUNT(*) FROM transactions',
+    'counts': '''
+        SELECT 'type', type, COUNT(*), SUM(CAST(ROUND(amount * 100) AS INTEGER))
+        FROM transactions GROUP BY type
+        UNION ALL
+        SELECT 'status', COALESCE(status, ''), COUNT(*), SUM(CAST(ROUND(amount * 100) AS INTEGER))
+        FROM transactions GROUP BY COALESCE(status, '')
+    ''',
+    'daily': '''
+        SELECT date(timestamp), type, COUNT(*), SUM(CAST(ROUND(amount * 100) AS INTEGER))
+        FROM transactions GROUP BY date(timestamp), type
+    '''
+}
+
+def _add_archived_stats(cursor):
+    """
+    Add each archive's transactions to the statistics. Archives are read
+    through their own connections because ATTACH is not allowed inside
+    the rebuild's transaction.
+    """
+    for month in archive_months():
+        with closing(sqlite3.connect(archive_path(month))) as archive:
+            total = archive.execute(_TRANSACTION_AGGREGATES['total']).fetchone()[0]
+            counts = archive.execute(_TRANSACTION_AGGREGATES['counts']).fetchall()
+            daily = archive.execute(_TRANSACTION_AGGREGATES['daily']).fetchall()
+        cursor.execute("UPDATE stats_totals SET value = value + ? WHERE name = 'transaction_count'",
+                       (total,))
+        cursor.executemany('''
+            INSERT INTO stats_transaction_counts (dimension, key, count, amount_cents)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(dimension, key) DO UPDATE SET
+                count = count + excluded.count, amount_cents = amount_cents + excluded.amount_cents
+        ''', counts)
+        cursor.executemany('''
+            INSERT INTO stats_daily (day, type, count, volume_cents) VALUES (?, ?, ?, ?)
+            ON CONFLICT(day, type) DO UPDATE SET
+                count = count + excluded.count, volume_cents = volume_cents + excluded.volume_cents
+        ''', daily)
+
+def _rebuild_stats(cursor):
+    """Recompute every statistic from the base tables and the archives"""
+    cursor.execute('DELETE FROM stats_totals')
+    cursor.execute('DELETE FROM stats_transaction_counts')
+    cursor.execute('DELETE FROM stats_daily')
+    cursor.execute('''
+        INSERT INTO stats_totals (name, value)
+        SELECT 'wallet_count', COUNT(*) FROM wallets
+        UNION ALL
+        SELECT 'total_balance_cents', COALESCE(SUM(CAST(ROUND(balance * 100) AS INTEGER)), 0) FROM wallets
+        UNION ALL
+        SELECT 'transaction_count', COUNT(*) FROM transactions
+    ''')
+    cursor.execute('INSERT INTO stats_transaction_counts (dimension, key, count, amount_cents) '
+                   + _TRANSACTION_AGGREGATES['counts'])
+    cursor.execute('INSERT INTO stats_daily (day, type, count, volume_cents) '
+                   + _TRANSACTION_AGGREGATES['daily'])
+    _add_archived_stats(cursor)
+
+@metrics.timed
+def rebuild_stats():
+    """Recompute statistics from scratch, e.g. after editing the database by hand"""
+    with transaction() as conn:
+        _rebuild_stats(conn.cursor())
+
+@metrics.timed
+def get_stats(days=30):
+    """
+    Read the precomputed statistics: wallet and transaction totals,
+    per-type and per-status counts, the richest wallet and daily volume
+    for the last `days` days.
+    """
+    with get_db_connection() as conn:
+        totals = {row['name']: row['value'] for row in conn.execute('SELECT * FROM stats_totals')}
+        by_type, by_status = {}, {}
+        for row in conn.execute('SELECT * FROM stats_transaction_counts WHERE count != 0'):
+            target = by_type if row['dimension'] == 'type' else by_status
+            target[row['key']] = {'count': row['count'], 'amount': row['amount_cents'] / 100.0}
+
+        richest = conn.execute('''
+            SELECT student_id, student_name, balance FROM wallets
+            ORDER BY balance DESC LIMIT 1
+        ''').fetchone()
+
+        daily = [{'day': row['day'], 'type': row['type'], 'count': row['count'],
+                  'volume': row['volume_cents'] / 100.0}
+                 for row in conn.execute('''
+                     SELECT * FROM stats_daily WHERE day >= date('now', ?)
+                     ORDER BY day, type
+                 ''', (f'-{int(days)} days',))]
+
+    wallet_count = totals.get('wallet_count', 0)
+    total_balance = totals.get('total_balance_cents', 0) / 100.0
+    return {
+        'wallet_count': wallet_count,
+        'transaction_count': totals.get('transaction_count', 0),
+        'total_balance': total_balance,
+        'average_balance': total_balance / wallet_count if wallet_count else 0,
+        'richest_wallet': dict(richest) if richest else None,
+        'transactions_by_type': by_type,
+        'transactions_by_status': by_status,
+        'daily_volume': daily
+    }
+
+@metrics.timed
 def add_wallet(student_id, student_name, wallet_id, phone=None, email=None):
     """Add a new wallet to the database"""
     with get_db_connection() as conn:
@@ -74,8 +820,47 @@ def add_wallet(student_id, student_name, wallet_id, phone=None, email=None):
             INSERT INTO wallets (student_id, student_name, wallet_id, phone, email)
             VALUES (?, ?, ?, ?, ?)
         ''', (student_id, student_name, wallet_id, phone, email))
-        return cursor.lastrowid
+        row_id = cursor.lastrowid
+        # Open the wallet's ledger account alongside it
+        cursor.execute('INSERT OR IGNORE INTO ledger_balances (account) VALUES (?)', (wallet_id,))
+        return row_id
+
+@metrics.timed
+def add_wallets(wallets):
+    """Add many wallets in one batch (dicts with add_wallet's fields)"""
+    rows = [(w['student_id'], w['student_name'], w['wallet_id'], w.get('phone'), w.get('email'))
+            for w in wallets]
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.executemany('''
+            INSERT INTO wallets (student_id, student_name, wallet_id, phone, email)
+            VALUES (?, ?, ?, ?, ?)
+        ''', rows)
+        cursor.executemany('INSERT OR IGNORE INTO ledger_balances (account) VALUES (?)',
+                           [(row[2],) for row in rows])
+        return len(rows)
 
+@metrics.timed
+def get_wallets_by_student_ids(student_ids):
+    """Get wallets for many students at once, as a dict keyed by student ID"""
+    student_ids = list(student_ids)
+    wallets = {}
+    with get_db_connection() as conn:
+        # Stay well under SQLite's bound-parameter limit
+        for i in range(0, len(student_ids), 500):
+            chunk = student_ids[i:i + 500]
+            placeholders = ','.join('?' * len(chunk))
+            for row in conn.execute(
+                    f'SELECT * FROM wallets WHERE student_id IN ({placeholders})', chunk):
+                wallets[row['student_id']] = dict(row)
+    return wallets
+
+@metrics.timed
+def get_existing_student_ids(student_ids):
+    """Return the subset of student IDs that already have a wallet"""
+    return set(get_wallets_by_student_ids(student_ids))
+
+@metrics.timed
 def get_wallet_by_student_id(student_id):
     """Get wallet information by student ID"""
     with get_db_connection() as conn:
@@ -86,6 +871,7 @@ def get_wallet_by_student_id(student_id):
             return dict(row)
         return None
 
+@metrics.timed
 def get_wallet_by_wallet_id(wallet_id):
     """Get wallet information by wallet ID"""
     with get_db_connection() as conn:
@@ -96,6 +882,7 @@ def get_wallet_by_wallet_id(wallet_id):
             return dict(row)
         return None
 
+@metrics.timed
 def update_wallet_balance(student_id, balance):
     """Update wallet balance"""
     with get_db_connection() as conn:
@@ -107,86 +894,346 @@ def update_wallet_balance(student_id, balance):
         ''', (balance, student_id))
         return cursor.rowcount > 0
 
+@metrics.timed
+def get_balance_version(wallet_id):
+    """Current version of a wallet's IntaSend balance (0 if never changed)"""
+    with get_db_connection() as conn:
+        row = conn.execute('SELECT version FROM balance_versions WHERE wallet_id = ?',
+                           (wallet_id,)).fetchone()
+        return row[0] if row else 0
+
+@metrics.timed
+def bump_balance_version(wallet_id):
+    """Mark a wallet's IntaSend balance as changed; returns the new version"""
+    with get_db_connection() as conn:
+        return conn.execute('''
+            INSERT INTO balance_versions (wallet_id, version) VALUES (?, 1)
+            ON CONFLICT(wallet_id) DO UPDATE SET version = version + 1
+            RETURNING version
+        ''', (wallet_id,)).fetchone()[0]
+
+@metrics.timed
 def get_all_wallets():
     """Get all wallets from the database"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
-        cursor.execute('SELECT * FROM wallets ORDER BY created_at DESC')
+        cursor.execute('SELECT * FROM wallets ORDER BY created_at DESC, id DESC')
         rows = cursor.fetchall()
         return [dict(row) for row in rows]
 
+# Columns the API may return, in default output order
+WALLET_FIELDS = ('student_id', 'student_name', 'wallet_id', 'balance', 'phone', 'email', 'created_at')
+TRANSACTION_FIELDS = ('id', 'type', 'amount', 'status', 'student_id', 'from_student', 'to_student',
+                      'description', 'timestamp')
+# Every transactions column read by internal callers (metadata lives in transaction_payloads)
+TRANSACTION_COLUMNS = ('id', 'transaction_id') + TRANSACTION_FIELDS[1:]
+
+def parse_fields(value, allowed):
+    """Turn a comma-separated ?fields= value into a tuple of allowed columns"""
+    fields = tuple(dict.fromkeys(f.strip() for f in value.split(',') if f.strip()))
+    unknown = [f for f in fields if f not in allowed]
+    if unknown:
+        raise ValueError(f'Unknown field(s): {", ".join(unknown)}. '
+                         f'Available: {", ".join(allowed)}')
+    return fields or allowed
+
+def select_columns(fields, allowed, keys):
+    """
+    SQL column list for the requested fields plus the keyset columns needed
+    for the next cursor. fields=None selects every column.
+    """
+    if fields is None:
+        return '*'
+    if any(field not in allowed for field in fields):
+        raise ValueError(f'Unknown field in {fields}')
+    return ', '.join(dict.fromkeys(tuple(fields) + tuple(keys)))
+
+def project_row(row, fields):
+    """Dict of only the requested fields of a row"""
+    return {field: row[field] for field in fields}
+
+@metrics.timed
+def get_wallets_page(limit=100, cursor=None, fields=None):
+    """
+    Get one page of wallets, newest first, using keyset pagination on
+    (created_at, id). With fields, only those columns (from WALLET_FIELDS)
+    are selected and returned. Returns (wallets, next_cursor).
+    """
+    columns = select_columns(fields, WALLET_FIELDS, ('created_at', 'id'))
+    with get_db_connection() as conn:
+        if cursor:
+            created_at, last_id = decode_cursor(cursor)
+            rows = conn.execute(f'''
+                SELECT {columns} FROM wallets
+                WHERE (created_at, id) < (?, ?)
+                ORDER BY created_at DESC, id DESC
+                LIMIT ?
+            ''', (created_at, last_id, limit + 1)).fetchall()
+        else:
+            rows = conn.execute(f'''
+                SELECT {columns} FROM wallets
+                ORDER BY created_at DESC, id DESC
+                LIMIT ?
+            ''', (limit + 1,)).fetchall()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1]['created_at'], rows[-1]['id'])
+        if fields is None:
+            return [dict(row) for row in rows], next_cursor
+        return [project_row(row, fields) for row in rows], next_cursor
+
+@metrics.timed
 def add_transaction(transaction_type, amount, status='pending', student_id=None,
                    from_student=None, to_student=None, description=None,
                    transaction_id=None, metadata=None):
     """Add a new transaction to the database"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
-
-        # Convert metadata dict to JSON string if provided
-        metadata_json = json.dumps(metadata) if metadata else None
-
         cursor.execute('''
             INSERT INTO transactions
-            (transaction_id, type, student_id, from_student, to_student, amount, status, description, metadata)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+            (transaction_id, type, student_id, from_student, to_student, amount, status, description)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
         ''', (transaction_id, transaction_type, student_id, from_student, to_student,
-              amount, status, description, metadata_json))
-        return cursor.lastrowid
+              amount, status, description))
+        row_id = cursor.lastrowid
+        if metadata:
+            cursor.execute('INSERT INTO transaction_payloads (id, payload) VALUES (?, ?)',
+                           (row_id, json.dumps(metadata)))
+        return row_id
+
+@metrics.timed
+def add_transactions(transactions):
+    """Add many transactions in one batch (dicts with add_transaction's arguments)"""
+    with get_db_connection() as conn:
+        cursor = conn.cursor()
+        for t in transactions:
+            cursor.execute('''
+                INSERT INTO transactions
+                (transaction_id, type, student_id, from_student, to_student, amount, status, description)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (t.get('transaction_id'), t['transaction_type'], t.get('student_id'),
+                  t.get('from_student'), t.get('to_student'), t['amount'],
+                  t.get('status', 'pending'), t.get('description')))
+            if t.get('metadata'):
+                cursor.execute('INSERT INTO transaction_payloads (id, payload) VALUES (?, ?)',
+                               (cursor.lastrowid, json.dumps(t['metadata'])))
+        return len(transactions)
 
-def update_transaction_status(transaction_id, status):
-    """Update transaction status"""
+@metrics.timed
+def update_transaction_status(transaction_id, status, new_transaction_id=None, metadata=None):
+    """Update transaction status, optionally replacing its external ID and metadata"""
     with get_db_connection() as conn:
         cursor = conn.cursor()
+        if metadata:
+            # Before the UPDATE, which may change the external ID it is found by
+            cursor.execute('''
+                INSERT INTO transaction_payloads (id, payload)
+                SELECT id, ? FROM transactions WHERE transaction_id = ?
+                ON CONFLICT(id) DO UPDATE SET payload = excluded.payload, updated_at = CURRENT_TIMESTAMP
+            ''', (json.dumps(metadata), transaction_id))
         cursor.execute('''
             UPDATE transactions
-            SET status = ?
+            SET status = ?,
+                transaction_id = COALESCE(?, transaction_id)
             WHERE transaction_id = ?
-        ''', (status, transaction_id))
+        ''', (status, new_transaction_id, transaction_id))
         return cursor.rowcount > 0
 
+def _decode_payload(payload):
+    try:
+        return json.loads(payload)
+    except ValueError:
+        return payload
+
+def _load_payloads(conn, rows):
+    """
+    Decoded payloads for a page of transaction rows, by id. Rows are looked
+    up in transaction_payloads; those in an archived month that are not
+    found there are read from their archive.
+    """
+    ids = [row['id'] for row in rows]
+    payloads = {row['id']: _decode_payload(row['payload']) for row in conn.execute(
+        'SELECT id, payload FROM transaction_payloads WHERE id IN (SELECT value FROM json_each(?))',
+        (json.dumps(ids),))}
+
+    archived = set(archive_months())
+    by_month = {}
+    for row in rows:
+        month = (row['timestamp'] or '')[:7]
+        if row['id'] not in payloads and month in archived:
+            by_month.setdefault(month, []).append(row['id'])
+    for month, month_ids in by_month.items():
+        with attach_archive(conn, month) as schema:
+            for row in conn.execute(f'''
+                SELECT id, metadata FROM {schema}.transactions
+                WHERE id IN (SELECT value FROM json_each(?)) AND metadata IS NOT NULL
+            ''', (json.dumps(month_ids),)):
+                payloads[row['id']] = _decode_payload(row['metadata'])
+    return payloads
+
+def _transaction_dicts(conn, rows, fields, include_metadata):
+    """Page rows as dicts of the requested fields, plus decoded metadata if asked for"""
+    transactions = [project_row(row, fields) for row in rows]
+    if include_metadata:
+        payloads = _load_payloads(conn, rows)
+        for transaction, row in zip(transactions, rows):
+            transaction['metadata'] = payloads.get(row['id'])
+    return transactions
+
+@metrics.timed
+def get_transaction_metadata(row_id):
+    """
+    The stored provider payload of one transaction, by its id, from the
+    live database or an archive. Returns a dict with id, transaction_id
+    and metadata, or None if there is no such transaction.
+    """
+    with get_db_connection() as conn:
+        row = conn.execute('''
+            SELECT t.id, t.transaction_id, p.payload FROM transactions t
+            LEFT JOIN transaction_payloads p ON p.id = t.id
+            WHERE t.id = ?
+        ''', (row_id,)).fetchone()
+        for month in ([] if row else archive_months()):
+            with attach_archive(conn, month) as schema:
+                row = conn.execute(f'''
+                    SELECT id, transaction_id, metadata AS payload FROM {schema}.transactions
+                    WHERE id = ?
+                ''', (row_id,)).fetchone()
+            if row:
+                break
+    if row is None:
+        return None
+    return {'id': row['id'], 'transaction_id': row['transaction_id'],
+            'metadata': _decode_payload(row['payload']) if row['payload'] else None}
+
+@metrics.timed
 def get_all_transactions(limit=50):
-    """Get all transactions from the database"""
+    """Get the most recent transactions"""
+    transactions, _ = get_transactions_page(limit=limit)
+    return transactions
+
+def encode_cursor(*values):
+    """Build an opaque pagination cursor from the sort key of the last row"""
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor, size=2):
+    """Decode a cursor made by encode_cursor; raises ValueError if it is invalid"""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except Exception:
+        raise ValueError('Invalid cursor')
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError('Invalid cursor')
+    return values
+
+@metrics.timed
+def get_transactions_page(limit=50, cursor=None, fields=None, include_metadata=False):
+    """
+    Get one page of transactions, newest first, using keyset pagination on
+    (timestamp, id). With fields, only those columns are selected and
+    returned; by default all of TRANSACTION_COLUMNS. Provider payloads are
+    only read with include_metadata. Returns (transactions, next_cursor);
+    next_cursor is None on the last page.
+    """
+    fields = fields or TRANSACTION_COLUMNS
+    columns = select_columns(fields, TRANSACTION_COLUMNS, ('timestamp', 'id'))
     with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT * FROM transactions
-            ORDER BY timestamp DESC
+        if cursor:
+            timestamp, last_id = decode_cursor(cursor)
+            rows = _with_archives(conn, f'''
+                SELECT {columns} FROM {{table}}
+                WHERE (timestamp, id) < (?, ?)
+                ORDER BY timestamp DESC, id DESC
+                LIMIT ?
+            ''', (timestamp, last_id, limit + 1), limit, before=timestamp)
+        else:
+            rows = _with_archives(conn, f'''
+                SELECT {columns} FROM {{table}}
+                ORDER BY timestamp DESC, id DESC
+                LIMIT ?
+            ''', (limit + 1,), limit)
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1]['timestamp'], rows[-1]['id'])
+        return _transaction_dicts(conn, rows, fields, include_metadata), next_cursor
+
+def normalize_timestamp(value):
+    """Turn an ISO date or datetime into the format stored in timestamp columns"""
+    try:
+        parsed = datetime.fromisoformat(str(value).replace('Z', ''))
+    except ValueError:
+        raise ValueError(f'Invalid date: {value}')
+    return parsed.strftime('%Y-%m-%d %H:%M:%S')
+
+@metrics.timed
+def get_student_transactions(student_id, limit=50, cursor=None, types=None, since=None, until=None,
+                             fields=None, include_metadata=False):
+    """
+    Get one page of a student's transactions, newest first.
+
+    Each participant column (student_id, from_student, to_student) is read
+    through its own (column, timestamp, id) index and limited separately, so
+    the cost depends on the page size rather than on the size of the table.
+    Filters: types (list of transaction types), since (inclusive) and until
+    (exclusive) as ISO dates. fields and include_metadata work as in
+    get_transactions_page. Returns (transactions, next_cursor).
+    """
+    fields = fields or TRANSACTION_COLUMNS
+    columns = select_columns(fields, TRANSACTION_COLUMNS, ('timestamp', 'id'))
+    conditions, params = [], []
+    timestamp = None
+    if cursor:
+        timestamp, last_id = decode_cursor(cursor)
+        conditions.append('(timestamp, id) < (?, ?)')
+        params += [timestamp, last_id]
+    if since:
+        since = normalize_timestamp(since)
+        conditions.append('timestamp >= ?')
+        params.append(since)
+    if until:
+        until = normalize_timestamp(until)
+        conditions.append('timestamp < ?')
+        params.append(until)
+    if types:
+        conditions.append(f'type IN ({",".join("?" * len(types))})')
+        params += list(types)
+    extra = ''.join(f' AND {condition}' for condition in conditions)
+
+    arms = []
+    arm_params = []
+    for column in ('student_id', 'from_student', 'to_student'):
+        arms.append(f'''
+            SELECT id FROM (
+                SELECT id FROM {{table}}
+                WHERE {column} = ?{extra}
+                ORDER BY timestamp DESC, id DESC
+                LIMIT ?
+            )
+        ''')
+        arm_params += [student_id] + params + [limit + 1]
+
+    with get_db_connection() as conn:
+        # Archives are only opened when the page reaches back into them
+        rows = _with_archives(conn, f'''
+            SELECT {columns} FROM {{table}}
+            WHERE id IN ({' UNION '.join(arms)})
+            ORDER BY timestamp DESC, id DESC
             LIMIT ?
-        ''', (limit,))
-        rows = cursor.fetchall()
-        transactions = []
-        for row in rows:
-            txn = dict(row)
-            # Parse metadata JSON if exists
-            if txn.get('metadata'):
-                try:
-                    txn['metadata'] = json.loads(txn['metadata'])
-                except:
-                    pass
-            transactions.append(txn)
-        return transactions
+        ''', arm_params + [limit + 1], limit, since=since, until=until, before=timestamp)
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1]['timestamp'], rows[-1]['id'])
+        return _transaction_dicts(conn, rows, fields, include_metadata), next_cursor
 
+@metrics.timed
 def get_transactions_by_student(student_id, limit=50):
     """Get all transactions for a specific student"""
-    with get_db_connection() as conn:
-        cursor = conn.cursor()
-        cursor.execute('''
-            SELECT * FROM transactions
-            WHERE student_id = ? OR from_student = ? OR to_student = ?
-            ORDER BY timestamp DESC
-            LIMIT ?
-        ''', (student_id, student_id, student_id, limit))
-        rows = cursor.fetchall()
-        transactions = []
-        for row in rows:
-            txn = dict(row)
-            if txn.get('metadata'):
-                try:
-                    txn['metadata'] = json.loads(txn['metadata'])
-                except:
-                    pass
-            transactions.append(txn)
-        return transactions
-
-# Initialize database when module is imported
-init_database()
+    transactions, _ = get_student_transactions(student_id, limit=limit)
+    return transactions
@@ -0,0 +1,356 @@
+"""
+Batch disbursements from a treasury wallet to student wallets
+
+A disbursement job takes a file of recipients (student_id, amount) and pays
+each one from a source wallet through transfer_between_wallets, using a
+bounded, rate-limited thread pool. Each item's progress is stored in SQLite
+before and after the IntaSend call, so an interrupted job can be resumed
+without paying anyone twice: items whose outcome is unknown (an
+interrupted run, or no clear answer from IntaSend) are held as 'unknown'
+until IntaSend's webhook or the ledger settles them, and are never sent
+again, not even with --retry-failed.
+
+Usage:
+    python disbursements.py recipients.csv --source WALLET_ID [--narrative TEXT]
+    python disbursements.py --resume JOB_ID
+    python disbursements.py --status JOB_ID
+"""
+import os
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from rate_limiter import RateLimiter
+import database as db
+import jobs
+import ledger
+import logs
+
+TREASURY_WALLET_ID = os.getenv('TREASURY_WALLET_ID')
+DISBURSE_WORKERS = int(os.getenv('DISBURSE_WORKERS', 8))
+DISBURSE_RATE_LIMIT = float(os.getenv('DISBURSE_RATE_LIMIT', 10))    # transfers per second
+
+log = logs.get_logger('disbursements')
+
+
+def create_job(source_wallet_id, recipients, narrative=None, source=None):
+    """Record a disbursement job and one pending item per recipient; returns the job id"""
+    items = []
+    for line_no, recipient in enumerate(recipients, start=1):
+        student_id = str(recipient.get('student_id') or '').strip() or None
+        status, error, amount_cents = 'pending', None, None
+        try:
+            amount_cents = ledger.to_cents(recipient.get('amount'))
+            if amount_cents <= 0:
+                raise ValueError
+        except Exception:
+            status, error = 'failed', 'A positive amount is required'
+        if not student_id:
+            status, error = 'failed', 'student_id is required'
+        items.append((line_no, student_id, amount_cents, status, error))
+
+    total_cents = sum(item[2] for item in items if item[3] == 'pending')
+    with db.get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('''
+            INSERT INTO disbursement_jobs (source_wallet_id, narrative, source, total, total_cents)
+            VALUES (?, ?, ?, ?, ?)
+        ''', (source_wallet_id, narrative, source, len(items), total_cents))
+        job_id = cursor.lastrowid
+        cursor.executemany('''
+            INSERT INTO disbursement_items (job_id, line_no, student_id, amount_cents, status, error)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', [(job_id,) + item for item in items])
+
+        # Paying the same student twice in one file is almost always a mistake
+        cursor.execute('''
+            UPDATE disbursement_items
+            SET status = 'failed', error = 'Duplicate student_id in this job'
+            WHERE job_id = ? AND status = 'pending' AND line_no NOT IN (
+                SELECT MIN(line_no) FROM disbursement_items
+                WHERE job_id = ? AND student_id IS NOT NULL GROUP BY student_id
+            )
+        ''', (job_id, job_id))
+    return job_id
+
+
+def _set_job_status(job_id, status):
+    jobs.set_status('disbursement_jobs', job_id, status)
+
+def _update_item(item_id, status, reference=None, tracking_id=None, error=None):
+    with db.get_db_connection() as conn:
+        conn.execute('''
+            UPDATE disbursement_items
+            SET status = ?, reference = COALESCE(?, reference),
+                tracking_id = COALESCE(?, tracking_id), error = ?,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (status, reference, tracking_id, error, item_id))
+
+
+def _recover_in_flight(job_id):
+    """
+    Settle items left 'in_flight' by an interrupted run, or 'unknown', using
+    the ledger. A transfer IntaSend confirmed is paid, a reversed one can be
+    retried, and one still pending is held as 'unknown' rather than sent again.
+    """
+    with db.get_db_connection() as conn:
+        items = conn.execute('''
+            SELECT id, status, reference FROM disbursement_items
+            WHERE job_id = ? AND status IN ('in_flight', 'unknown')
+        ''', (job_id,)).fetchall()
+
+    for item in items:
+        transfer = ledger.find_transfer(reference=item['reference']) if item['reference'] else None
+        if transfer is None:
+            # Interrupted before anything was posted or sent
+            _update_item(item['id'], 'pending')
+        elif transfer['status'] == 'confirmed':
+            _update_item(item['id'], 'paid', tracking_id=transfer['provider_ref'])
+        elif transfer['status'] == 'reversed':
+            _update_item(item['id'], 'pending', error='Retried after reversal')
+        elif item['status'] == 'in_flight':
+            _update_item(item['id'], 'unknown',
+                         error='Interrupted while waiting for IntaSend; check before retrying')
+
+def settle_transfer(reference, tracking_id=None):
+    """
+    Mark the item paid by a ledger transfer as paid, once IntaSend has
+    confirmed it (e.g. by webhook after a timeout). Returns True if an
+    item was waiting on this transfer.
+    """
+    with db.get_db_connection() as conn:
+        cursor = conn.execute('''
+            UPDATE disbursement_items
+            SET status = 'paid', tracking_id = COALESCE(?, tracking_id), error = NULL,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE reference = ? AND status IN ('in_flight', 'unknown')
+        ''', (tracking_id, reference))
+        return cursor.rowcount > 0
+
+
+def _pay(item, job, to_wallet, wallet_manager):
+    """Hold funds in the ledger, send one transfer, and record the outcome"""
+    from intasend_transport import IntaSendTimeout
+
+    narrative = job['narrative'] or 'University disbursement'
+    amount = ledger.from_cents(item['amount_cents'])
+
+    try:
+        with db.transaction():
+            reference = ledger.post_transfer(job['source_wallet_id'], to_wallet['wallet_id'],
+                                             amount, narrative=narrative, kind='disbursement')
+            db.add_transaction(
+                transaction_type='disbursement',
+                amount=amount,
+                status='pending',
+                to_student=to_wallet['student_id'],
+                description=f'{narrative} for {to_wallet["student_name"]}',
+                transaction_id=reference
+            )
+            _update_item(item['id'], 'in_flight', reference=reference)
+    except ledger.InsufficientFunds as e:
+        _update_item(item['id'], 'failed', error=str(e))
+        return
+
+    try:
+        result = wallet_manager.transfer_between_wallets(
+            origin_wallet_id=job['source_wallet_id'],
+            destination_wallet_id=to_wallet['wallet_id'],
+            amount=amount,
+            narrative=narrative
+        )
+    except IntaSendTimeout:
+        # IntaSend may still carry it out: keep the funds held and leave the
+        # item for the webhook to settle; it must not be sent again
+        _update_item(item['id'], 'unknown',
+                     error='No clear answer from IntaSend; waiting for its confirmation')
+        return
+    except Exception as e:
+        with db.transaction():
+            ledger.reverse_transfer(reference, reason='IntaSend transfer request failed')
+            db.update_transaction_status(reference, 'failed')
+            _update_item(item['id'], 'failed', error=str(e))
+        return
+
+    if result and 'error' not in result and ('tracking_id' in result or 'details' in result):
+        tracking_id = result.get('tracking_id')
+        with db.transaction():
+            ledger.confirm_transfer(reference, provider_ref=tracking_id)
+            db.update_transaction_status(reference, 'completed', new_transaction_id=tracking_id,
+                                         metadata=result)
+            _update_item(item['id'], 'paid', tracking_id=tracking_id)
+    else:
+        error = (result or {}).get('error', 'Transfer failed')
+        with db.transaction():
+            ledger.reverse_transfer(reference, reason=str(error))
+            db.update_transaction_status(reference, 'failed', metadata=result)
+            _update_item(item['id'], 'failed', error=str(error))
+
+
+def run_job(job_id, wallet_manager, workers=DISBURSE_WORKERS, rate=DISBURSE_RATE_LIMIT,
+            retry_failed=False):
+    """
+    Pay every pending item of a job. Safe to call again to resume; with
+    retry_failed, items that failed on a previous run are attempted again.
+    Raises RuntimeError while another run, in any process, holds the job.
+    """
+    with jobs.running('disbursement_jobs', 'disbursement', job_id, track_start=True):
+        try:
+            with db.get_db_connection() as conn:
+                job = conn.execute('SELECT * FROM disbursement_jobs WHERE id = ?', (job_id,)).fetchone()
+            if not job:
+                raise ValueError(f'No disbursement job {job_id}')
+            job = dict(job)
+
+            # Holding the lease, so items left in flight belong to a run that died
+            _recover_in_flight(job_id)
+
+            # Start from the treasury balance IntaSend reports
+            balance_info = wallet_manager.get_wallet_balance(job['source_wallet_id'])
+            if balance_info:
+                ledger.reconcile(job['source_wallet_id'], balance_info.get('current_balance', 0))
+
+            statuses = ('pending', 'failed') if retry_failed else ('pending',)
+            with db.get_db_connection() as conn:
+                items = [dict(row) for row in conn.execute(f'''
+                    SELECT id, line_no, student_id, amount_cents FROM disbursement_items
+                    WHERE job_id = ? AND status IN ({','.join('?' * len(statuses))})
+                      AND student_id IS NOT NULL AND amount_cents > 0
+                    ORDER BY line_no
+                ''', (job_id,) + statuses)]
+
+            wallets = db.get_wallets_by_student_ids({item['student_id'] for item in items})
+            limiter = RateLimiter(rate)
+
+            def process(item):
+                to_wallet = wallets.get(item['student_id'])
+                if not to_wallet:
+                    _update_item(item['id'], 'failed', error=f'No wallet found for student {item["student_id"]}')
+                    return
+                limiter.acquire()
+                try:
+                    _pay(item, job, to_wallet, wallet_manager)
+                except Exception:
+                    log.exception('Disbursement item failed', extra={'job_id': job_id, 'line_no': item['line_no']})
+
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                # Consume results so worker exceptions are not silently dropped
+                list(pool.map(process, items))
+
+            _set_job_status(job_id, 'completed')
+            return job_status(job_id)
+        except Exception:
+            _set_job_status(job_id, 'failed')
+            raise
+
+
+def start_job(job_id, wallet_manager, **kwargs):
+    """Run a job on a background thread"""
+    return jobs.start_job('disbursement', run_job, job_id, wallet_manager, **kwargs)
+
+
+def job_status(job_id, item_status=None, after=0, limit=100):
+    """Get a job's progress with throughput and ETA, plus per-item results"""
+    with db.get_db_connection() as conn:
+        job = conn.execute('''
+            SELECT *, (julianday('now') - julianday(started_at)) * 86400 AS elapsed
+            FROM disbursement_jobs WHERE id = ?
+        ''', (job_id,)).fetchone()
+        if not job:
+            return None
+
+        counts, amounts = {}, {}
+        for row in conn.execute('''
+            SELECT status, COUNT(*) AS n, COALESCE(SUM(amount_cents), 0) AS cents
+            FROM disbursement_items WHERE job_id = ? GROUP BY status
+        ''', (job_id,)):
+            counts[row['status']] = row['n']
+            amounts[row['status']] = row['cents']
+
+        processed_this_run = 0
+        if job['started_at']:
+            processed_this_run = conn.execute('''
+                SELECT COUNT(*) FROM disbursement_items
+                WHERE job_id = ? AND status IN ('paid', 'failed') AND updated_at >= ?
+            ''', (job_id, job['started_at'])).fetchone()[0]
+
+        query = '''
+            SELECT line_no, student_id, amount_cents, status, tracking_id, error
+            FROM disbursement_items WHERE job_id = ? AND line_no > ?
+        '''
+        params = [job_id, after]
+        if item_status:
+            query += ' AND status = ?'
+            params.append(item_status)
+        query += ' ORDER BY line_no LIMIT ?'
+        params.append(limit)
+        items = [dict(row) for row in conn.execute(query, params)]
+
+    result = dict(job)
+    elapsed = result.pop('elapsed') or 0
+    remaining = counts.get('pending', 0) + counts.get('in_flight', 0)
+    throughput = processed_this_run / elapsed if elapsed > 0 else 0.0
+
+    result['counts'] = counts
+    result['paid_amount'] = ledger.from_cents(amounts.get('paid', 0))
+    result['remaining'] = remaining
+    result['throughput_per_second'] = round(throughput, 2)
+    result['eta_seconds'] = (round(remaining / throughput)
+                             if throughput and result['status'] == 'running' else None)
+    for item in items:
+        item['amount'] = ledger.from_cents(item.pop('amount_cents') or 0)
+    result['items'] = items
+    result['next_after'] = items[-1]['line_no'] if items and len(items) == limit else None
+    return result
+
+
+def _print_status(status):
+    counts = status['counts']
+    print(f"Job {status['id']} [{status['status']}]: paid {counts.get('paid', 0)}/{status['total']} "
+          f"({status['paid_amount']:.2f} KES), failed {counts.get('failed', 0)}, "
+          f"unknown {counts.get('unknown', 0)}, {status['throughput_per_second']}/s"
+          + (f", ETA {status['eta_seconds']}s" if status['eta_seconds'] is not None else ''))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Disburse funds to student wallets in bulk')
+    parser.add_argument('file', nargs='?', help='CSV or JSON file of recipients')
+    parser.add_argument('--source', default=TREASURY_WALLET_ID,
+                        help='Wallet ID to pay from (default: TREASURY_WALLET_ID)')
+    parser.add_argument('--narrative', help='Narrative shown on each transfer')
+    parser.add_argument('--resume', type=int, metavar='JOB_ID', help='Resume an existing job')
+    parser.add_argument('--status', type=int, metavar='JOB_ID', help='Show job progress')
+    parser.add_argument('--retry-failed', action='store_true', help='Also retry failed items')
+    parser.add_argument('--workers', type=int, default=DISBURSE_WORKERS)
+    parser.add_argument('--rate', type=float, default=DISBURSE_RATE_LIMIT,
+                        help='Max transfers per second (0 = unlimited)')
+    args = parser.parse_args()
+
+    if args.status:
+        status = job_status(args.status, item_status='failed')
+        if not status:
+            parser.exit(1, f"No disbursement job {args.status}\n")
+        _print_status(status)
+        for item in status['items']:
+            print(f"  line {item['line_no']} {item['student_id']}: {item['error']}")
+        parser.exit()
+
+    if args.resume:
+        job_id = args.resume
+    elif args.file:
+        if not args.source:
+            parser.error('--source or TREASURY_WALLET_ID is required')
+        with open(args.file, 'rb') as f:
+            recipients = jobs.parse_rows(f.read(), jobs.file_format(args.file), 'items')
+        job_id = create_job(args.source, recipients, narrative=args.narrative,
+                            source=os.path.basename(args.file))
+        print(f"Created disbursement job {job_id} with {len(recipients)} recipient(s)")
+    else:
+        parser.error('a recipient file, --resume or --status is required')
+
+    from wallet_manager import UniversityWalletManager
+
+    runner = start_job(job_id, UniversityWalletManager(), workers=args.workers, rate=args.rate,
+                       retry_failed=args.retry_failed)
+    while runner.is_alive():
+        runner.join(5)
+        _print_status(job_status(job_id, limit=0))
@@ -0,0 +1,174 @@
+"""
+Live change feed for the web interface
+
+SQLite triggers append wallet and transaction changes to the event_log
+table, whichever process or code path wrote them. While at least one
+client is listening, a single poller thread per process tails event_log
+and wakes the waiting clients; with no listeners nothing runs at all.
+Idle connections just block on a condition variable, so hundreds of open
+tabs cost one query per poll interval in total.
+
+Each open stream or long poll does hold a server thread, so a process
+serves at most EVENTS_MAX_STREAMS of them at once and keeps its other
+threads for ordinary requests. Beyond that, /events answers 503 and the
+page retries later, and /events/poll returns at once instead of waiting.
+"""
+import os
+import json
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+import database as db
+import logs
+
+EVENTS_POLL_INTERVAL = float(os.getenv('EVENTS_POLL_INTERVAL', 0.5))    # seconds
+EVENTS_HEARTBEAT = float(os.getenv('EVENTS_HEARTBEAT', 15))             # seconds
+EVENTS_BUFFER_SIZE = int(os.getenv('EVENTS_BUFFER_SIZE', 2000))
+EVENTS_MAX_STREAMS = int(os.getenv('EVENTS_MAX_STREAMS', 8))           # per process
+
+log = logs.get_logger('events')
+
+_FETCH_BATCH = 500
+
+
+class EventFeed:
+    """Fans event_log rows out to any number of waiting clients"""
+
+    def __init__(self, poll_interval=EVENTS_POLL_INTERVAL, buffer_size=EVENTS_BUFFER_SIZE):
+        self.poll_interval = poll_interval
+        self._buffer = deque(maxlen=buffer_size)
+        self._cond = threading.Condition()
+        self._last_id = None
+        self._subscribers = 0
+        self._pid = None
+
+    def _ensure_poller(self):
+        if self._pid == os.getpid():
+            return
+        # First use in this process (or after a fork): start from the newest event
+        with db.get_db_connection() as conn:
+            self._last_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM event_log').fetchone()[0]
+        self._buffer.clear()
+        self._pid = os.getpid()
+        threading.Thread(target=self._poll_loop, name='event-feed', daemon=True).start()
+
+    def _poll_loop(self):
+        while True:
+            with self._cond:
+                while self._subscribers == 0:
+                    self._cond.wait()
+                after_id = self._last_id
+
+            try:
+                with db.get_db_connection() as conn:
+                    rows = conn.execute('''
+                        SELECT id, type, payload FROM event_log WHERE id > ? ORDER BY id LIMIT ?
+                    ''', (after_id, _FETCH_BATCH)).fetchall()
+            except Exception:
+                log.exception('Event feed poll failed')
+                rows = []
+
+            if rows:
+                with self._cond:
+                    for row in rows:
+                        self._buffer.append((row['id'], row['type'], row['payload']))
+                    self._last_id = rows[-1]['id']
+                    self._cond.notify_all()
+            if len(rows) < _FETCH_BATCH:
+                time.sleep(self.poll_interval)
+
+    @contextmanager
+    def subscription(self):
+        """Register a listening client for the duration of the block"""
+        with self._cond:
+            self._ensure_poller()
+            self._subscribers += 1
+            self._cond.notify_all()
+        try:
+            yield self
+        finally:
+            with self._cond:
+                self._subscribers -= 1
+
+    def latest_id(self):
+        with self._cond:
+            self._ensure_poller()
+            return self._last_id
+
+    def wait(self, after_id, timeout):
+        """
+        Wait up to `timeout` seconds for events newer than after_id.
+        Returns (events, resync); resync is True when the client has fallen
+        too far behind (or reconnected with an unknown id) and should reload
+        its data instead of applying events.
+        """
+        with self._cond:
+            self._ensure_poller()
+            if after_id > self._last_id:
+                return [], True
+            self._cond.wait_for(lambda: self._last_id > after_id, timeout)
+            events = [event for event in self._buffer if event[0] > after_id]
+            oldest = self._buffer[0][0] if self._buffer else self._last_id + 1
+            missed = after_id < self._last_id and after_id + 1 < oldest
+            return events, missed
+
+
+feed = EventFeed()
+
+_stream_slots = threading.BoundedSemaphore(EVENTS_MAX_STREAMS)
+
+def acquire_stream():
+    """Take one of this process's stream slots; False if all are in use"""
+    return _stream_slots.acquire(blocking=False)
+
+def release_stream():
+    _stream_slots.release()
+
+
+def format_sse(event_id, event_type, payload):
+    """Encode one Server-Sent Event"""
+    return f"id: {event_id}\nevent: {event_type}\ndata: {payload}\n\n"
+
+def sse_stream(last_event_id=None, heartbeat=EVENTS_HEARTBEAT):
+    """Generator for a text/event-stream response"""
+    with feed.subscription():
+        after_id = last_event_id if last_event_id is not None else feed.latest_id()
+        # Tell the browser how quickly to reconnect, and where we start
+        yield f"retry: 3000\nid: {after_id}\nevent: ready\ndata: {{}}\n\n"
+        while True:
+            events, resync = feed.wait(after_id, heartbeat)
+            if resync:
+                after_id = feed.latest_id()
+                yield format_sse(after_id, 'resync', '{}')
+                continue
+            if not events:
+                # Comment line keeps proxies from closing an idle connection
+                yield ": keepalive\n\n"
+                continue
+            for event_id, event_type, payload in events:
+                yield format_sse(event_id, event_type, payload)
+            after_id = events[-1][0]
+
+def poll(after_id=None, timeout=25):
+    """Long-poll alternative to the SSE stream; returns a JSON-ready dict"""
+    with feed.subscription():
+        if after_id is None:
+            return {'events': [], 'last_id': feed.latest_id(), 'resync': False, 'waited': False}
+        # Only wait while holding a slot; otherwise answer with what is there
+        waiting = timeout > 0 and acquire_stream()
+        try:
+            events, resync = feed.wait(after_id, timeout if waiting else 0)
+        finally:
+            if waiting:
+                release_stream()
+        if resync:
+            return {'events': [], 'last_id': feed.latest_id(), 'resync': True, 'waited': waiting}
+        return {
+            'events': [{'id': event_id, 'type': event_type, 'data': json.loads(payload)}
+                       for event_id, event_type, payload in events],
+            'last_id': events[-1][0] if events else after_id,
+            'resync': False,
+            # False when all slots were busy: the client should back off
+            'waited': waiting
+        }
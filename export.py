@@ -0,0 +1,169 @@
+"""
+Streaming export of transactions and wallets as CSV or NDJSON
+
+Rows are read in keyset-paginated batches on the (timestamp, id) and
+(created_at, id) indexes and written out as they are read, so memory use
+stays the same however many rows are exported. Transactions moved to the
+monthly archives (archive.py) are merged back in when the date range
+reaches them.
+
+Usage: python export.py transactions|wallets [--format csv|ndjson]
+                        [--since DATE] [--until DATE] [--type TYPE,...] [-o FILE]
+"""
+import io
+import csv
+import sys
+import heapq
+import argparse
+import database as db
+import serializers
+
+EXPORT_BATCH_SIZE = 1000
+
+TRANSACTION_COLUMNS = ['id', 'transaction_id', 'type', 'student_id', 'from_student', 'to_student',
+                       'amount', 'status', 'description', 'timestamp']
+WALLET_COLUMNS = ['id', 'student_id', 'student_name', 'wallet_id', 'phone', 'email',
+                  'balance', 'created_at', 'updated_at']
+
+FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson'
+}
+
+
+def iter_transactions(since=None, until=None, types=None, batch_size=EXPORT_BATCH_SIZE):
+    """Yield transactions oldest first, filtered by date range and type"""
+    conditions, params = [], []
+    since = db.normalize_timestamp(since) if since else None
+    until = db.normalize_timestamp(until) if until else None
+    if since:
+        conditions.append('timestamp >= ?')
+        params.append(since)
+    if until:
+        conditions.append('timestamp < ?')
+        params.append(until)
+    if types:
+        conditions.append(f'type IN ({",".join("?" * len(types))})')
+        params += list(types)
+
+    sources = [_iter_keyset('transactions', TRANSACTION_COLUMNS, 'timestamp',
+                            conditions, params, batch_size)]
+    for month in reversed(db.archive_months(since, until)):
+        sources.append(_iter_keyset('transactions', TRANSACTION_COLUMNS, 'timestamp',
+                                    conditions, params, batch_size, archive=month))
+    timestamp_at, id_at = TRANSACTION_COLUMNS.index('timestamp'), TRANSACTION_COLUMNS.index('id')
+    last_id = None
+    for row in heapq.merge(*sources, key=lambda row: (row[timestamp_at], row[id_at])):
+        # A row interrupted mid-move can be in both the live table and an archive
+        if row[id_at] != last_id:
+            last_id = row[id_at]
+            yield row
+
+def iter_wallets(batch_size=EXPORT_BATCH_SIZE):
+    """Yield wallets oldest first"""
+    yield from _iter_keyset('wallets', WALLET_COLUMNS, 'created_at', [], [], batch_size)
+
+def _iter_keyset(table, columns, sort_column, conditions, params, batch_size, archive=None):
+    """
+    Read a table in (sort_column, id) order one batch at a time. The
+    connection is only held while a batch is fetched, never between yields.
+    With archive (a 'YYYY-MM' month), the table is read from that month's
+    archive, attached for each batch.
+    """
+    last = None
+    while True:
+        where = list(conditions)
+        batch_params = list(params)
+        if last is not None:
+            where.append(f'({sort_column}, id) > (?, ?)')
+            batch_params += list(last)
+        query = f'SELECT {", ".join(columns)} FROM {{table}}'
+        if where:
+            query += ' WHERE ' + ' AND '.join(where)
+        query += f' ORDER BY {sort_column}, id LIMIT ?'
+
+        with db.get_db_connection() as conn:
+            if archive:
+                with db.attach_archive(conn, archive) as schema:
+                    rows = conn.execute(query.format(table=f'{schema}.{table}'),
+                                        batch_params + [batch_size]).fetchall()
+            else:
+                rows = conn.execute(query.format(table=table), batch_params + [batch_size]).fetchall()
+        if not rows:
+            return
+        for row in rows:
+            yield tuple(row)
+        if len(rows) < batch_size:
+            return
+        last = (rows[-1][sort_column], rows[-1]['id'])
+
+
+def to_csv(rows, columns, lines_per_chunk=500):
+    """Encode rows as CSV text chunks, header first"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    count = 0
+    for row in rows:
+        writer.writerow(row)
+        count += 1
+        if count % lines_per_chunk == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def to_ndjson(rows, columns, lines_per_chunk=500):
+    """Encode rows as newline-delimited JSON text chunks"""
+    lines = []
+    for row in rows:
+        lines.append(serializers.dumps(dict(zip(columns, row))))
+        if len(lines) >= lines_per_chunk:
+            yield '\n'.join(lines) + '\n'
+            lines = []
+    if lines:
+        yield '\n'.join(lines) + '\n'
+
+def encode(rows, columns, fmt):
+    """Encode rows in the given export format"""
+    if fmt == 'csv':
+        return to_csv(rows, columns)
+    if fmt == 'ndjson':
+        return to_ndjson(rows, columns)
+    raise ValueError(f'Unsupported export format: {fmt}')
+
+
+def export(kind, fmt='csv', since=None, until=None, types=None):
+    """Return a generator of text chunks for a transactions or wallets export"""
+    if fmt not in FORMATS:
+        raise ValueError(f'Unsupported export format: {fmt}')
+    if kind == 'transactions':
+        # Validate filters up front rather than mid-stream
+        since = db.normalize_timestamp(since) if since else None
+        until = db.normalize_timestamp(until) if until else None
+        return encode(iter_transactions(since, until, types), TRANSACTION_COLUMNS, fmt)
+    if kind == 'wallets':
+        return encode(iter_wallets(), WALLET_COLUMNS, fmt)
+    raise ValueError(f'Unknown export: {kind}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export transactions or wallets')
+    parser.add_argument('kind', choices=['transactions', 'wallets'])
+    parser.add_argument('--format', choices=sorted(FORMATS), default='csv')
+    parser.add_argument('--since', help='Start date (inclusive), e.g. 2025-01-01')
+    parser.add_argument('--until', help='End date (exclusive), e.g. 2025-02-01')
+    parser.add_argument('--type', help='Comma-separated transaction types')
+    parser.add_argument('-o', '--output', help='Output file (default: stdout)')
+    args = parser.parse_args()
+
+    types = [t for t in (args.type or '').split(',') if t]
+    chunks = export(args.kind, args.format, since=args.since, until=args.until, types=types)
+
+    out = open(args.output, 'w', newline='', encoding='utf-8') if args.output else sys.stdout
+    try:
+        for chunk in chunks:
+            out.write(chunk)
+    finally:
+        if args.output:
+            out.close()
@@ -0,0 +1,330 @@
+"""
+Local stand-in for the IntaSend API, for development and load testing
+
+Implements the wallet endpoints the app uses (create, retrieve, list,
+intra_transfer, transactions) and M-Pesa STK push, keeping wallets in
+memory, and sends webhooks back to the app like IntaSend does. Latency,
+errors, hangs and rate limits can be injected to reproduce production
+conditions offline.
+
+Usage:
+    python fake_intasend.py --port 8001 --latency lognormal:80:600 --error-rate 0.02
+    INTASEND_BASE_URL=http://localhost:8001/api/v1 python app.py
+
+Latency specs (milliseconds): fixed:50, uniform:20:200, exponential:100 (mean),
+lognormal:80:600 (median and 99th percentile).
+"""
+import os
+import math
+import time
+import uuid
+import random
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+import requests
+from flask import Flask, request, jsonify
+from rate_limiter import RateLimiter
+
+API_PREFIX = '/api/v1'
+
+
+def parse_latency(spec):
+    """Turn a latency spec into a function returning a delay in seconds"""
+    if not spec:
+        return lambda: 0.0
+    kind, _, args = spec.partition(':')
+    values = [float(v) for v in args.split(':') if v]
+    if kind == 'fixed':
+        return lambda: values[0] / 1000
+    if kind == 'uniform':
+        low, high = values
+        return lambda: random.uniform(low, high) / 1000
+    if kind == 'exponential':
+        mean = values[0]
+        return lambda: random.expovariate(1 / mean) / 1000
+    if kind == 'lognormal':
+        median, p99 = values
+        sigma = math.log(p99 / median) / 2.326 if p99 > median else 0.0
+        return lambda: random.lognormvariate(math.log(median), sigma) / 1000
+    raise ValueError(f'Unknown latency spec: {spec}')
+
+
+class FakeIntaSend:
+    """In-memory wallets plus webhook delivery"""
+
+    def __init__(self, webhook_url=None, initial_balance=0.0, webhook_delay=1.0,
+                 stk_fail_rate=0.0, duplicate_rate=0.0):
+        self.webhook_url = webhook_url
+        self.initial_balance = initial_balance
+        self.webhook_delay = webhook_delay
+        self.stk_fail_rate = stk_fail_rate
+        self.duplicate_rate = duplicate_rate
+        self.wallets = {}
+        self.transactions = {}
+        self.lock = threading.Lock()
+        self._webhooks = ThreadPoolExecutor(max_workers=8, thread_name_prefix='fake-webhook')
+
+    def create_wallet(self, label, currency='KES', can_disburse=False):
+        now = datetime.now().isoformat()
+        wallet = {
+            'wallet_id': uuid.uuid4().hex[:7].upper(),
+            'label': label,
+            'wallet_type': 'WORKING',
+            'currency': currency,
+            'can_disburse': can_disburse,
+            'current_balance': self.initial_balance,
+            'available_balance': self.initial_balance,
+            'created_at': now,
+            'updated_at': now
+        }
+        with self.lock:
+            self.wallets[wallet['wallet_id']] = wallet
+            self.transactions[wallet['wallet_id']] = []
+        return dict(wallet)
+
+    def _move(self, wallet_id, amount, narrative, transaction_type):
+        """Change a wallet's balance; caller holds the lock"""
+        wallet = self.wallets[wallet_id]
+        wallet['current_balance'] = round(wallet['current_balance'] + amount, 2)
+        wallet['available_balance'] = wallet['current_balance']
+        wallet['updated_at'] = datetime.now().isoformat()
+        self.transactions[wallet_id].append({
+            'transaction_id': uuid.uuid4().hex[:10].upper(),
+            'transaction_type': transaction_type,
+            'value': amount,
+            'running_balance': wallet['current_balance'],
+            'narrative': narrative,
+            'created_at': wallet['updated_at']
+        })
+
+    def credit(self, wallet_id, amount, narrative='Credit'):
+        with self.lock:
+            self._move(wallet_id, amount, narrative, 'CREDIT')
+            return dict(self.wallets[wallet_id])
+
+    def transfer(self, origin, destination, amount, narrative):
+        """Returns (response, error)"""
+        with self.lock:
+            if origin not in self.wallets or destination not in self.wallets:
+                return None, 'Wallet not found'
+            if self.wallets[origin]['available_balance'] < amount:
+                return None, 'Insufficient balance'
+            self._move(origin, -amount, narrative, 'DEBIT')
+            self._move(destination, amount, narrative, 'CREDIT')
+            result = {
+                'tracking_id': str(uuid.uuid4()),
+                'status': 'Completed',
+                'details': {
+                    'origin': dict(self.wallets[origin]),
+                    'destination': dict(self.wallets[destination])
+                }
+            }
+
+        self.send_webhook({
+            'event': 'wallet.transfer',
+            'origin_wallet_id': origin,
+            'destination_wallet_id': destination,
+            'amount': amount,
+            'narrative': narrative,
+            'status': 'completed',
+            'tracking_id': result['tracking_id']
+        })
+        return result, None
+
+    def stk_push(self, payload):
+        invoice_id = uuid.uuid4().hex[:7].upper()
+        amount = float(payload.get('amount') or 0)
+        wallet_id = payload.get('wallet_id')
+        invoice = {
+            'invoice_id': invoice_id,
+            'state': 'PENDING',
+            'provider': 'M-PESA',
+            'value': amount,
+            'account': payload.get('phone_number'),
+            'api_ref': payload.get('api_ref'),
+            'currency': payload.get('currency', 'KES'),
+            'created_at': datetime.now().isoformat()
+        }
+
+        def settle():
+            # The customer answers the prompt (or not) a little later
+            if random.random() < self.stk_fail_rate:
+                self.send_webhook({**invoice, 'event': 'FAILED', 'state': 'FAILED',
+                                   'failed_reason': 'Request cancelled by user'}, delay=False)
+                return
+            if wallet_id in self.wallets:
+                self.credit(wallet_id, amount, narrative=payload.get('narrative') or 'M-Pesa deposit')
+                self.send_webhook({'event': 'wallet.topup', 'wallet_id': wallet_id,
+                                   'amount': amount, 'currency': invoice['currency'],
+                                   'status': 'completed', 'invoice_id': invoice_id}, delay=False)
+            self.send_webhook({**invoice, 'event': 'COMPLETE', 'state': 'COMPLETE'}, delay=False)
+
+        threading.Timer(self.webhook_delay, settle).start()
+        return {'invoice': invoice, 'customer': {'phone_number': payload.get('phone_number'),
+                                                 'email': payload.get('email')}}
+
+    def send_webhook(self, event, delay=True):
+        if not self.webhook_url:
+            return
+        copies = 2 if random.random() < self.duplicate_rate else 1
+        for _ in range(copies):
+            self._webhooks.submit(self._deliver, event, self.webhook_delay if delay else 0)
+
+    def _deliver(self, event, delay):
+        time.sleep(delay)
+        for attempt in range(5):
+            try:
+                response = requests.post(self.webhook_url, json=event, timeout=10)
+                if response.status_code < 500:
+                    return
+            except requests.RequestException:
+                pass
+            time.sleep(2 ** attempt)
+        print(f"[ERROR] Could not deliver {event.get('event')} webhook to {self.webhook_url}")
+
+
+def create_app(provider=None, latency=None, error_rate=0.0, error_status=500,
+               hang_rate=0.0, hang_seconds=60.0, rate_limit=0.0):
+    """Flask app serving the fake API; fault injection applies to /api/v1 only"""
+    provider = provider or FakeIntaSend()
+    sample_latency = parse_latency(latency)
+    limiter = RateLimiter(rate_limit)
+    app = Flask(__name__)
+    app.config['provider'] = provider
+
+    @app.before_request
+    def inject_faults():
+        if not request.path.startswith(API_PREFIX):
+            return None
+        if 'Authorization' not in request.headers:
+            return jsonify({'detail': 'Authentication credentials were not provided.'}), 401
+
+        wait = limiter.try_acquire()
+        if wait:
+            response = jsonify({'detail': 'Request was throttled.'})
+            response.headers['Retry-After'] = str(max(1, math.ceil(wait)))
+            return response, 429
+
+        time.sleep(sample_latency())
+        if random.random() < hang_rate:
+            time.sleep(hang_seconds)
+        if random.random() < error_rate:
+            return jsonify({'detail': 'Injected failure'}), error_status
+        return None
+
+    def wallet_or_404(wallet_id):
+        wallet = provider.wallets.get(wallet_id)
+        if not wallet:
+            return None, (jsonify({'detail': 'Not found.'}), 404)
+        return wallet, None
+
+    @app.route(f'{API_PREFIX}/wallets/', methods=['GET', 'POST'])
+    def wallets():
+        if request.method == 'POST':
+            data = request.get_json() or {}
+            return jsonify(provider.create_wallet(data.get('label'), data.get('currency', 'KES'),
+                                                  bool(data.get('can_disburse')))), 201
+
+        page = request.args.get('page', 1, type=int)
+        page_size = request.args.get('page_size', 100, type=int)
+        with provider.lock:
+            all_wallets = [dict(w) for w in provider.wallets.values()]
+        start = (page - 1) * page_size
+        has_next = start + page_size < len(all_wallets)
+        return jsonify({
+            'count': len(all_wallets),
+            'next': f'{request.base_url}?page={page + 1}&page_size={page_size}' if has_next else None,
+            'previous': f'{request.base_url}?page={page - 1}&page_size={page_size}' if page > 1 else None,
+            'results': all_wallets[start:start + page_size]
+        })
+
+    @app.route(f'{API_PREFIX}/wallets/<wallet_id>', strict_slashes=False)
+    def wallet_details(wallet_id):
+        wallet, error = wallet_or_404(wallet_id)
+        return error or jsonify(dict(wallet))
+
+    @app.route(f'{API_PREFIX}/wallets/<wallet_id>/transactions', strict_slashes=False)
+    def wallet_transactions(wallet_id):
+        _, error = wallet_or_404(wallet_id)
+        if error:
+            return error
+        with provider.lock:
+            results = list(reversed(provider.transactions[wallet_id]))
+        return jsonify({'count': len(results), 'next': None, 'previous': None, 'results': results})
+
+    @app.route(f'{API_PREFIX}/wallets/<wallet_id>/intra_transfer/', methods=['POST'])
+    def intra_transfer(wallet_id):
+        data = request.get_json() or {}
+        try:
+            amount = float(data.get('amount'))
+        except (TypeError, ValueError):
+            return jsonify({'errors': [{'detail': 'A valid amount is required'}]}), 400
+        result, error = provider.transfer(wallet_id, data.get('wallet_id'), amount,
+                                          data.get('narrative'))
+        if error:
+            return jsonify({'errors': [{'detail': error}]}), 400
+        return jsonify(result)
+
+    @app.route(f'{API_PREFIX}/payment/mpesa-stk-push/', methods=['POST'])
+    def mpesa_stk_push():
+        data = request.get_json() or {}
+        if not data.get('phone_number') or not data.get('amount'):
+            return jsonify({'errors': [{'detail': 'phone_number and amount are required'}]}), 400
+        return jsonify(provider.stk_push(data))
+
+    # Test helpers, outside the API prefix
+    @app.route('/_fake/wallets/<wallet_id>/credit', methods=['POST'])
+    def fake_credit(wallet_id):
+        _, error = wallet_or_404(wallet_id)
+        if error:
+            return error
+        amount = float((request.get_json() or {}).get('amount', 0))
+        return jsonify(provider.credit(wallet_id, amount, narrative='Test credit'))
+
+    @app.route('/_fake/state')
+    def fake_state():
+        with provider.lock:
+            return jsonify({'wallets': len(provider.wallets),
+                            'total_balance': round(sum(w['current_balance']
+                                                       for w in provider.wallets.values()), 2)})
+
+    return app
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run a local IntaSend stand-in')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=int(os.getenv('FAKE_INTASEND_PORT', 8001)))
+    parser.add_argument('--webhook-url', default='http://localhost:5000/webhook/intasend',
+                        help="App webhook endpoint ('' disables webhooks)")
+    parser.add_argument('--webhook-delay', type=float, default=1.0,
+                        help='Seconds before webhooks (and STK push outcomes) are sent')
+    parser.add_argument('--initial-balance', type=float, default=0.0,
+                        help='Balance of newly created wallets')
+    parser.add_argument('--latency', help='Latency distribution, e.g. lognormal:80:600')
+    parser.add_argument('--error-rate', type=float, default=0.0,
+                        help='Fraction of API calls answered with --error-status')
+    parser.add_argument('--error-status', type=int, default=500)
+    parser.add_argument('--hang-rate', type=float, default=0.0,
+                        help='Fraction of API calls that stall for --hang-seconds')
+    parser.add_argument('--hang-seconds', type=float, default=60.0)
+    parser.add_argument('--rate-limit', type=float, default=0.0,
+                        help='API calls per second before answering 429 (0 = unlimited)')
+    parser.add_argument('--stk-fail-rate', type=float, default=0.0,
+                        help='Fraction of STK pushes the customer cancels')
+    parser.add_argument('--duplicate-rate', type=float, default=0.0,
+                        help='Fraction of webhooks delivered twice')
+    args = parser.parse_args()
+
+    fake = FakeIntaSend(webhook_url=args.webhook_url or None, initial_balance=args.initial_balance,
+                        webhook_delay=args.webhook_delay, stk_fail_rate=args.stk_fail_rate,
+                        duplicate_rate=args.duplicate_rate)
+    fake_app = create_app(fake, latency=args.latency, error_rate=args.error_rate,
+                          error_status=args.error_status, hang_rate=args.hang_rate,
+                          hang_seconds=args.hang_seconds, rate_limit=args.rate_limit)
+
+    print(f"Fake IntaSend API on http://{args.host}:{args.port}{API_PREFIX}")
+    print(f"Run the app with INTASEND_BASE_URL=http://{args.host}:{args.port}{API_PREFIX}")
+    fake_app.run(host=args.host, port=args.port, threaded=True)
@@ -0,0 +1,52 @@
+"""
+gunicorn settings for production
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+Each worker is a separate process with its own threads, so the app can use
+every core. Workers use threads (gthread); an open /events stream or long
+poll holds one of them, so each worker serves at most EVENTS_MAX_STREAMS
+of those and keeps the other threads for API requests. With preload the
+app is imported once in the master and forked; database connections, HTTP
+sessions and background threads are recreated in each worker.
+
+Graceful restart: `kill -HUP <master pid>` replaces the workers, letting
+in-flight requests finish. With preload on, new code is only picked up by
+a full restart (or GUNICORN_PRELOAD=false).
+"""
+import os
+
+bind = os.getenv('GUNICORN_BIND', f"0.0.0.0:{os.getenv('FLASK_PORT', 5000)}")
+workers = int(os.getenv('WEB_CONCURRENCY', os.cpu_count() or 1))
+worker_class = 'gthread'
+# Keep this well above EVENTS_MAX_STREAMS (default 8): streams beyond that get a 503
+threads = int(os.getenv('GUNICORN_THREADS', 16))
+preload_app = os.getenv('GUNICORN_PRELOAD', 'true').lower() == 'true'
+
+timeout = int(os.getenv('GUNICORN_TIMEOUT', 60))                  # seconds without a worker heartbeat
+graceful_timeout = int(os.getenv('GUNICORN_GRACEFUL_TIMEOUT', 30))
+keepalive = int(os.getenv('GUNICORN_KEEPALIVE', 5))
+# Recycle workers after this many requests (0 = never)
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', 0))
+max_requests_jitter = int(os.getenv('GUNICORN_MAX_REQUESTS_JITTER', 0))
+
+pidfile = os.getenv('GUNICORN_PIDFILE')
+# The app logs JSON lines itself and /metrics counts requests
+accesslog = os.getenv('GUNICORN_ACCESS_LOG')
+errorlog = '-'
+
+
+def pre_fork(server, worker):
+    # SQLite connections must not be carried into a child process
+    import database
+    database.close_connections()
+
+
+def post_worker_init(worker):
+    from wsgi import init_worker
+    init_worker()
+
+
+def worker_exit(server, worker):
+    import app
+    app.webhook_processor.stop()
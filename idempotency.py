@@ -0,0 +1,186 @@
+"""
+Idempotency-Key handling for POST endpoints that call IntaSend
+
+A client sends the same Idempotency-Key header on every retry of one
+logical request. The first request claims the key and does the work;
+its response is stored in idempotency_keys. A duplicate that arrives
+while the first is still running waits for it, and any later duplicate
+gets the stored response replayed without IntaSend being called again.
+
+Keys are scoped to the endpoint and expire after IDEMPOTENCY_TTL seconds.
+A failed request (an exception or a 5xx) releases its key, so a retry can
+do the work again, only if it sent nothing to IntaSend. Once a payment
+request has gone out, the failure is stored and replayed like any other
+response: a retry must not pay a second time.
+"""
+import os
+import time
+import hashlib
+from functools import wraps
+from flask import request, jsonify, make_response, g, has_request_context
+import database as db
+import metrics
+
+IDEMPOTENCY_TTL = float(os.getenv('IDEMPOTENCY_TTL', 24 * 3600))             # seconds
+IDEMPOTENCY_LOCK_SECONDS = float(os.getenv('IDEMPOTENCY_LOCK_SECONDS', 90))   # seconds
+IDEMPOTENCY_WAIT = float(os.getenv('IDEMPOTENCY_WAIT', 40))                   # seconds
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+
+# How often a waiting duplicate checks whether the first request finished
+_POLL_INTERVAL = 0.05
+# How often each process deletes expired keys
+_PURGE_INTERVAL = 300
+
+_last_purge = 0.0
+
+requests_total = metrics.Counter('idempotency_requests_total',
+                                 'Requests carrying an Idempotency-Key, by endpoint and outcome',
+                                 ('endpoint', 'outcome'))
+
+
+def request_fingerprint():
+    """Hash of the request body, to catch a key reused for a different request"""
+    return hashlib.sha256(request.get_data()).hexdigest()
+
+
+def note_provider_call():
+    """
+    Record that the current request sent a state-changing call to IntaSend
+    (called by the transport), so its key is kept even if the request fails
+    """
+    if has_request_context():
+        g.idempotency_provider_called = True
+
+def _provider_called():
+    return g.get('idempotency_provider_called', False)
+
+
+def purge_expired(now=None):
+    """Delete expired keys; returns how many were removed"""
+    with db.get_db_connection() as conn:
+        cursor = conn.execute('DELETE FROM idempotency_keys WHERE expires_at < ?',
+                              (now or time.time(),))
+        return cursor.rowcount
+
+def _maybe_purge(now):
+    global _last_purge
+    if now - _last_purge >= _PURGE_INTERVAL:
+        _last_purge = now
+        purge_expired(now)
+
+
+def _claim(endpoint, key, fingerprint, now):
+    """Try to become the request that does the work for this key"""
+    with db.transaction() as conn:
+        row = conn.execute('''
+            SELECT fingerprint, status, locked_until, expires_at FROM idempotency_keys
+            WHERE endpoint = ? AND idempotency_key = ?
+        ''', (endpoint, key)).fetchone()
+
+        if row is None or row['expires_at'] < now:
+            conn.execute('''
+                INSERT OR REPLACE INTO idempotency_keys
+                (endpoint, idempotency_key, fingerprint, status, locked_until, expires_at)
+                VALUES (?, ?, ?, 'in_progress', ?, ?)
+            ''', (endpoint, key, fingerprint, now + IDEMPOTENCY_LOCK_SECONDS, now + IDEMPOTENCY_TTL))
+            return True
+        if row['fingerprint'] != fingerprint:
+            return False
+        if row['status'] == 'in_progress' and row['locked_until'] < now:
+            # The request holding the key died without finishing
+            conn.execute('''
+                UPDATE idempotency_keys SET locked_until = ?
+                WHERE endpoint = ? AND idempotency_key = ?
+            ''', (now + IDEMPOTENCY_LOCK_SECONDS, endpoint, key))
+            return True
+        return False
+
+
+def _lookup(endpoint, key):
+    with db.get_db_connection() as conn:
+        return conn.execute('''
+            SELECT fingerprint, status, response_status, response_body, content_type,
+                   locked_until, expires_at
+            FROM idempotency_keys WHERE endpoint = ? AND idempotency_key = ?
+        ''', (endpoint, key)).fetchone()
+
+
+def _store(endpoint, key, response):
+    with db.get_db_connection() as conn:
+        conn.execute('''
+            UPDATE idempotency_keys
+            SET status = 'completed', response_status = ?, response_body = ?, content_type = ?,
+                locked_until = 0
+            WHERE endpoint = ? AND idempotency_key = ?
+        ''', (response.status_code, response.get_data(), response.content_type, endpoint, key))
+
+def _release(endpoint, key):
+    with db.get_db_connection() as conn:
+        conn.execute('DELETE FROM idempotency_keys WHERE endpoint = ? AND idempotency_key = ?',
+                     (endpoint, key))
+
+
+def _replay(row):
+    response = make_response(bytes(row['response_body']), row['response_status'])
+    response.content_type = row['content_type']
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+def idempotent(view):
+    """Honour an Idempotency-Key header on a view; requests without one are unaffected"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get(HEADER)
+        if not key:
+            return view(*args, **kwargs)
+        if len(key) > MAX_KEY_LENGTH:
+            return jsonify({'error': f'{HEADER} must be at most {MAX_KEY_LENGTH} characters'}), 400
+
+        endpoint = request.path
+        fingerprint = request_fingerprint()
+        deadline = time.monotonic() + IDEMPOTENCY_WAIT
+        while True:
+            now = time.time()
+            _maybe_purge(now)
+            # Only take the write lock when the key looks free to claim
+            row = _lookup(endpoint, key)
+            if (row is None or row['expires_at'] < now
+                    or (row['status'] == 'in_progress' and row['locked_until'] < now)):
+                if _claim(endpoint, key, fingerprint, now):
+                    break
+                row = _lookup(endpoint, key)
+                if row is None:
+                    continue
+
+            if row['fingerprint'] != fingerprint:
+                requests_total.inc((endpoint, 'mismatch'))
+                return jsonify({'error': f'{HEADER} was already used for a different request'}), 422
+            if row['status'] == 'completed':
+                requests_total.inc((endpoint, 'replayed'))
+                return _replay(row)
+            if time.monotonic() >= deadline:
+                requests_total.inc((endpoint, 'conflict'))
+                response = jsonify({'error': 'A request with this Idempotency-Key is still in progress'})
+                response.headers['Retry-After'] = '1'
+                return response, 409
+            time.sleep(_POLL_INTERVAL)
+
+        try:
+            response = make_response(view(*args, **kwargs))
+        except Exception:
+            if _provider_called():
+                _store(endpoint, key, make_response(jsonify({'error': 'Internal server error'}), 500))
+            else:
+                _release(endpoint, key)
+            raise
+        if response.status_code >= 500 and not _provider_called():
+            _release(endpoint, key)
+            requests_total.inc((endpoint, 'released'))
+        else:
+            _store(endpoint, key, response)
+            requests_total.inc((endpoint, 'executed'))
+        return response
+    return wrapper
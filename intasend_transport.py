@@ -0,0 +1,223 @@
+"""
+HTTP transport for the IntaSend SDK
+
+The SDK opens a new connection (and TLS handshake) for every call and never
+times out. IntaSendTransport replaces send_request on the SDK's service
+objects with one that uses a pooled keep-alive session, a connect and read
+timeout per kind of operation, and retries for reads. Retries use jittered
+exponential backoff and draw from a retry budget, so an IntaSend outage
+does not multiply our own traffic.
+"""
+import os
+import time
+import random
+import threading
+from functools import partial
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+from intasend.client import get_service_url
+from intasend.exceptions import (IntaSendBadRequest, IntaSendNotAllowed,
+                                 IntaSendServerError, IntaSendUnauthorized)
+import idempotency
+
+# Point the client at another server, e.g. fake_intasend.py (http://localhost:8001/api/v1)
+INTASEND_BASE_URL = os.getenv('INTASEND_BASE_URL')
+INTASEND_POOL_SIZE = int(os.getenv('INTASEND_POOL_SIZE', 20))
+INTASEND_CONNECT_TIMEOUT = float(os.getenv('INTASEND_CONNECT_TIMEOUT', 3.05))   # seconds
+INTASEND_RETRIES = int(os.getenv('INTASEND_RETRIES', 2))
+INTASEND_RETRY_BACKOFF = float(os.getenv('INTASEND_RETRY_BACKOFF', 0.25))       # seconds
+INTASEND_RETRY_BUDGET = float(os.getenv('INTASEND_RETRY_BUDGET', 0.2))          # retries per request
+
+# Read timeout per kind of operation (seconds)
+OPERATION_TIMEOUTS = {
+    'read': float(os.getenv('INTASEND_TIMEOUT_READ', 10)),
+    'transfer': float(os.getenv('INTASEND_TIMEOUT_TRANSFER', 30)),
+    'stk_push': float(os.getenv('INTASEND_TIMEOUT_STK_PUSH', 30)),
+    'write': float(os.getenv('INTASEND_TIMEOUT_WRITE', 20)),
+}
+
+# Responses worth retrying for a read
+RETRY_STATUSES = {429, 502, 503, 504}
+
+
+class IntaSendTimeout(Exception):
+    """
+    A request that changes state failed after it was sent (no answer, a
+    dropped connection, or a gateway error): IntaSend may or may not have
+    carried it out.
+    """
+
+
+def _never_sent(error):
+    """Whether a connection error happened before the request left this host"""
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def _is_error_body(response):
+    """A 500 that IntaSend itself answered with a JSON error, i.e. a definite failure"""
+    try:
+        return isinstance(response.json(), dict)
+    except ValueError:
+        return False
+
+
+class RetryBudget:
+    """
+    Allows retries only up to a fraction of recent requests. Every request
+    earns `ratio` of a retry, every retry spends one; the balance is capped
+    so a quiet period cannot build up a retry storm.
+    """
+
+    def __init__(self, ratio=INTASEND_RETRY_BUDGET, max_tokens=10):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._tokens = max_tokens
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+
+def operation(request_type, service_endpoint):
+    """Classify a call for its timeout"""
+    if request_type == 'GET':
+        return 'read'
+    if 'intra_transfer' in service_endpoint:
+        return 'transfer'
+    if 'mpesa-stk-push' in service_endpoint:
+        return 'stk_push'
+    return 'write'
+
+
+class IntaSendTransport:
+    """Pooled, time-limited replacement for the SDK's send_request"""
+
+    def __init__(self, pool_size=INTASEND_POOL_SIZE, connect_timeout=INTASEND_CONNECT_TIMEOUT,
+                 retries=INTASEND_RETRIES, backoff=INTASEND_RETRY_BACKOFF, budget=None,
+                 base_url=INTASEND_BASE_URL):
+        self.base_url = base_url.rstrip('/') if base_url else None
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.budget = budget or RetryBudget()
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        # Sockets must not be shared with a forked child
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    session = requests.Session()
+                    adapter = HTTPAdapter(pool_connections=2, pool_maxsize=self.pool_size,
+                                          max_retries=0)
+                    session.mount('https://', adapter)
+                    session.mount('http://', adapter)
+                    self._session = session
+                    self._pid = os.getpid()
+        return self._session
+
+    def attach(self, api):
+        """Route every service of an intasend.APIService through this transport"""
+        for service in vars(api).values():
+            if hasattr(service, 'send_request'):
+                service.send_request = partial(self.send_request, service)
+                # Some services wrap another (wallets.collect)
+                for inner in vars(service).values():
+                    if hasattr(inner, 'send_request') and hasattr(inner, 'get_headers'):
+                        inner.send_request = partial(self.send_request, inner)
+        return api
+
+    def url(self, service_endpoint, test):
+        if self.base_url:
+            return f'{self.base_url}/{service_endpoint}'
+        return get_service_url(service_endpoint, test)
+
+    def _delay(self, attempt, response=None):
+        delay = random.uniform(0, self.backoff * (2 ** attempt))
+        retry_after = response.headers.get('Retry-After') if response is not None else None
+        if retry_after and retry_after.isdigit():
+            delay = max(delay, min(float(retry_after), 5.0))
+        return delay
+
+    def send_request(self, service, request_type, service_endpoint, payload, noauth=False):
+        """Same contract as intasend.client.APIBase.send_request"""
+        url = self.url(service_endpoint, service.test)
+        headers = service.get_headers(noauth)
+        op = operation(request_type, service_endpoint)
+        timeout = (self.connect_timeout, OPERATION_TIMEOUTS[op])
+        idempotent = op == 'read'
+
+        self.budget.deposit()
+        attempt = 0
+        while True:
+            if not idempotent:
+                # From here on IntaSend may act on it: an Idempotency-Key must not be released
+                idempotency.note_provider_call()
+            try:
+                response = self.session.request(request_type, url, json=payload,
+                                                headers=headers, timeout=timeout)
+            except requests.ConnectTimeout:
+                # Never reached IntaSend, so even a write is safe to retry
+                if attempt < self.retries and self.budget.withdraw():
+                    time.sleep(self._delay(attempt))
+                    attempt += 1
+                    continue
+                raise
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if idempotent and attempt < self.retries and self.budget.withdraw():
+                    time.sleep(self._delay(attempt))
+                    attempt += 1
+                    continue
+                if not idempotent and not _never_sent(e):
+                    raise IntaSendTimeout(f'No answer from IntaSend to {request_type} '
+                                          f'{service_endpoint}: {e}') from e
+                raise
+
+            if (idempotent and response.status_code in RETRY_STATUSES
+                    and attempt < self.retries and self.budget.withdraw()):
+                time.sleep(self._delay(attempt, response))
+                attempt += 1
+                continue
+            break
+
+        if (not idempotent and response.status_code >= 500
+                and not (response.status_code == 500 and _is_error_body(response))):
+            # A gateway or proxy error says nothing about whether IntaSend acted
+            raise IntaSendTimeout(f'IntaSend answered {request_type} {service_endpoint} '
+                                  f'with HTTP {response.status_code}')
+
+        if response.status_code == 400:
+            raise IntaSendBadRequest(response.text)
+        elif response.status_code == 403:
+            raise IntaSendNotAllowed(response.text)
+        elif response.status_code == 500:
+            raise IntaSendServerError(response.text)
+        elif response.status_code == 401:
+            raise IntaSendUnauthorized(response.text)
+        return response.json()
+
+
+_transport = None
+
+def get_transport():
+    """Process-wide transport shared by every wallet manager"""
+    global _transport
+    if _transport is None:
+        _transport = IntaSendTransport()
+    return _transport
@@ -0,0 +1,121 @@
+"""
+Shared helpers for background batch jobs
+
+Bulk wallet provisioning (provisioning.py) and batch disbursements
+(disbursements.py) both read a CSV or JSON list of rows, record a job with
+one row per entry, and run it on a background thread. The parsing, the
+running-job lease, status updates and the background thread live here.
+
+A job only runs while it holds a lease on its row in the database: the
+run sets the status to 'running' only if no other run holds it, and keeps
+updated_at fresh while it works. So a job runs at most once at a time
+across all server workers and the command line. A run that died leaves
+the job 'running' until JOB_LEASE_SECONDS pass without a heartbeat; then
+it can be resumed.
+"""
+import os
+import csv
+import io
+import json
+import threading
+from contextlib import contextmanager
+import database as db
+import logs
+
+JOB_LEASE_SECONDS = int(os.getenv('JOB_LEASE_SECONDS', 60))
+
+log = logs.get_logger('jobs')
+
+
+def file_format(filename):
+    """'json' for .json files, otherwise 'csv'"""
+    return 'json' if (filename or '').lower().endswith('.json') else 'csv'
+
+
+def parse_rows(payload, fmt='csv', list_key='items'):
+    """
+    Parse an uploaded list. CSV needs a header row; JSON is a list of
+    objects, or an object holding the list under list_key.
+    """
+    if fmt == 'json':
+        data = json.loads(payload) if isinstance(payload, (str, bytes)) else payload
+        if isinstance(data, dict):
+            data = data.get(list_key, [])
+        return [dict(item) for item in data]
+
+    if isinstance(payload, bytes):
+        payload = payload.decode('utf-8-sig')
+    reader = csv.DictReader(io.StringIO(payload))
+    return [{key.strip(): (value or '').strip() for key, value in row.items() if key}
+            for row in reader]
+
+
+def _claim(table, job_id, track_start):
+    """Set a job running unless a live run holds it; True if this call got it"""
+    started = ", started_at = CURRENT_TIMESTAMP" if track_start else ''
+    with db.get_db_connection() as conn:
+        cursor = conn.execute(f'''
+            UPDATE {table}
+            SET status = 'running', updated_at = CURRENT_TIMESTAMP, finished_at = NULL{started}
+            WHERE id = ? AND (status != 'running' OR updated_at < datetime('now', ?))
+        ''', (job_id, f'-{JOB_LEASE_SECONDS} seconds'))
+        return cursor.rowcount == 1
+
+
+def _heartbeat(table, job_id, stop):
+    while not stop.wait(JOB_LEASE_SECONDS / 3):
+        try:
+            with db.get_db_connection() as conn:
+                conn.execute(f'''
+                    UPDATE {table} SET updated_at = CURRENT_TIMESTAMP
+                    WHERE id = ? AND status = 'running'
+                ''', (job_id,))
+        except Exception:
+            log.exception('Job heartbeat failed', extra={'job_id': job_id})
+
+
+@contextmanager
+def running(table, kind, job_id, track_start=False):
+    """
+    Hold a job's lease while the block runs; raises if another run, in any
+    process, holds it. The block must set a final status when it is done.
+    """
+    if not _claim(table, job_id, track_start):
+        with db.get_db_connection() as conn:
+            if not conn.execute(f'SELECT 1 FROM {table} WHERE id = ?', (job_id,)).fetchone():
+                raise ValueError(f'No {kind} job {job_id}')
+        raise RuntimeError(f'{kind.capitalize()} job {job_id} is already running')
+
+    stop = threading.Event()
+    heartbeat = threading.Thread(target=_heartbeat, args=(table, job_id, stop),
+                                 name=f'{kind}-{job_id}-lease', daemon=True)
+    heartbeat.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        heartbeat.join()
+
+
+def set_status(table, job_id, status):
+    """Update a job's status; 'completed' and 'failed' also end its lease"""
+    with db.get_db_connection() as conn:
+        conn.execute(f'''
+            UPDATE {table}
+            SET status = ?, updated_at = CURRENT_TIMESTAMP,
+                finished_at = CASE WHEN ? IN ('completed', 'failed') THEN CURRENT_TIMESTAMP END
+            WHERE id = ?
+        ''', (status, status, job_id))
+
+
+def start_job(kind, run_job, job_id, *args, **kwargs):
+    """Call run_job(job_id, *args, **kwargs) on a background thread"""
+    def target():
+        try:
+            run_job(job_id, *args, **kwargs)
+        except Exception:
+            log.exception(f'{kind.capitalize()} job failed', extra={'job_id': job_id})
+
+    thread = threading.Thread(target=target, name=f'{kind}-{job_id}', daemon=True)
+    thread.start()
+    return thread
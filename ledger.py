@@ -0,0 +1,338 @@
+"""
+Local double-entry ledger for wallet balances
+
+Every movement of money is a ledger transfer with two postings (a debit and
+a credit in integer cents) written in a single SQLite transaction together
+with the running balance of both accounts and the mirrored wallets.balance.
+Transfers start out 'pending' and are confirmed or reversed once IntaSend
+answers, so funds checks never wait on the provider.
+"""
+import json
+import uuid
+from decimal import Decimal, DecimalException, ROUND_HALF_UP
+import database as db
+
+# Counterparty for money entering or leaving the system through IntaSend
+EXTERNAL_ACCOUNT = 'external:intasend'
+
+
+class LedgerError(Exception):
+    """Raised when a ledger operation cannot be applied"""
+
+
+class InsufficientFunds(LedgerError):
+    """Raised when the origin account cannot cover a transfer"""
+
+    def __init__(self, available_cents, required_cents):
+        self.available_cents = available_cents
+        self.required_cents = required_cents
+        super().__init__(
+            f'Insufficient balance. Available: {from_cents(available_cents)} KES, '
+            f'Required: {from_cents(required_cents)} KES'
+        )
+
+
+def to_cents(amount):
+    """Convert a KES amount (float, str or Decimal) to integer cents"""
+    try:
+        return int((Decimal(str(amount)) * 100).quantize(Decimal('1'), rounding=ROUND_HALF_UP))
+    except (DecimalException, ValueError):
+        raise LedgerError(f'Invalid amount: {amount!r}')
+
+def from_cents(cents):
+    """Convert integer cents back to a KES amount"""
+    return cents / 100.0
+
+def new_reference():
+    """Generate a unique ledger transfer reference"""
+    return uuid.uuid4().hex
+
+
+def _apply_posting(cursor, reference, account, amount_cents, pending_cents):
+    """Write one posting and move the account's running balances"""
+    cursor.execute('''
+        INSERT INTO ledger_postings (transfer_ref, account, amount_cents)
+        VALUES (?, ?, ?)
+    ''', (reference, account, amount_cents))
+    _move_balance(cursor, account, amount_cents, pending_cents)
+
+def _move_balance(cursor, account, amount_cents, pending_cents):
+    """Adjust an account's running balances and refresh the wallet mirror"""
+    cursor.execute('''
+        INSERT INTO ledger_balances (account, balance_cents, pending_cents)
+        VALUES (?, ?, ?)
+        ON CONFLICT(account) DO UPDATE SET
+            balance_cents = balance_cents + excluded.balance_cents,
+            pending_cents = pending_cents + excluded.pending_cents
+    ''', (account, amount_cents, pending_cents))
+    if amount_cents:
+        cursor.execute('''
+            UPDATE wallets
+            SET balance = (SELECT balance_cents FROM ledger_balances WHERE account = ?) / 100.0,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE wallet_id = ?
+        ''', (account, account))
+
+
+def get_balance(account):
+    """Get the ledger balance of an account as a dict of cents"""
+    with db.get_db_connection() as conn:
+        row = conn.execute('''
+            SELECT balance_cents, pending_cents FROM ledger_balances WHERE account = ?
+        ''', (account,)).fetchone()
+        if row:
+            return dict(row)
+        return {'balance_cents': 0, 'pending_cents': 0}
+
+def _pending_inbound_cents(cursor, account):
+    """Credits to an account from transfers that may still be reversed"""
+    return cursor.execute('''
+        SELECT COALESCE(SUM(amount_cents), 0) FROM ledger_transfers
+        WHERE status = 'pending' AND to_account = ?
+    ''', (account,)).fetchone()[0]
+
+def _spendable_cents(cursor, account):
+    """Balance minus unconfirmed inbound credits"""
+    row = cursor.execute(
+        'SELECT balance_cents FROM ledger_balances WHERE account = ?', (account,)
+    ).fetchone()
+    return (row['balance_cents'] if row else 0) - _pending_inbound_cents(cursor, account)
+
+def available_balance(account):
+    """Get the spendable balance of an account in KES (settled funds only)"""
+    with db.get_db_connection() as conn:
+        return from_cents(_spendable_cents(conn.cursor(), account))
+
+
+def post_transfer(from_account, to_account, amount, narrative=None, kind='transfer',
+                  status='pending', provider_ref=None, reference=None, allow_overdraft=False):
+    """
+    Check funds and post a transfer between two accounts atomically.
+
+    Returns the transfer reference. Raises InsufficientFunds when the origin
+    account would go negative, unless allow_overdraft is set (used for
+    movements IntaSend has already settled, and for the external account).
+    """
+    amount_cents = to_cents(amount)
+    if amount_cents <= 0:
+        raise LedgerError('Transfer amount must be positive')
+    if from_account == to_account:
+        raise LedgerError('Cannot transfer to the same account')
+    if status not in ('pending', 'confirmed'):
+        raise LedgerError(f'Invalid initial status: {status}')
+
+    reference = reference or new_reference()
+    pending_cents = amount_cents if status == 'pending' else 0
+
+    with db.transaction() as conn:
+        cursor = conn.cursor()
+
+        if not allow_overdraft and from_account != EXTERNAL_ACCOUNT:
+            # Money from a transfer that may still be reversed cannot be spent yet
+            available_cents = _spendable_cents(cursor, from_account)
+            if amount_cents > available_cents:
+                raise InsufficientFunds(available_cents, amount_cents)
+
+        cursor.execute('''
+            INSERT INTO ledger_transfers
+            (reference, kind, from_account, to_account, amount_cents, status, provider_ref, narrative)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', (reference, kind, from_account, to_account, amount_cents, status, provider_ref, narrative))
+
+        _apply_posting(cursor, reference, from_account, -amount_cents, -pending_cents)
+        _apply_posting(cursor, reference, to_account, amount_cents, pending_cents)
+
+    return reference
+
+def confirm_transfer(reference, provider_ref=None):
+    """Mark a pending transfer as settled by IntaSend"""
+    with db.transaction() as conn:
+        cursor = conn.cursor()
+        transfer = cursor.execute(
+            'SELECT * FROM ledger_transfers WHERE reference = ?', (reference,)
+        ).fetchone()
+        if not transfer:
+            raise LedgerError(f'Unknown ledger transfer: {reference}')
+        if transfer['status'] == 'confirmed':
+            return False
+        if transfer['status'] != 'pending':
+            raise LedgerError(f'Cannot confirm a {transfer["status"]} transfer: {reference}')
+
+        amount_cents = transfer['amount_cents']
+        cursor.execute('''
+            UPDATE ledger_transfers
+            SET status = 'confirmed', provider_ref = COALESCE(?, provider_ref),
+                updated_at = CURRENT_TIMESTAMP
+            WHERE reference = ?
+        ''', (provider_ref, reference))
+        _move_balance(cursor, transfer['from_account'], 0, amount_cents)
+        _move_balance(cursor, transfer['to_account'], 0, -amount_cents)
+        return True
+
+def reverse_transfer(reference, reason=None):
+    """Undo a pending transfer that IntaSend rejected, with compensating postings"""
+    with db.transaction() as conn:
+        cursor = conn.cursor()
+        transfer = cursor.execute(
+            'SELECT * FROM ledger_transfers WHERE reference = ?', (reference,)
+        ).fetchone()
+        if not transfer:
+            raise LedgerError(f'Unknown ledger transfer: {reference}')
+        if transfer['status'] == 'reversed':
+            return False
+        if transfer['status'] != 'pending':
+            raise LedgerError(f'Cannot reverse a {transfer["status"]} transfer: {reference}')
+
+        amount_cents = transfer['amount_cents']
+        cursor.execute('''
+            UPDATE ledger_transfers
+            SET status = 'reversed', narrative = COALESCE(?, narrative),
+                updated_at = CURRENT_TIMESTAMP
+            WHERE reference = ?
+        ''', (reason, reference))
+        reversal_ref = f'reversal:{reference}'
+        _apply_posting(cursor, reversal_ref, transfer['from_account'], amount_cents, amount_cents)
+        _apply_posting(cursor, reversal_ref, transfer['to_account'], -amount_cents, -amount_cents)
+        return True
+
+
+def find_transfer(reference=None, provider_ref=None):
+    """Look up a ledger transfer by its reference or IntaSend tracking ID"""
+    with db.get_db_connection() as conn:
+        if reference:
+            row = conn.execute(
+                'SELECT * FROM ledger_transfers WHERE reference = ?', (reference,)
+            ).fetchone()
+        elif provider_ref:
+            row = conn.execute(
+                'SELECT * FROM ledger_transfers WHERE provider_ref = ? ORDER BY id LIMIT 1',
+                (provider_ref,)
+            ).fetchone()
+        else:
+            return None
+        return dict(row) if row else None
+
+def find_pending_transfer(from_account, to_account, amount):
+    """Find the oldest pending transfer matching an IntaSend transfer event"""
+    with db.get_db_connection() as conn:
+        row = conn.execute('''
+            SELECT * FROM ledger_transfers
+            WHERE status = 'pending' AND from_account = ? AND to_account = ? AND amount_cents = ?
+            ORDER BY id LIMIT 1
+        ''', (from_account, to_account, to_cents(amount))).fetchone()
+        return dict(row) if row else None
+
+
+def record_deposit(wallet_id, amount, provider_ref=None, narrative=None):
+    """Credit a wallet with money IntaSend has already received"""
+    return post_transfer(EXTERNAL_ACCOUNT, wallet_id, amount, narrative=narrative,
+                         kind='deposit', status='confirmed', provider_ref=provider_ref,
+                         allow_overdraft=True)
+
+def _accounts_with_pending(cursor, accounts):
+    """Those of the accounts that have a pending transfer in either direction"""
+    return {row[0] for row in cursor.execute('''
+        SELECT from_account FROM ledger_transfers
+        WHERE status = 'pending' AND from_account IN (SELECT value FROM json_each(?1))
+        UNION
+        SELECT to_account FROM ledger_transfers
+        WHERE status = 'pending' AND to_account IN (SELECT value FROM json_each(?1))
+    ''', (json.dumps(accounts),))}
+
+def _differences(cursor, provider_balances):
+    """
+    Provider minus ledger balance, in cents, for each account that differs.
+
+    Accounts with pending transfers are skipped: IntaSend may already have
+    executed a transfer the ledger still shows as pending (e.g. after a
+    timeout), so its balance cannot be compared until the transfer settles.
+    """
+    accounts = list(provider_balances)
+    current = {row['account']: row['balance_cents'] for row in cursor.execute('''
+        SELECT account, balance_cents FROM ledger_balances
+        WHERE account IN (SELECT value FROM json_each(?))
+    ''', (json.dumps(accounts),))}
+    deferred = _accounts_with_pending(cursor, accounts)
+
+    differences = {}
+    for account, provider_balance in provider_balances.items():
+        if account in deferred:
+            continue
+        difference = to_cents(provider_balance) - current.get(account, 0)
+        if difference:
+            differences[account] = difference
+    return differences
+
+def reconcile(wallet_id, provider_balance):
+    """
+    Bring an account in line with the balance IntaSend reports.
+
+    Any difference is posted as a confirmed adjustment against the external
+    account. Accounts with pending transfers are left alone until those
+    settle. Returns the adjustment in cents.
+    """
+    return reconcile_many({wallet_id: provider_balance}).get(wallet_id, 0)
+
+def reconcile_many(provider_balances):
+    """
+    Reconcile many accounts using batched statements.
+
+    provider_balances maps wallet_id to the balance IntaSend reports. The
+    comparison is read-only; a write transaction is only opened when some
+    account needs an adjustment. Returns {wallet_id: adjustment in cents}
+    for the accounts that were adjusted.
+    """
+    provider_balances = dict(provider_balances)
+    if not provider_balances:
+        return {}
+
+    with db.get_db_connection() as conn:
+        if not _differences(conn.cursor(), provider_balances):
+            return {}
+
+    with db.transaction() as conn:
+        cursor = conn.cursor()
+        # Re-check under the write lock; a transfer may have started meanwhile
+        differences = _differences(cursor, provider_balances)
+
+        transfers, postings, balance_moves, changed = [], [], [], []
+        for account, difference in differences.items():
+            reference = new_reference()
+            if difference > 0:
+                from_account, to_account, amount_cents = EXTERNAL_ACCOUNT, account, difference
+            else:
+                from_account, to_account, amount_cents = account, EXTERNAL_ACCOUNT, -difference
+            transfers.append((reference, 'adjustment', from_account, to_account, amount_cents,
+                              'confirmed', None, 'Reconciled with IntaSend'))
+            postings.append((reference, from_account, -amount_cents))
+            postings.append((reference, to_account, amount_cents))
+            balance_moves.append((account, difference, 0))
+            balance_moves.append((EXTERNAL_ACCOUNT, -difference, 0))
+            changed.append((account, account))
+
+        if not changed:
+            return {}
+
+        cursor.executemany('''
+            INSERT INTO ledger_transfers
+            (reference, kind, from_account, to_account, amount_cents, status, provider_ref, narrative)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', transfers)
+        cursor.executemany('''
+            INSERT INTO ledger_postings (transfer_ref, account, amount_cents)
+            VALUES (?, ?, ?)
+        ''', postings)
+        cursor.executemany('''
+            INSERT INTO ledger_balances (account, balance_cents, pending_cents)
+            VALUES (?, ?, ?)
+            ON CONFLICT(account) DO UPDATE SET
+                balance_cents = balance_cents + excluded.balance_cents,
+                pending_cents = pending_cents + excluded.pending_cents
+        ''', balance_moves)
+        cursor.executemany('''
+            UPDATE wallets
+            SET balance = (SELECT balance_cents FROM ledger_balances WHERE account = ?) / 100.0,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE wallet_id = ?
+        ''', changed)
+        return differences
@@ -0,0 +1,147 @@
+"""
+Structured, non-blocking logging
+
+Log calls put the record on an in-memory queue and return; a background
+listener thread formats each record as one JSON line and writes it out.
+A slow stdout or pipe then delays only the listener, never a request
+thread. When the queue is full records are dropped (and counted) rather
+than blocking.
+
+Extra fields become JSON keys:
+
+    log.info('Wallet created', extra={'wallet_id': wallet_id})
+
+Verbose records (full provider responses, webhook payloads) are marked
+with 'sample': True and only LOG_SAMPLE_RATE of them are kept.
+"""
+import os
+import sys
+import json
+import queue
+import atexit
+import random
+import logging
+import threading
+import traceback
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+import serializers
+import metrics
+
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'json')                  # json or text
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', 0.01))
+
+# Attributes every LogRecord has; anything else came from `extra`
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {'message', 'asctime', 'taskName'}
+
+dropped = metrics.Counter('log_records_dropped_total', 'Log records dropped because the log queue was full')
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line: time, level, logger, message and extra fields"""
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and key != 'sample':
+                entry[key] = value
+        if record.exc_info:
+            entry['exception'] = ''.join(traceback.format_exception(*record.exc_info)).rstrip()
+        try:
+            return serializers.dumps(entry)
+        except TypeError:
+            return json.dumps(entry, default=str, separators=(',', ':'))
+
+
+class SampleFilter(logging.Filter):
+    """Keep only a fraction of records marked as verbose"""
+
+    def __init__(self, rate=LOG_SAMPLE_RATE):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if getattr(record, 'sample', False):
+            return random.random() < self.rate
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Queue handler that never blocks the caller. The listener thread is
+    started lazily and again after a fork, since threads do not survive one.
+    """
+
+    def __init__(self, log_queue, outputs):
+        super().__init__(log_queue)
+        self.outputs = outputs
+        self._listener = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_listener(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid != os.getpid():
+                self.queue = queue.Queue(self.queue.maxsize)
+                self._listener = QueueListener(self.queue, *self.outputs, respect_handler_level=True)
+                self._listener.start()
+                self._pid = os.getpid()
+
+    def prepare(self, record):
+        # Format the message now; the arguments may change after the call returns
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        self._ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            dropped.inc()
+
+    def stop(self):
+        """Flush queued records and stop the listener"""
+        with self._lock:
+            if self._listener is not None and self._pid == os.getpid():
+                self._listener.stop()
+            self._listener = None
+            self._pid = None
+
+
+_handler = None
+
+def configure():
+    """Route all logging through the queue (idempotent)"""
+    global _handler
+    if _handler is not None:
+        return _handler
+
+    output = logging.StreamHandler(sys.stdout)
+    if LOG_FORMAT == 'text':
+        output.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    else:
+        output.setFormatter(JsonFormatter())
+
+    _handler = DroppingQueueHandler(queue.Queue(LOG_QUEUE_SIZE), [output])
+    _handler.addFilter(SampleFilter())
+
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    root.handlers = [_handler]
+    atexit.register(_handler.stop)
+    return _handler
+
+
+def get_logger(name):
+    configure()
+    return logging.getLogger(name)
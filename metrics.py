@@ -0,0 +1,180 @@
+"""
+In-process metrics in Prometheus text format
+
+Counters and histograms for HTTP routes, IntaSend calls, database
+functions and webhook events, served at /metrics. Values are kept per
+process; with several server processes each one reports its own.
+"""
+import time
+import threading
+from functools import wraps
+from contextlib import contextmanager
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Counter:
+    """Monotonic count per label set"""
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, labels=(), amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} counter']
+        with self._lock:
+            for labels, value in sorted(self._values.items()):
+                lines.append(f'{self.name}{_format_labels(self.labelnames, labels)} {value}')
+        return lines
+
+
+class Gauge:
+    """Value read from a callback at scrape time"""
+
+    def __init__(self, name, help_text, callback):
+        self.name = name
+        self.help = help_text
+        self.callback = callback
+        _registry.append(self)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} gauge']
+        try:
+            lines.append(f'{self.name} {float(self.callback())}')
+        except Exception:
+            pass
+        return lines
+
+
+class Histogram:
+    """Bucketed distribution of observed values per label set"""
+
+    def __init__(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._series = {}      # labels -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def observe(self, labels, value):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            snapshot = {labels: list(series) for labels, series in self._series.items()}
+        bounds = [f'le="{bound}"' for bound in self.buckets] + ['le="+Inf"']
+        for labels, series in sorted(snapshot.items()):
+            cumulative = 0
+            overflow = series[-1] - sum(series[:-2])     # above the largest bucket
+            for bound, count in zip(bounds, series[:-2] + [overflow]):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{_format_labels(self.labelnames, labels, bound)} '
+                             f'{cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labelnames, labels)} {series[-2]}')
+            lines.append(f'{self.name}_count{_format_labels(self.labelnames, labels)} {series[-1]}')
+        return lines
+
+
+def render():
+    """All metrics in Prometheus text exposition format"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+http_requests = Counter('http_requests_total', 'HTTP requests by route, method and status',
+                        ('method', 'route', 'status'))
+http_duration = Histogram('http_request_duration_seconds', 'HTTP request latency',
+                          ('method', 'route', 'status'))
+intasend_duration = Histogram('intasend_call_duration_seconds', 'IntaSend call latency by manager method',
+                              ('method',), buckets=DEFAULT_BUCKETS + (30.0,))
+intasend_errors = Counter('intasend_call_errors_total', 'Failed IntaSend calls by manager method and error',
+                          ('method', 'error'))
+db_duration = Histogram('db_function_duration_seconds', 'Time spent in database.py functions',
+                        ('function',), buckets=(0.0001, 0.00025, 0.0005) + DEFAULT_BUCKETS)
+webhooks_received = Counter('webhook_events_received_total', 'Webhook deliveries by event type',
+                            ('event', 'duplicate'))
+webhooks_processed = Counter('webhook_events_processed_total', 'Webhook events handled by type and outcome',
+                             ('event', 'outcome'))
+
+
+def timed(function):
+    """Record a database function's duration"""
+    name = function.__name__
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            db_duration.observe((name,), time.perf_counter() - started)
+    return wrapper
+
+
+@contextmanager
+def intasend_call(method):
+    """Record the latency and any error of one IntaSend call"""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        intasend_errors.inc((method, type(e).__name__))
+        raise
+    finally:
+        intasend_duration.observe((method,), time.perf_counter() - started)
+
+
+def init_app(app):
+    """Time every request by its route pattern (not the raw path)"""
+    from flask import g, request
+
+    @app.before_request
+    def _start_timer():
+        g.metrics_started = time.perf_counter()
+
+    @app.after_request
+    def _record(response):
+        started = g.pop('metrics_started', None)
+        if started is not None:
+            route = request.url_rule.rule if request.url_rule else 'unmatched'
+            labels = (request.method, route, str(response.status_code))
+            http_requests.inc(labels)
+            # Streamed responses are timed up to their first byte
+            http_duration.observe(labels, time.perf_counter() - started)
+        return response
@@ -0,0 +1,289 @@
+"""
+Bulk wallet provisioning for student intakes
+
+A provisioning job takes a CSV or JSON list of students, creates their
+IntaSend wallets concurrently under a rate limit, and saves the results in
+batched transactions. Every student is tracked as a row with its own
+status. Each wallet_id IntaSend returns is written to its row straight
+away ('provisioned'), so an interrupted job can be resumed without
+creating a second IntaSend wallet: provisioned rows are only saved
+locally, and only the remaining rows are attempted again.
+
+Usage:
+    python provisioning.py students.csv        # create and run a job
+    python provisioning.py --resume JOB_ID     # continue an interrupted job
+    python provisioning.py --status JOB_ID     # show job progress
+"""
+import os
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from rate_limiter import RateLimiter
+import database as db
+import jobs
+import logs
+
+PROVISION_WORKERS = int(os.getenv('PROVISION_WORKERS', 8))
+PROVISION_RATE_LIMIT = float(os.getenv('PROVISION_RATE_LIMIT', 10))    # wallets per second
+PROVISION_BATCH_SIZE = int(os.getenv('PROVISION_BATCH_SIZE', 100))
+
+log = logs.get_logger('provisioning')
+
+
+def create_job(students, source=None):
+    """Record a provisioning job and one pending row per student; returns the job id"""
+    rows = []
+    for row_no, student in enumerate(students, start=1):
+        student_id = str(student.get('student_id') or '').strip()
+        student_name = str(student.get('student_name') or '').strip()
+        status, error = 'pending', None
+        if not student_id or not student_name:
+            status, error = 'failed', 'student_id and student_name are required'
+        rows.append((row_no, student_id or None, student_name or None,
+                     student.get('phone') or None, student.get('email') or None, status, error))
+
+    with db.get_db_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute('INSERT INTO provisioning_jobs (source, total) VALUES (?, ?)',
+                       (source, len(rows)))
+        job_id = cursor.lastrowid
+        cursor.executemany('''
+            INSERT INTO provisioning_rows
+            (job_id, row_no, student_id, student_name, phone, email, status, error)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        ''', [(job_id,) + row for row in rows])
+
+        # The same student listed twice in one file is only provisioned once
+        cursor.execute('''
+            UPDATE provisioning_rows
+            SET status = 'failed', error = 'Duplicate student_id in this job'
+            WHERE job_id = ? AND status = 'pending' AND row_no NOT IN (
+                SELECT MIN(row_no) FROM provisioning_rows
+                WHERE job_id = ? AND student_id IS NOT NULL GROUP BY student_id
+            )
+        ''', (job_id, job_id))
+    return job_id
+
+
+def _set_job_status(job_id, status):
+    jobs.set_status('provisioning_jobs', job_id, status)
+
+def _mark_rows(rows):
+    """rows: (status, wallet_id, error, row id) tuples"""
+    with db.get_db_connection() as conn:
+        conn.executemany('''
+            UPDATE provisioning_rows
+            SET status = ?, wallet_id = COALESCE(?, wallet_id), error = ?,
+                updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', rows)
+
+
+def _save_batch(created):
+    """Insert a batch of newly created wallets and mark their rows, in one transaction"""
+    with db.transaction():
+        # Someone may have created one of these students since the job started
+        existing = db.get_existing_student_ids(row['student_id'] for row, _ in created)
+        fresh = [(row, wallet_id) for row, wallet_id in created if row['student_id'] not in existing]
+
+        db.add_wallets([{
+            'student_id': row['student_id'],
+            'student_name': row['student_name'],
+            'wallet_id': wallet_id,
+            'phone': row['phone'],
+            'email': row['email']
+        } for row, wallet_id in fresh])
+        db.add_transactions([{
+            'transaction_type': 'wallet_created',
+            'amount': 0,
+            'status': 'completed',
+            'student_id': row['student_id'],
+            'description': f'Wallet created for {row["student_name"]}'
+        } for row, _ in fresh])
+
+        _mark_rows([('created', wallet_id, None, row['id']) for row, wallet_id in fresh] +
+                   [('exists', wallet_id, f'Student already has a wallet; IntaSend wallet {wallet_id} is unused',
+                     row['id']) for row, wallet_id in created if row['student_id'] in existing])
+
+
+def _record_wallet(row, wallet_id):
+    """Remember an IntaSend wallet as soon as it exists, before it is saved locally"""
+    with db.get_db_connection() as conn:
+        conn.execute('''
+            UPDATE provisioning_rows
+            SET status = 'provisioned', wallet_id = ?, error = NULL, updated_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        ''', (wallet_id, row['id']))
+
+
+def run_job(job_id, wallet_manager, workers=PROVISION_WORKERS, rate=PROVISION_RATE_LIMIT,
+            batch_size=PROVISION_BATCH_SIZE, retry_failed=False, progress=None):
+    """
+    Provision every pending row of a job. Safe to call again to resume:
+    rows that already have a wallet are skipped, and rows whose IntaSend
+    wallet was created but not saved are saved without calling IntaSend.
+    With retry_failed, rows that failed on a previous run are attempted
+    again. Raises RuntimeError while another run, in any process, holds
+    the job.
+    """
+    with jobs.running('provisioning_jobs', 'provisioning', job_id):
+        try:
+            statuses = ('pending', 'provisioned') + (('failed',) if retry_failed else ())
+            with db.get_db_connection() as conn:
+                rows = [dict(row) for row in conn.execute(f'''
+                    SELECT * FROM provisioning_rows
+                    WHERE job_id = ? AND status IN ({','.join('?' * len(statuses))})
+                      AND student_id IS NOT NULL AND student_name IS NOT NULL
+                    ORDER BY row_no
+                ''', (job_id,) + statuses)]
+
+            # Wallets IntaSend created on an earlier run only need saving
+            created = [(row, row['wallet_id']) for row in rows if row['status'] == 'provisioned']
+            rows = [row for row in rows if row['status'] != 'provisioned']
+
+            # Students that already have a wallet need no IntaSend call
+            existing = db.get_existing_student_ids(row['student_id'] for row in rows)
+            if existing:
+                _mark_rows([('exists', None, None, row['id'])
+                            for row in rows if row['student_id'] in existing])
+            rows = [row for row in rows if row['student_id'] not in existing]
+
+            limiter = RateLimiter(rate)
+            unsaved = 0
+
+            def provision(row):
+                limiter.acquire()
+                wallet = wallet_manager.create_wallet(label=row['student_id'], currency='KES',
+                                                      can_disburse=True)
+                if not wallet or 'wallet_id' not in wallet:
+                    raise RuntimeError('IntaSend did not return a wallet_id')
+                _record_wallet(row, wallet['wallet_id'])
+                return wallet['wallet_id']
+
+            def save(batch):
+                # A failed batch stays 'provisioned' and is saved on resume
+                nonlocal unsaved
+                try:
+                    _save_batch(batch)
+                except Exception:
+                    unsaved += len(batch)
+                    log.exception('Saving provisioned wallets failed', extra={'job_id': job_id})
+
+            failed = []
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = {pool.submit(provision, row): row for row in rows}
+                for future in as_completed(futures):
+                    row = futures[future]
+                    try:
+                        created.append((row, future.result()))
+                    except Exception as e:
+                        failed.append(('failed', None, str(e), row['id']))
+
+                    if len(created) >= batch_size:
+                        save(created)
+                        created = []
+                    if len(failed) >= batch_size:
+                        _mark_rows(failed)
+                        failed = []
+                    if progress:
+                        progress(job_id)
+
+            if created:
+                save(created)
+            if failed:
+                _mark_rows(failed)
+
+            _set_job_status(job_id, 'failed' if unsaved else 'completed')
+            return job_status(job_id)
+        except Exception:
+            _set_job_status(job_id, 'failed')
+            raise
+
+
+def start_job(job_id, wallet_manager, **kwargs):
+    """Run a job on a background thread"""
+    return jobs.start_job('provisioning', run_job, job_id, wallet_manager, **kwargs)
+
+
+def job_status(job_id, row_status=None, after=0, limit=100):
+    """
+    Get a job's progress, with per-row results. Rows can be filtered by
+    status and paged by row number.
+    """
+    with db.get_db_connection() as conn:
+        job = conn.execute('SELECT * FROM provisioning_jobs WHERE id = ?', (job_id,)).fetchone()
+        if not job:
+            return None
+        counts = {row['status']: row['n'] for row in conn.execute('''
+            SELECT status, COUNT(*) AS n FROM provisioning_rows WHERE job_id = ? GROUP BY status
+        ''', (job_id,))}
+
+        query = '''
+            SELECT row_no, student_id, student_name, status, wallet_id, error
+            FROM provisioning_rows WHERE job_id = ? AND row_no > ?
+        '''
+        params = [job_id, after]
+        if row_status:
+            query += ' AND status = ?'
+            params.append(row_status)
+        query += ' ORDER BY row_no LIMIT ?'
+        params.append(limit)
+        rows = [dict(row) for row in conn.execute(query, params)]
+
+    result = dict(job)
+    result['counts'] = counts
+    result['rows'] = rows
+    result['next_after'] = rows[-1]['row_no'] if rows and len(rows) == limit else None
+    return result
+
+
+def _print_status(status):
+    counts = status['counts']
+    done = sum(n for s, n in counts.items() if s != 'pending')
+    print(f"Job {status['id']} [{status['status']}]: {done}/{status['total']} processed - "
+          + ', '.join(f"{s}: {n}" for s, n in sorted(counts.items())))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Provision student wallets in bulk')
+    parser.add_argument('file', nargs='?', help='CSV or JSON file of students')
+    parser.add_argument('--resume', type=int, metavar='JOB_ID', help='Resume an existing job')
+    parser.add_argument('--status', type=int, metavar='JOB_ID', help='Show job progress')
+    parser.add_argument('--retry-failed', action='store_true', help='Also retry failed rows')
+    parser.add_argument('--workers', type=int, default=PROVISION_WORKERS)
+    parser.add_argument('--rate', type=float, default=PROVISION_RATE_LIMIT,
+                        help='Max wallets created per second (0 = unlimited)')
+    parser.add_argument('--batch-size', type=int, default=PROVISION_BATCH_SIZE)
+    args = parser.parse_args()
+
+    if args.status:
+        status = job_status(args.status, row_status='failed')
+        if not status:
+            parser.exit(1, f"No provisioning job {args.status}\n")
+        _print_status(status)
+        for row in status['rows']:
+            print(f"  row {row['row_no']} {row['student_id']}: {row['error']}")
+        parser.exit()
+
+    if args.resume:
+        job_id = args.resume
+    elif args.file:
+        with open(args.file, 'rb') as f:
+            students = jobs.parse_rows(f.read(), jobs.file_format(args.file), 'students')
+        job_id = create_job(students, source=os.path.basename(args.file))
+        print(f"Created provisioning job {job_id} with {len(students)} student(s)")
+    else:
+        parser.error('a student file, --resume or --status is required')
+
+    from wallet_manager import UniversityWalletManager
+
+    last_report = [0.0]
+
+    def report(job_id):
+        if time.monotonic() - last_report[0] >= 5:
+            last_report[0] = time.monotonic()
+            _print_status(job_status(job_id, limit=0))
+
+    result = run_job(job_id, UniversityWalletManager(), workers=args.workers, rate=args.rate,
+                     batch_size=args.batch_size, retry_failed=args.retry_failed, progress=report)
+    _print_status(result)
@@ -16,8 +16,9 @@ def show_wallets():
         print(f"  Balance: {wallet['balance']} KES")
         print(f"  Wallet ID: {wallet['wallet_id']}")
         print(f"  Created: {wallet['created_at']}")
-    print(f"\nTotal wallets: {len(wallets)}")
-    print(f"Total balance: {sum(w['balance'] for w in wallets)} KES")
+    stats = db.get_stats()
+    print(f"\nTotal wallets: {stats['wallet_count']}")
+    print(f"Total balance: {stats['total_balance']} KES")
 
 def show_transactions(limit=10):
     """Show recent transactions"""
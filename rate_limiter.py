@@ -0,0 +1,51 @@
+"""
+Token-bucket rate limiter shared by the bulk IntaSend jobs
+"""
+import time
+import threading
+
+
+class RateLimiter:
+    """
+    Allows up to `rate` operations per second on average, with bursts of
+    up to `burst` operations. acquire() blocks until a token is available;
+    try_acquire() never blocks.
+    A rate of 0 or less disables limiting.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(1.0, self.rate))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _take(self):
+        """Take a token if one is available; otherwise return the wait for one"""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0.0
+            return (1 - self._tokens) / self.rate
+
+    def acquire(self):
+        """Wait until one operation is allowed"""
+        if self.rate <= 0:
+            return
+        while True:
+            wait = self._take()
+            if not wait:
+                return
+            time.sleep(wait)
+
+    def try_acquire(self):
+        """
+        Take a token without waiting. Returns 0 on success, otherwise the
+        seconds until a token will be available.
+        """
+        if self.rate <= 0:
+            return 0.0
+        return self._take()
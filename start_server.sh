@@ -30,7 +30,7 @@ source venv/Scripts/activate
 
 echo ""
 echo "Starting server..."
-echo "Server will run on http://localhost:5000
+echo "Server will run on http://localhost:5000"
 echo "Webhook endpoint: http://localhost:5000/webhook/intasend"
 echo "To expose via ngrok, open a new terminal and run:"
 echo "  ngrok http 5000"
@@ -38,4 +38,10 @@ echo ""
 echo "Press Ctrl+C to stop the server"
 echo ""
 
-python app.py
+# gunicorn runs several worker processes; it is not available on Windows,
+# where (or with --dev) the Flask development server is used instead
+if [ "$1" != "--dev" ] && command -v gunicorn > /dev/null; then
+    exec gunicorn -c gunicorn.conf.py wsgi:app
+else
+    python app.py
+fi
@@ -1,62 +1,137 @@
 """
 Sync all wallet balances from IntaSend
 Use this if webhooks are not working
+
+Balances are pulled through the paged wallet listing first; any wallets it
+does not cover are fetched individually by a bounded, rate-limited worker
+pool. Results are reconciled into the ledger in chunks, each committed on
+its own, so an interrupted run keeps everything synced so far.
+
+Usage: python sync_balances.py [--workers N] [--rate N] [--chunk-size N] [--no-bulk]
 """
-import sqlite3
+import os
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from wallet_manager import UniversityWalletManager
+from rate_limiter import RateLimiter
+import database as db
+import ledger
+
+SYNC_WORKERS = int(os.getenv('SYNC_WORKERS', 16))
+SYNC_RATE_LIMIT = float(os.getenv('SYNC_RATE_LIMIT', 20))    # requests per second
+SYNC_CHUNK_SIZE = int(os.getenv('SYNC_CHUNK_SIZE', 200))
+
+
+class _ChunkWriter:
+    """Buffers fetched balances and reconciles them a chunk at a time"""
+
+    def __init__(self, chunk_size):
+        self.chunk_size = chunk_size
+        self.buffer = {}
+        self.synced = 0
+        self.changed = 0
+
+    def add(self, wallet_id, balance):
+        self.buffer[wallet_id] = balance
+        if len(self.buffer) >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        self.changed += len(ledger.reconcile_many(self.buffer))
+        self.synced += len(self.buffer)
+        self.buffer = {}
+
+
+def _fetch_bulk(wm, wanted, writer):
+    """Pull balances from the paged wallet listing; returns wallet_ids found"""
+    found = set()
+    for page in wm.iter_wallet_pages():
+        for wallet in page:
+            wallet_id = wallet.get('wallet_id')
+            if wallet_id in wanted and wallet_id not in found:
+                found.add(wallet_id)
+                writer.add(wallet_id, wallet.get('current_balance', 0))
+    return found
 
-def sync_all_balances():
+
+def _fetch_one(wm, limiter, wallet_id):
+    limiter.acquire()
+    balance_info = wm.get_wallet_balance(wallet_id)
+    return balance_info.get('current_balance', 0) if balance_info else None
+
+
+def sync_all_balances(workers=SYNC_WORKERS, rate=SYNC_RATE_LIMIT,
+                      chunk_size=SYNC_CHUNK_SIZE, use_bulk=True):
     """Sync all wallet balances from IntaSend"""
 
     wm = UniversityWalletManager()
-
-    # Connect to database
-    conn = sqlite3.connect('wallet_system.db')
-    conn.row_factory = sqlite3.Row
-    cur = conn.cursor()
+    started = time.monotonic()
 
     # Get all wallets
-    wallets = cur.execute('SELECT * FROM wallets').fetchall()
+    with db.get_db_connection() as conn:
+        wanted = {row['wallet_id'] for row in conn.execute('SELECT wallet_id FROM wallets')}
 
     print("="*60)
-    print("Syncing wallet balances from IntaSend...")
+    print(f"Syncing {len(wanted)} wallet balances from IntaSend...")
     print("="*60)
 
-    for wallet in wallets:
-        student_id = wallet['student_id']
-        wallet_id = wallet['wallet_id']
-        old_balance = wallet['balance']
-
-        # Get live balance from IntaSend
-        balance_info = wm.get_wallet_balance(wallet_id)
+    writer = _ChunkWriter(chunk_size)
+    failed = []
 
-        if balance_info:
-            new_balance = balance_info.get('current_balance', 0)
+    found = set()
+    if use_bulk:
+        try:
+            found = _fetch_bulk(wm, wanted, writer)
+        except Exception as e:
+            print(f"[WARN] Bulk listing failed, falling back to per-wallet calls: {e}")
 
-            # Update database
-            cur.execute(
-                'UPDATE wallets SET balance = ? WHERE student_id = ?',
-                (new_balance, student_id)
-            )
+    # Fetch whatever the listing did not cover, concurrently
+    remaining = wanted - found
+    if remaining:
+        limiter = RateLimiter(rate)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = {pool.submit(_fetch_one, wm, limiter, wallet_id): wallet_id
+                       for wallet_id in remaining}
+            for future in as_completed(futures):
+                wallet_id = futures[future]
+                try:
+                    balance = future.result()
+                except Exception:
+                    balance = None
+                if balance is None:
+                    failed.append(wallet_id)
+                else:
+                    writer.add(wallet_id, balance)
 
-            print(f"\n{wallet['student_name']} ({student_id}):")
-            print(f"  Old balance: {old_balance} KES")
-            print(f"  New balance: {new_balance} KES")
+    writer.flush()
 
-            if new_balance != old_balance:
-                print(f"  [OK] Updated!")
-            else:
-                print(f"  [OK] No change")
-        else:
-            print(f"\n{wallet['student_name']} ({student_id}): ERROR fetching balance")
-
-    # Commit changes
-    conn.commit()
-    conn.close()
-
-    print("\n" + "="*60)
+    elapsed = time.monotonic() - started
+    print(f"Synced:   {writer.synced} ({len(found)} from bulk listing)")
+    print(f"Changed:  {writer.changed}")
+    print(f"Failed:   {len(failed)}")
+    for wallet_id in failed[:20]:
+        print(f"  - {wallet_id}")
+    if len(failed) > 20:
+        print(f"  ... and {len(failed) - 20} more")
+    print(f"Elapsed:  {elapsed:.1f}s")
+    print("="*60)
     print("Sync complete!")
     print("="*60)
 
+    return {'synced': writer.synced, 'changed': writer.changed, 'failed': failed}
+
 if __name__ == "__main__":
-    sync_all_balances()
+    parser = argparse.ArgumentParser(description='Sync wallet balances from IntaSend')
+    parser.add_argument('--workers', type=int, default=SYNC_WORKERS)
+    parser.add_argument('--rate', type=float, default=SYNC_RATE_LIMIT,
+                        help='Max IntaSend requests per second (0 = unlimited)')
+    parser.add_argument('--chunk-size', type=int, default=SYNC_CHUNK_SIZE)
+    parser.add_argument('--no-bulk', action='store_true',
+                        help='Skip the paged wallet listing and fetch each wallet')
+    args = parser.parse_args()
+
+    sync_all_balances(workers=args.workers, rate=args.rate,
+                      chunk_size=args.chunk_size, use_bulk=not args.no_bulk)
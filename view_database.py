@@ -70,17 +70,13 @@ def view_student_details(student_id):
     print(f"Created:       {wallet['created_at']}")
     print(f"Last Updated:  {wallet['updated_at']}")
 
-    # Get transactions
-    transactions = db.get_all_transactions()
-    student_trans = [t for t in transactions
-                     if t.get('student_id') == student_id
-                     or t.get('from_student') == student_id
-                     or t.get('to_student') == student_id]
+    # Get the student's latest transactions (indexed lookup)
+    student_trans = db.get_transactions_by_student(student_id, limit=10)
 
     if student_trans:
-        print(f"\nTransactions: {len(student_trans)}")
+        print(f"\nRecent Transactions: {len(student_trans)}")
         print_separator()
-        for t in student_trans[-10:]:  # Last 10
+        for t in student_trans:
             print(f"  {t['type']:<15} {t['amount']:>8.2f} KES  {t['status']:<12} {t['timestamp']}")
 
 def main_menu():
@@ -116,19 +112,15 @@ def view_statistics():
     """Display database statistics"""
     print_separator("STATISTICS")
 
-    wallets = db.get_all_wallets()
-    transactions = db.get_all_transactions()
-
-    total_balance = sum(w['balance'] for w in wallets)
-    avg_balance = total_balance / len(wallets) if wallets else 0
+    stats = db.get_stats()
 
-    print(f"\nTotal Wallets:       {len(wallets)}")
-    print(f"Total Transactions:  {len(transactions)}")
-    print(f"Total Balance:       {total_balance:.2f} KES")
-    print(f"Average Balance:     {avg_balance:.2f} KES")
+    print(f"\nTotal Wallets:       {stats['wallet_count']}")
+    print(f"Total Transactions:  {stats['transaction_count']}")
+    print(f"Total Balance:       {stats['total_balance']:.2f} KES")
+    print(f"Average Balance:     {stats['average_balance']:.2f} KES")
 
-    if wallets:
-        richest = max(wallets, key=lambda w: w['balance'])
+    richest = stats['richest_wallet']
+    if richest:
         print(f"\nRichest Student:     {richest['student_name']} ({richest['student_id']})")
         print(f"  Balance:           {richest['balance']:.2f} KES")
 
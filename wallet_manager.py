@@ -1,10 +1,27 @@
 #intasend Api integration
 import os
+from functools import wraps
+from urllib.parse import urlparse
 from intasend import APIService
+from intasend_transport import get_transport
+from circuit_breaker import get_breaker
+import metrics
+import logs
 from dotenv import load_dotenv
 
 load_dotenv()
 
+log = logs.get_logger('wallet_manager')
+
+
+def guarded(method):
+    """Run an IntaSend call through the manager's circuit breaker"""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with metrics.intasend_call(method.__name__):
+            return self.breaker.call(method, self, *args, **kwargs)
+    return wrapper
+
 
 class UniversityWalletManager:
 
@@ -16,7 +33,11 @@ class UniversityWalletManager:
         self.is_live = os.getenv('INTASEND_IS_LIVE', 'False').lower() == 'true'
 
         if not self.publishable_key or not self.secret_key:
-            raise ValueError("IntaSend API keys not found. Please check your .env file")
+            if not os.getenv('INTASEND_BASE_URL'):
+                raise ValueError("IntaSend API keys not found. Please check your .env file")
+            # A local stand-in (fake_intasend.py) accepts any keys
+            self.publishable_key = self.publishable_key or 'local-publishable-key'
+            self.secret_key = self.secret_key or 'local-secret-key'
 
         # Initialize IntaSend API service
         #  IntaSend SDK uses 'token' parameter for the secret key
@@ -25,10 +46,15 @@ class UniversityWalletManager:
             publishable_key=self.publishable_key,
             test=not self.is_live
         )
+        # Pooled connections, timeouts and retries for every SDK call
+        get_transport().attach(self.api)
+        # Shared by every manager in the process: IntaSend is one dependency
+        self.breaker = get_breaker('IntaSend')
 
         # Get wallets service
         self.wallet_service = self.api.wallets
 
+    @guarded
     def create_wallet(self, label, currency="KES", can_disburse=True):
        
         try:
@@ -39,50 +65,73 @@ class UniversityWalletManager:
                 can_disburse=can_disburse
             )
 
-            print(f"[OK] Wallet created successfully")
-            print(f"  Label: {label}")
-            print(f"  Wallet ID: {response.get('wallet_id', 'N/A')}")
-            print(f"  Balance: {currency} {response.get('current_balance', 0)}")
+            log.info('Wallet created', extra={
+                'label': label,
+                'wallet_id': response.get('wallet_id'),
+                'balance': response.get('current_balance', 0),
+                'currency': currency
+            })
 
             return response
 
         except Exception as e:
-            print(f"[ERROR] Error creating wallet: {str(e)}")
+            log.error('Error creating wallet', extra={'label': label, 'error': str(e)})
             raise
 
+    @guarded
     def get_wallet_balance(self, wallet_id):
         
         try:
             response = self.wallet_service.retrieve(wallet_id=wallet_id)
             balance = response.get('current_balance', 0)
 
-            print(f"[OK] Wallet {wallet_id} balance: KES {balance}")
+            log.debug('Wallet balance', extra={'wallet_id': wallet_id, 'balance': balance})
 
             return response
 
         except Exception as e:
-            print(f"[ERROR] Error retrieving wallet: {str(e)}")
+            log.error('Error retrieving wallet', extra={'wallet_id': wallet_id, 'error': str(e)})
             raise
 
+    @guarded
     def list_wallets(self):
        
         try:
             response = self.wallet_service.list()
             wallets = response.get('results', [])
 
-            print(f"[OK] Found {len(wallets)} wallet(s)")
-            for wallet in wallets:
-                label = wallet.get('label', 'N/A')
-                balance = wallet.get('current_balance', 0)
-                wallet_id = wallet.get('wallet_id', 'N/A')
-                print(f"  - {label}: KES {balance} (ID: {wallet_id})")
+            log.info('Listed wallets', extra={'count': len(wallets)})
 
             return wallets
 
         except Exception as e:
-            print(f"[ERROR] Error listing wallets: {str(e)}")
+            log.error('Error listing wallets', extra={'error': str(e)})
             raise
 
+    @guarded
+    def fetch_wallet_page(self, next_url=None):
+        """One page of the wallet listing: the first, or the one next_url points to"""
+        if not next_url:
+            return self.wallet_service.retrieve()
+        query = urlparse(next_url).query
+        return self.wallet_service.send_request("GET", f"wallets/?{query}", None)
+
+    def iter_wallet_pages(self):
+        """
+        Yield the wallets on the account one page at a time, following the
+        paged wallet listing. Used for bulk balance syncs; each page goes
+        through the circuit breaker.
+        """
+        response = self.fetch_wallet_page()
+        while True:
+            yield response.get('results', [])
+
+            next_url = response.get('next')
+            if not next_url:
+                break
+            response = self.fetch_wallet_page(next_url)
+
+    @guarded
     def fund_wallet(self, wallet_id, amount, phone_number, email=None):
         
         try:
@@ -106,17 +155,19 @@ class UniversityWalletManager:
                 wallet_id=wallet_id
             )
 
-            print(f"[OK] Funding request initiated for wallet {wallet_id}")
-            print(f"  Amount: KES {amount}")
-            print(f"  Phone: {phone_number}")
-            print(f"  Please complete M-Pesa prompt on your phone")
+            log.info('Funding request initiated', extra={
+                'wallet_id': wallet_id,
+                'amount': amount,
+                'invoice_id': (response.get('invoice') or {}).get('invoice_id')
+            })
 
             return response
 
         except Exception as e:
-            print(f"[ERROR] Error funding wallet: {str(e)}")
+            log.error('Error funding wallet', extra={'wallet_id': wallet_id, 'error': str(e)})
             raise
 
+    @guarded
     def transfer_between_wallets(self, origin_wallet_id, destination_wallet_id, amount, narrative="Canteen payment"):
         
         try:
@@ -127,34 +178,38 @@ class UniversityWalletManager:
                 narrative
             )
 
-            print(f"[OK] Transfer API response:")
-            print(f"  Response: {response}")
-            print(f"  From: {origin_wallet_id}")
-            print(f"  To: {destination_wallet_id}")
-            print(f"  Amount: KES {amount}")
-            print(f"  Narrative: {narrative}")
+            log.info('Transfer submitted', extra={
+                'origin_wallet_id': origin_wallet_id,
+                'destination_wallet_id': destination_wallet_id,
+                'amount': amount,
+                'tracking_id': response.get('tracking_id')
+            })
+            log.info('Transfer response', extra={'response': response, 'sample': True})
 
             return response
 
         except Exception as e:
-            print(f"[ERROR] Error transferring funds: {str(e)}")
+            log.error('Error transferring funds', extra={
+                'origin_wallet_id': origin_wallet_id,
+                'destination_wallet_id': destination_wallet_id,
+                'amount': amount,
+                'error': str(e)
+            })
             raise
 
+    @guarded
     def get_wallet_transactions(self, wallet_id):
        
         try:
             response = self.wallet_service.transactions(wallet_id=wallet_id)
             transactions = response.get('results', [])
 
-            print(f"[OK] Found {len(transactions)} transaction(s) for wallet {wallet_id}")
-            for txn in transactions:
-                print(f"  - {txn.get('created_at')}: {txn.get('narrative')} - "
-                      f"KES {txn.get('value', 0)} ({txn.get('transaction_type')})")
+            log.debug('Listed wallet transactions', extra={'wallet_id': wallet_id, 'count': len(transactions)})
 
             return transactions
 
         except Exception as e:
-            print(f"[ERROR] Error retrieving transactions: {str(e)}")
+            log.error('Error retrieving transactions', extra={'wallet_id': wallet_id, 'error': str(e)})
             raise
 
 
@@ -166,5 +221,7 @@ if __name__ == "__main__":
 
     # List existing wallets
     print("1. Listing existing wallets...")
-    manager.list_wallets()
+    for wallet in manager.list_wallets():
+        print(f"  - {wallet.get('label', 'N/A')}: KES {wallet.get('current_balance', 0)} "
+              f"(ID: {wallet.get('wallet_id', 'N/A')})")
 
@@ -0,0 +1,248 @@
+"""
+Durable inbox for IntaSend webhook events
+
+The webhook endpoint only appends the raw event to the webhook_inbox table
+and acknowledges it. A dispatcher thread hands stored events to a pool of
+worker threads, keeping events for the same wallet in arrival order.
+Redeliveries of an event (same event type and invoice_id/tracking_id) are
+ignored on insert. Failed events are retried with exponential backoff and
+copied to webhook_dead_letter once they run out of attempts; the inbox row
+stays behind with status 'dead' so the event is still recognised as a
+redelivery.
+"""
+import os
+import json
+import time
+import queue
+import random
+import threading
+import database as db
+import logs
+
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', 4))
+WEBHOOK_MAX_ATTEMPTS = int(os.getenv('WEBHOOK_MAX_ATTEMPTS', 5))
+WEBHOOK_RETRY_BASE = float(os.getenv('WEBHOOK_RETRY_BASE', 2))          # seconds
+WEBHOOK_POLL_INTERVAL = float(os.getenv('WEBHOOK_POLL_INTERVAL', 1))    # seconds
+WEBHOOK_LEASE_SECONDS = float(os.getenv('WEBHOOK_LEASE_SECONDS', 300))
+
+log = logs.get_logger('webhook_inbox')
+
+# Rows the dispatcher looks at per pass
+_DISPATCH_BATCH = 500
+
+
+def dedup_key(data):
+    """Identify a delivery of the same provider event"""
+    key = data.get('invoice_id') or data.get('tracking_id')
+    if not key:
+        return None
+    state = data.get('state') or data.get('status') or ''
+    return f'{key}:{state}'
+
+def partition_key(data):
+    """Events sharing this key are processed strictly in order"""
+    return (data.get('wallet_id') or data.get('origin_wallet_id')
+            or data.get('account') or data.get('invoice_id'))
+
+
+def enqueue(raw_payload, data):
+    """
+    Append a webhook event to the inbox.
+
+    Returns the inbox row id, or None if the event was already received.
+    """
+    with db.get_db_connection() as conn:
+        cursor = conn.execute('''
+            INSERT OR IGNORE INTO webhook_inbox (event_type, dedup_key, partition_key, payload)
+            VALUES (?, ?, ?, ?)
+        ''', (data.get('event'), dedup_key(data), partition_key(data), raw_payload))
+        return cursor.lastrowid if cursor.rowcount else None
+
+
+class WebhookInbox:
+    """Background processor for stored webhook events"""
+
+    def __init__(self, handler, workers=WEBHOOK_WORKERS, max_attempts=WEBHOOK_MAX_ATTEMPTS,
+                 retry_base=WEBHOOK_RETRY_BASE, poll_interval=WEBHOOK_POLL_INTERVAL):
+        self.handler = handler
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_base = retry_base
+        self.poll_interval = poll_interval
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_started(self):
+        """Start the dispatcher and workers once per process"""
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._wake = threading.Event()
+            self._stopping = threading.Event()
+            self._work = queue.Queue()
+            self._in_flight = set()
+            self._in_flight_lock = threading.Lock()
+            self._threads = [threading.Thread(target=self._dispatch_loop,
+                                              name='webhook-dispatcher', daemon=True)]
+            self._threads += [threading.Thread(target=self._worker_loop,
+                                               name=f'webhook-worker-{i}', daemon=True)
+                              for i in range(self.workers)]
+            for thread in self._threads:
+                thread.start()
+            self._pid = os.getpid()
+
+    def notify(self):
+        """Wake the dispatcher after a new event was stored"""
+        if self._pid == os.getpid():
+            self._wake.set()
+
+    def stop(self, timeout=5):
+        """Stop the background threads (events stay in the inbox)"""
+        if self._pid != os.getpid():
+            return
+        self._stopping.set()
+        self._wake.set()
+        for _ in range(self.workers):
+            self._work.put(None)
+        for thread in self._threads:
+            thread.join(timeout)
+        self._pid = None
+
+    def _dispatch_loop(self):
+        while not self._stopping.is_set():
+            wait = self.poll_interval
+            try:
+                next_due = self._dispatch()
+                if next_due is not None:
+                    wait = min(wait, max(0.0, next_due - time.time()))
+            except Exception:
+                log.exception('Webhook dispatcher error')
+            self._wake.wait(wait)
+            self._wake.clear()
+
+    def _dispatch(self):
+        """
+        Claim every event whose wallet has nothing older still outstanding.
+        Returns the time the next delayed retry falls due, if any.
+        """
+        now = time.time()
+        with db.get_db_connection() as conn:
+            rows = conn.execute('''
+                SELECT id, event_type, partition_key, payload, status, attempts,
+                       next_attempt_at, locked_until
+                FROM webhook_inbox
+                WHERE status IN ('pending', 'processing')
+                ORDER BY id
+                LIMIT ?
+            ''', (_DISPATCH_BATCH,)).fetchall()
+
+        blocked = set()
+        next_due = None
+        for row in rows:
+            key = row['partition_key'] or f"event:{row['id']}"
+            with self._in_flight_lock:
+                busy = key in blocked or key in self._in_flight
+            if busy:
+                blocked.add(key)
+                continue
+
+            held_elsewhere = row['status'] == 'processing' and row['locked_until'] > now
+            if held_elsewhere or row['next_attempt_at'] > now:
+                if not held_elsewhere:
+                    next_due = min(next_due or row['next_attempt_at'], row['next_attempt_at'])
+                blocked.add(key)
+                continue
+
+            if self._claim(row, now):
+                with self._in_flight_lock:
+                    self._in_flight.add(key)
+                self._work.put((key, row))
+            blocked.add(key)
+
+        return next_due
+
+    def _claim(self, row, now):
+        """Lease a row so no other process picks it up"""
+        with db.get_db_connection() as conn:
+            cursor = conn.execute('''
+                UPDATE webhook_inbox
+                SET status = 'processing', locked_until = ?
+                WHERE id = ? AND status = ? AND locked_until = ?
+            ''', (now + WEBHOOK_LEASE_SECONDS, row['id'], row['status'], row['locked_until']))
+            return cursor.rowcount > 0
+
+    def _worker_loop(self):
+        while True:
+            item = self._work.get()
+            if item is None:
+                return
+            key, row = item
+            try:
+                self._process(row)
+            except Exception:
+                # e.g. the database was locked while recording the outcome; the
+                # row keeps its lease and is picked up again once it expires
+                log.exception('Webhook worker error', extra={'inbox_id': row['id']})
+            finally:
+                with self._in_flight_lock:
+                    self._in_flight.discard(key)
+                self._wake.set()
+
+    def _process(self, row):
+        try:
+            self.handler(json.loads(row['payload']))
+        except Exception as e:
+            self._fail(row, e)
+            return
+
+        with db.get_db_connection() as conn:
+            conn.execute('''
+                UPDATE webhook_inbox
+                SET status = 'done', attempts = attempts + 1, locked_until = 0,
+                    last_error = NULL, processed_at = CURRENT_TIMESTAMP
+                WHERE id = ?
+            ''', (row['id'],))
+
+    def _fail(self, row, error):
+        attempts = row['attempts'] + 1
+        log.error('Webhook event failed', extra={
+            'inbox_id': row['id'], 'event': row['event_type'], 'attempt': attempts,
+            'max_attempts': self.max_attempts, 'error': str(error)
+        })
+
+        with db.get_db_connection() as conn:
+            if attempts >= self.max_attempts:
+                conn.execute('''
+                    INSERT INTO webhook_dead_letter
+                    (inbox_id, event_type, dedup_key, payload, attempts, last_error, received_at)
+                    SELECT id, event_type, dedup_key, payload, ?, ?, received_at
+                    FROM webhook_inbox WHERE id = ?
+                ''', (attempts, str(error), row['id']))
+                # Kept as 'dead' rather than deleted so its dedup key still
+                # rejects redeliveries of the same event
+                conn.execute('''
+                    UPDATE webhook_inbox
+                    SET status = 'dead', attempts = ?, locked_until = 0, last_error = ?
+                    WHERE id = ?
+                ''', (attempts, str(error), row['id']))
+                return
+
+            delay = self.retry_base * (2 ** (attempts - 1)) * random.uniform(0.8, 1.2)
+            conn.execute('''
+                UPDATE webhook_inbox
+                SET status = 'pending', attempts = ?, next_attempt_at = ?,
+                    locked_until = 0, last_error = ?
+                WHERE id = ?
+            ''', (attempts, time.time() + delay, str(error), row['id']))
+
+
+def stats():
+    """Count inbox events by status, plus dead letters"""
+    with db.get_db_connection() as conn:
+        counts = {row['status']: row['n'] for row in conn.execute(
+            'SELECT status, COUNT(*) AS n FROM webhook_inbox GROUP BY status')}
+        counts['dead_letter'] = conn.execute(
+            'SELECT COUNT(*) FROM webhook_dead_letter').fetchone()[0]
+        return counts
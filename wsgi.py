@@ -0,0 +1,10 @@
+"""
+WSGI entry point for production servers
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+
+gunicorn.conf.py sets the worker count, threads and per-worker startup.
+"""
+from app import app, init_worker
+
+__all__ = ['app', 'init_worker']